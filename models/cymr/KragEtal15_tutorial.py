@@ -11,10 +11,19 @@ from cymr import parameters
 from cymr import network
 
 import tutorial_helpers as th
-
-#from numpy.random import Generator, PCG64
-#rng = Generator(PCG64(seed=42))
-rng = np.random.default_rng()
+import sweep
+import permutation
+import generation
+import summaries
+import cmr_l
+import comparison
+
+# one seed for the whole tutorial; the random generator used below and
+# each simulation get their own independent stream from it, so every run
+# gives the same results
+seed_seq = np.random.SeedSequence(42)
+rng_seed, sim_seed, dyn_sim_seed = seed_seq.spawn(3)
+rng = np.random.default_rng(rng_seed)
 
 # setting the path for where you want to save figures
 # change this to be a folder on your computer
@@ -91,8 +100,10 @@ orig_B_rec = param_def.fixed['B_rec']
 # Each row in the synth_study dataframe describes a study event (the presentation
 # of a to-be-remembered word). The code iterates through these to simulate an experiment.
 # The generate function returns 'sim', a dataframe containing the original study events,
-# and model-generated recall events.
-sim = model.generate(synth_study, param_def.fixed, param_def=param_def, patterns=patterns, n_rep=2)
+# and model-generated recall events. generation.generate runs cymr's generate
+# for each subject and replicate in parallel, each with its own random stream.
+sim = generation.generate(model, synth_study, param_def.fixed, param_def=param_def,
+                          patterns=patterns, n_rep=2, seed=sim_seed, n_jobs=2)
 
 # The likelihood function takes a set of study and recall events and determines
 # how likely it is that the model defined by param_def (and the model code) generated
@@ -134,20 +145,13 @@ plt.savefig(figpath+'crp.pdf', bbox_inches='tight')
 
 # parameter sweep B_rec
 print('running parameter sweep over B_rec')
-# make a copy of the parameter definitions object
-param_sweep = parameters.Parameters()
-param_sweep.fixed = param_def.fixed.copy()
-
+# each value of B_rec replaces the fixed value in param_def; the sweep
+# is split across n_jobs worker processes, and results are cached, so
+# re-running this section (or overlapping sweeps) is free
 B_rec_vals = np.linspace(0, 1, 11)
-logl_vals = np.zeros((len(B_rec_vals),), dtype=float)
-for i in range(len(B_rec_vals)):
-    param_sweep.fixed['B_rec'] = B_rec_vals[i]
-    results = model.likelihood(sim, param_sweep.fixed,
-                               param_def=param_def,
-                               patterns=patterns)
-    logl_vals[i] = np.sum(results['logl'])
-    print('*', end='')
-print('')
+sweep_res = sweep.likelihood_sweep(model, sim, param_def, {'B_rec': B_rec_vals},
+                                   patterns=patterns, n_jobs=2)
+logl_vals = sweep.to_grid(sweep_res, 'B_rec')
 
 # This figure demonstrates that the best-fitting model (largest likelihood value)
 # has a B_rec parameter value that matches B_rec of the generating model
@@ -195,12 +199,13 @@ param_def.fixed['neural_scaling'] = neural_scaling
 
 # The 'recall' key specifies that this dynamic parameter changes with each recall event.  
 # The 'B_rec' key specifies which parameter will be updated.
-# The set_dynamic function evaluates the string following 'B_rec', using the numpy
+# The set_dynamic function (called through th.set_recall_dynamic, which
+# handles the different cymr signatures) evaluates the string following 'B_rec', using the numpy
 # namespace and the namespace of the parameters defined in param_def.fixed.
 # The stochastic hcmp values are scaled and added to B_rec, and 'clip' 
 # bounds B_rec at 0 and 1 (because the B_rec parameter is limited to this range).
 
-param_def.set_dynamic('recall', {'B_rec': 'clip(B_rec + hcmp * neural_scaling, 0, 1)'})
+th.set_recall_dynamic(param_def, {'B_rec': 'clip(B_rec + hcmp * neural_scaling, 0, 1)'})
 
 # recall_keys tells the generate function to preserve the 'hcmp' column on the events dataframe
 # and that the relevant values of 'hcmp' are the ones defined for recall events
@@ -209,13 +214,12 @@ recall_keys = ['hcmp']
 
 # n_rep (number of repetitions) controls how much data is generated, e.g.
 # n_rep=2 tells it to generate 2x as much data as in the dataframe provided
-dyn_sim = model.generate(ndf, param_def.fixed, param_def=param_def,
-                         patterns=patterns, recall_keys=recall_keys, n_rep=1)
-
 # dyn_sim is a data structure containing study events and recall events.
-# but the model code doesn't pass the 'hcmp' value back out, so
-# we will have to copy it over from the ndf dataframe
-dyn_sim = th.fix_hcmp_field(ndf, dyn_sim)
+# the model code doesn't pass the 'hcmp' value back out, so generation.generate
+# copies it over from the ndf dataframe onto the simulated recall events
+dyn_sim = generation.generate(model, ndf, param_def.fixed, param_def=param_def,
+                              patterns=patterns, recall_keys=recall_keys, n_rep=1,
+                              seed=dyn_sim_seed, n_jobs=2)
 
 # demonstrate how lag-CRP is different for recall events with
 # low vs high temporal reinstatement
@@ -225,9 +229,14 @@ dyn_sim = th.fix_hcmp_field(ndf, dyn_sim)
 # preserve the 'hcmp' column for recall events).
 dsh_merged = fr.merge_free_recall(dyn_sim, recall_keys=['hcmp'])
 
+# the summaries module converts the merged data once into a dense
+# (list x output position) matrix, then computes the same statistics as
+# psifr's lag_crp and lag_rank with array operations
+dsh_mat = summaries.recall_matrix(dsh_merged, keys=['hcmp'])
+
 print('running lag-CRP analyses')
 # lag-CRP curve for all recall transitions
-crp = fr.lag_crp(dsh_merged)
+crp = summaries.lag_crp(dsh_mat)
 g = fr.plot_lag_crp(crp)
 g.set(ylim=(0, .6))
 plt.savefig(figpath+'dsh_overall_crp.pdf', bbox_inches='tight')
@@ -240,19 +249,31 @@ plt.savefig(figpath+'dsh_overall_crp.pdf', bbox_inches='tight')
 # value for hcmp / temporal reinstatement.
 th.plot_var_crp(dsh_merged, figpath)
 
-tf_all = fr.lag_rank(dsh_merged)
-tf_lo = fr.lag_rank(dsh_merged, test_key='hcmp', test=lambda x, y: x < -0.5)
-tf_hi = fr.lag_rank(dsh_merged, test_key='hcmp', test=lambda x, y: x > 0.5)
+# conditional versions use a mask of the transitions to include,
+# equivalent to psifr's test_key='hcmp' with the same test
+tf_all = summaries.lag_rank(dsh_mat)
+tf_lo = summaries.lag_rank(
+    dsh_mat, summaries.transition_mask(dsh_mat, 'hcmp', lambda x, y: x < -0.5))
+tf_hi = summaries.lag_rank(
+    dsh_mat, summaries.transition_mask(dsh_mat, 'hcmp', lambda x, y: x > 0.5))
 
 # SECTION 5. Running predictive simulations given the data created by the
 # model with temporal reinstatement (B_rec) that varies across recall events.
 
-# calculate likelihood under perfect case where B_rec fluctuations perfectly
-# match what was used to create the synthetic data
-
 # 'hcmp' is a recall_key, as described above
 recall_keys = ['hcmp']
 
+# the sweeps and scrambles below evaluate the same data many times, with
+# only the parameters or the 'hcmp' values changing. cmr_l.Model is a
+# NumPy implementation of the same likelihood; given prepared data, the
+# study and recall events, item indices and 'hcmp' values are extracted
+# once, and a different version of 'hcmp' can be swapped in without
+# copying anything else
+engine = cmr_l.Model()
+dyn_data = cmr_l.prepare_lists(dyn_sim, recall_keys)
+
+# calculate likelihood under perfect case where B_rec fluctuations perfectly
+# match what was used to create the synthetic data
 results = model.likelihood(dyn_sim, param_def.fixed,
                            param_def=param_def,
                            patterns=patterns,
@@ -283,6 +304,8 @@ noise = rng.standard_normal(size=hcmp_rec.shape[0])
 
 noisy_vals = (hcmp_rec * (1-noise_weight)) + (noise * noise_weight)
 dndf.loc[(dndf.trial_type=='recall'), 'hcmp'] = noisy_vals
+# prepared version of dndf, sharing everything but 'hcmp' with dyn_data
+dn_data = dyn_data.with_covariate('hcmp', noisy_vals)
 
 # sweep over neural scaling and B_rec base values
 dnparam = param_def.copy()
@@ -291,36 +314,27 @@ dnparam = param_def.copy()
 # dnparam.fixed = param_def.fixed.copy()
 # dnparam.weights = param_def.weights.copy()
 # dnparam.dynamic = {'recall': {'B_rec': 'clip(B_rec + hcmp * neural_scaling, 0, 1)'}}
-dnparam.set_dynamic('recall', {'B_rec': 'clip(B_rec + hcmp * neural_scaling, 0, 1)'})
+th.set_recall_dynamic(dnparam, {'B_rec': 'clip(B_rec + hcmp * neural_scaling, 0, 1)'})
 recall_keys = ['hcmp']
 
 B_rec_vals = np.array([0.3, 0.4, 0.5, 0.6, 0.7])
 nscale_vals = np.array([0.0, 0.05, 0.1, 0.15, 0.2, 0.25, 0.3])
 
-logl_vals = np.zeros((len(B_rec_vals), len(nscale_vals)))
-
 print('running parameter sweep over B_rec and neural_scaling')
-for i in range(len(B_rec_vals)):
-    for j in range(len(nscale_vals)):
-        # set the parameters
-        dnparam.fixed['B_rec'] = B_rec_vals[i]
-        dnparam.fixed['neural_scaling'] = nscale_vals[j]
-        # evaluate likelihood
-        results = model.likelihood(dndf, dnparam.fixed,
-                                   param_def=param_def,
-                                   patterns=patterns,
-                                   recall_keys=recall_keys)
-        logl_vals[i,j] = np.sum(results['logl'])
-        print('*', end='')
-print('')
+dn_res = sweep.likelihood_sweep(engine, dn_data, dnparam,
+                                {'B_rec': B_rec_vals, 'neural_scaling': nscale_vals},
+                                n_jobs=2)
+# [B_rec x neural_scaling] matrix of log-likelihood values
+logl_vals = sweep.to_grid(dn_res, ['B_rec', 'neural_scaling'])
+dn_best = sweep.best_point(dn_res)
 
 width = 10
 precision = 7
 # using python formatted strings to print results
 print(f"Original model: B_rec={param_def.fixed['B_rec']}, neural_scaling={param_def.fixed['neural_scaling']}")
-print(f'Best fitting neurally informed model:\n log-likelihood: {np.max(logl_vals):{width}.{precision}}')
-print(f' B_rec: {B_rec_vals[np.unravel_index(np.argmax(logl_vals), logl_vals.shape)[0]]}, ', end='')
-print(f'neural_scaling: {nscale_vals[np.unravel_index(np.argmax(logl_vals), logl_vals.shape)[1]]}')
+print(f'Best fitting neurally informed model:\n log-likelihood: {dn_best.logl:{width}.{precision}}')
+print(f' B_rec: {dn_best.B_rec}, ', end='')
+print(f'neural_scaling: {dn_best.neural_scaling}')
 
 # likelihood for a version of the model where B_rec is not dynamic
 # i.e., the generating model had dynamic variability in B_rec, but the evaluating
@@ -330,52 +344,44 @@ naiveparam = cmr.CMRParameters()
 naiveparam.fixed = param_def.fixed.copy()
 naiveparam.weights = param_def.weights.copy()
 naiveparam.sublayers = param_def.sublayers.copy()
-# this isn't strictly necessary as naiveparam doesn't have a dynamic param field to actually make use of neural_scaling
-naiveparam.fixed['neural_scaling'] = 0
-
-naive_logl = np.zeros((len(B_rec_vals)))
+# naiveparam has no dynamic parameter to make use of neural_scaling, so it
+# is left out (cmr_l rejects parameters that the model would not use)
+del naiveparam.fixed['neural_scaling']
 
 print('running parameter sweep over B_rec for neurally naive model')
-for i in range(len(B_rec_vals)):
-    naiveparam.fixed['B_rec'] = B_rec_vals[i]
-    results = model.likelihood(dndf, naiveparam.fixed,
-                               param_def=naiveparam,
-                               patterns=patterns)
-    naive_logl[i] = np.sum(results['logl'])
-    n = np.sum(results['n'])
+naive_res = sweep.likelihood_sweep(engine, dn_data, naiveparam, {'B_rec': B_rec_vals},
+                                   n_jobs=2)
+naive_logl = sweep.to_grid(naive_res, 'B_rec')
+naive_best = sweep.best_point(naive_res)
+n = naive_best.n
 
 print(f"Original model: B_rec={param_def.fixed['B_rec']}, neural_scaling={param_def.fixed['neural_scaling']}")
 print('Evaluating neurally naive model')
-print(f'Best fitting model:\n log-likelihood: {np.max(naive_logl):{width}.{precision}}')
-print(f' B_rec: {B_rec_vals[np.unravel_index(np.argmax(naive_logl), naive_logl.shape)[0]]}')
+print(f'Best fitting model:\n log-likelihood: {naive_best.logl:{width}.{precision}}')
+print(f' B_rec: {naive_best.B_rec}')
 
 # SECTION 6. Model comparison
-# Calculating AIC with correction for finite samples
-# syntax: calc_aic(n, V, L)
+# Calculating AIC with correction for finite samples (AICc)
+# syntax: comparison.aicc(L, n, k)
+# L is log-likelihood (any array, e.g. a whole sweep grid)
 # n is number of estimated data points
-# V is number of free param
-# L is log-likelihood
+# k is number of free param
 
-sweep_aic_vals = np.zeros((logl_vals.shape))
-naive_aic_vals = np.zeros((naive_logl.shape))
-for i in range(len(B_rec_vals)):
-    naive_aic_vals[i] = th.calc_aic(n, 1, naive_logl[i])
-    for j in range(len(nscale_vals)):
-        sweep_aic_vals[i, j] = th.calc_aic(n, 2, logl_vals[i, j])
+# AICc of every variant in each sweep, in one call per grid
+sweep_aic_vals = comparison.aicc(logl_vals, n, 2)
+naive_aic_vals = comparison.aicc(naive_logl, n, 1)
 
-best_aic = np.zeros((2,))
-# 0 is naive, 1 is neurally informed
-best_aic[0] = naive_aic_vals[np.unravel_index(np.argmax(naive_logl), naive_logl.shape)[0]]
-best_aic[1] = sweep_aic_vals[np.unravel_index(np.argmax(logl_vals), logl_vals.shape)]
+# best variant of each model, compared using AICc, BIC and Akaike weights
+# (the relative likelihood of each model, exp(-delta AICc / 2), normalized)
+table = comparison.compare({'naive': naive_res, 'neural': dn_res},
+                           k={'naive': 1, 'neural': 2})
+best_aic = table['aicc'].to_numpy()
+waic = table['w_aicc'].to_numpy()
 
 print('AIC score for best-fitting naive model:')
 print(f' AIC: {best_aic[0]:{width}.{precision}}')
 print('AIC score for best-fitting neurally informed model:')
 print(f' AIC: {best_aic[1]:{width}.{precision}}')
-
-# weighted AIC for best-fit naive vs best-fit neural
-temp_waic = np.exp(-0.5 * (best_aic - np.max(best_aic)))
-waic = temp_waic / np.sum(temp_waic)
 print(f'wAIC naive: {waic[0]:{width}.{precision}}, wAIC neural: {waic[1]:{width}.{precision}}')
 
 # check whether n from likelihood function includes termination events
@@ -392,30 +398,15 @@ print(f'wAIC naive: {waic[0]:{width}.{precision}}, wAIC neural: {waic[1]:{width}
 # then we can see how scrambling the neural signal affects the likelihood
 # scores under otherwise perfect conditions
 
-# set this to 100 or more for a more refined p-value
-n_scrambles = 20
-logl_perm = np.zeros((n_scrambles,))
+# this is the most scrambles that will be run; the test stops early once
+# the confidence interval on the p-value is clearly above or below alpha
+n_scrambles = 200
 
 orig_vals = dyn_sim.loc[(dyn_sim.trial_type=='recall'), 'hcmp'].values
 
 dnparam.fixed['B_rec'] = orig_B_rec
 dnparam.fixed['neural_scaling'] = neural_scaling
 
-for i in range(n_scrambles):
-    # shuffle around the neural signal and place it back on the dataframe
-    #shuffle_inds = np.random.permutation(orig_vals.shape[0])
-    shuffle_inds = rng.permutation(orig_vals.shape[0])
-    shuf_vals = orig_vals[shuffle_inds]
-    dndf.loc[(dndf.trial_type == 'recall'), 'hcmp'] = shuf_vals
-    # calculate likelihood of data given model with shuffled neural signal
-    results = model.likelihood(dndf, dnparam.fixed,
-                               param_def=dnparam,
-                               patterns=patterns,
-                               recall_keys=recall_keys)
-    logl_perm[i] = np.sum(results['logl'])
-    print('*', end='')
-print('')
-
 # we can get a p-value out of this permutation analysis by
 # comparing the log-likelihood of the model with the unscrambled
 # neural signal, to the distribution of log-likelihoods with
@@ -423,17 +414,25 @@ print('')
 
 # The likelihoods with scrambled signal tend to be much worse than for the
 # intact model, so this permutation analysis will likely produce a
-# p-value of zero.  However, if you decide to explore modifications to the
+# p-value close to zero.  However, if you decide to explore modifications to the
 # tutorial, you may find cases where this final analysis is more informative
 
 best_logl = np.max(logl_vals)
-# count up the number of times the scrambled logl value exceeds the
-# original logl value
-pval = np.sum(best_logl < logl_perm) / n_scrambles
+
+# all shuffles of the original neural signal are drawn from rng up front,
+# then each scramble is swapped into the prepared data (dn_data) and the
+# likelihood of the data is calculated given the model with the shuffled
+# neural signal. strata='subject' would only shuffle within subject.
+# the p-value counts the scrambles whose logl reaches the original
+# logl value: (n_exceed + 1) / (n_perm + 1)
+perm = permutation.permutation_test(
+    engine, dn_data, dnparam, 'hcmp', n_perm=n_scrambles,
+    values=orig_vals, observed=best_logl, n_jobs=2, rng=rng,
+    callback=lambda s: print(f"{s['n_perm']} scrambles, p = {s['pval']:.4f}"))
+logl_perm = perm['logl_perm']
+pval = perm['pval']
 
 print(f'Best log-likelihood with scrambled neural signal: {np.max(logl_perm):{width}.{precision}}')
 print(f'p-value for neurally informed model against permutation distribution: {pval:{width}.{precision}}')
 
 print('A good place for a final breakpoint.')
-
-
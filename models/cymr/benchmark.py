@@ -0,0 +1,319 @@
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+from psifr import fr
+from cymr import cmr
+
+import cmr_l
+import expt_builder as eb
+import fitting
+import generation
+import item_patterns as ip
+
+# end-to-end parameter recovery benchmarks. each configuration (list
+# length x number of subjects x set of free parameters) runs the whole
+# pipeline: build the experiment, generate data from known subject
+# parameters, merge it for analysis, evaluate the likelihood at the true
+# parameters, and fit. the wall time and peak memory of every stage are
+# recorded with the recovery error of the fit, one json record per
+# configuration appended to a results file, so runs of different
+# versions can be compared (see compare_runs).
+#
+# peak memory is measured with tracemalloc (numpy allocations are
+# included), relative to the memory in use when the stage starts.
+# tracing slows down python-heavy code, so times are only comparable
+# between runs with the same trace_memory setting, which is stored in
+# each record. with n_jobs > 1, work done in worker processes is not
+# traced.
+#
+# usage (from models/cymr):
+#   python benchmark.py run --grid quick --out bench.jsonl
+#   python benchmark.py compare base.jsonl bench.jsonl
+
+# fixed parameters of the generating model, as in the tutorial
+BASE_PARAM = {'B_enc': 0.7, 'B_rec': 0.5, 'w_loc': 1, 'P1': 8.0, 'P2': 1.0,
+              'T': 0.35, 'X1': 0.001, 'X2': 0.5, 'Lfc': 1, 'Lcf': 1,
+              'Dfc': 3, 'Dcf': 1, 'B_start': 0}
+
+# free parameter sets, with fitting bounds
+PARAM_SETS = {
+    'context': {'B_enc': (0, 1), 'B_rec': (0, 1)},
+    'primacy': {'P1': (0, 15), 'P2': (0, 3)},
+    'full': {'B_enc': (0, 1), 'B_rec': (0, 1), 'P1': (0, 15), 'P2': (0, 3)},
+}
+
+# true subject parameters are drawn from this part of each range, so
+# recovery is not dominated by estimates stuck at a bound
+TRUE_RANGE = (0.2, 0.8)
+
+GRIDS = {
+    'quick': {'list_len': [10, 24], 'n_subj': [10], 'param_set': ['context']},
+    'full': {'list_len': [10, 25, 50, 100], 'n_subj': [10, 100, 1000],
+             'param_set': list(PARAM_SETS)},
+}
+
+
+def param_def_for(free):
+    # cymr parameters for the generating model, with the free
+    # parameters (dict of bounds) set free
+    param_def = cmr.CMRParameters()
+    param_def.set_sublayers(f=['task'], c=['task'])
+    param_def.set_weights('fc', {(('task', 'item'), ('task', 'item')): 'Dfc * w_loc * loc'})
+    param_def.set_weights('cf', {(('task', 'item'), ('task', 'item')): 'Dcf * w_loc * loc'})
+    param_def.set_fixed(**{k: v for k, v in BASE_PARAM.items() if k not in free})
+    param_def.set_free(**free)
+    return param_def
+
+
+def true_params(subjects, free, rng):
+    # DataFrame indexed by subject of true values of the free parameters
+    rng = np.random.default_rng(rng)
+    lo, hi = TRUE_RANGE
+    values = {}
+    for name, (lower, upper) in free.items():
+        u = rng.uniform(lo, hi, len(subjects))
+        values[name] = lower + u * (upper - lower)
+    return pd.DataFrame(values, index=pd.Index(subjects, name='subject'))
+
+
+@contextlib.contextmanager
+def measure(stages, name, trace_memory=True):
+    # record the wall time (s) and peak memory (MB above the starting
+    # point) of the enclosed code in stages[name]
+    if trace_memory:
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    yield
+    record = {'time': time.perf_counter() - start}
+    if trace_memory:
+        record['peak_mb'] = (tracemalloc.get_traced_memory()[1] - base) / 2 ** 20
+    stages[name] = record
+
+
+def recovery(truth, fit):
+    # rmse, bias and correlation of estimated against true values of
+    # each parameter
+    out = {}
+    for name in truth.columns:
+        true = truth[name].to_numpy()
+        est = fit.loc[truth.index, name].to_numpy()
+        err = est - true
+        corr = np.nan
+        if true.shape[0] > 2 and np.std(true) > 0 and np.std(est) > 0:
+            corr = float(np.corrcoef(true, est)[0, 1])
+        out[name] = {'rmse': float(np.sqrt(np.mean(err ** 2))),
+                     'bias': float(np.mean(err)), 'corr': corr}
+    return out
+
+
+def run_config(list_len, n_subj, param_set, n_trials=10, seed=0,
+               fit_method='group', n_starts=2, n_jobs=1, trace_memory=True):
+    # run the pipeline for one configuration; returns a record with the
+    # configuration, stage costs, and recovery
+    free = PARAM_SETS[param_set]
+    seed_seq = np.random.SeedSequence(seed)
+    param_seed, gen_seed, fit_seed = seed_seq.spawn(3)
+    stages = {}
+    started = trace_memory and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    try:
+        with measure(stages, 'build', trace_memory):
+            patterns = ip.create_patterns(list_len, localist='dense')
+            study = eb.build_expt(patterns, n_subj, n_trials, list_len)
+        param_def = param_def_for(free)
+        truth = true_params(study['subject'].unique(), free, param_seed)
+        subj_param = {subject: row.to_dict() for subject, row in truth.iterrows()}
+
+        model = cmr.CMR()
+        with measure(stages, 'generate', trace_memory):
+            sim = generation.generate(model, study, param_def.fixed,
+                                      subj_param=subj_param, param_def=param_def,
+                                      patterns=patterns, seed=gen_seed, n_jobs=n_jobs)
+        with measure(stages, 'merge', trace_memory):
+            fr.merge_free_recall(sim)
+        with measure(stages, 'prepare', trace_memory):
+            lists = cmr_l.prepare_lists(sim)
+        with measure(stages, 'likelihood', trace_memory):
+            stats = cmr_l.likelihood(lists, param_def.fixed, subj_param=subj_param)
+        with measure(stages, 'fit', trace_memory):
+            if fit_method == 'group':
+                fit, population = fitting.fit_group(
+                    lists, param_def, n_starts=n_starts, n_jobs=n_jobs,
+                    rng=fit_seed, prior=False)
+                cost = population.attrs
+            elif fit_method == 'indiv':
+                fit = fitting.fit_indiv(lists, param_def, n_starts=n_starts,
+                                        n_jobs=n_jobs, rng=fit_seed)
+                cost = {'n_eval': int(fit['n_eval'].sum()),
+                        'n_iter': int(fit['n_iter'].sum())}
+            else:
+                raise ValueError(f'unknown fit_method: {fit_method}')
+    finally:
+        if started:
+            tracemalloc.stop()
+
+    return {
+        'config': {'list_len': list_len, 'n_subj': n_subj, 'n_trials': n_trials,
+                   'param_set': param_set, 'free': list(free), 'seed': seed,
+                   'fit_method': fit_method, 'n_starts': n_starts,
+                   'n_jobs': n_jobs, 'trace_memory': trace_memory},
+        'data': {'n_events': int(len(sim)),
+                 'n_recalls': int(np.sum(lists['recalls'] > 0))},
+        'stages': stages,
+        'fit': {'logl': float(fit['logl'].sum()),
+                'logl_true': float(stats['logl'].sum()),
+                'n_eval': int(cost['n_eval']), 'n_iter': int(cost['n_iter'])},
+        'recovery': recovery(truth, fit),
+    }
+
+
+def run_info():
+    # version information stored with every record
+    try:
+        commit = subprocess.run(['git', 'describe', '--always', '--dirty'],
+                                capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    import cymr
+    import psifr
+    return {'time': datetime.datetime.now().isoformat(timespec='seconds'),
+            'commit': commit, 'python': platform.python_version(),
+            'numpy': np.__version__, 'pandas': pd.__version__,
+            'cymr': getattr(cymr, '__version__', None),
+            'psifr': getattr(psifr, '__version__', None),
+            'machine': platform.node(), 'processor': platform.processor()}
+
+
+def grid_configs(grid):
+    # list of (list_len, n_subj, param_set) for a named grid or a dict
+    # with the same keys as GRIDS entries
+    if isinstance(grid, str):
+        grid = GRIDS[grid]
+    return [(ll, ns, ps) for ps in grid['param_set']
+            for ns in grid['n_subj'] for ll in grid['list_len']]
+
+
+def run_suite(grid='quick', out=None, callback=None, **config_kws):
+    # run every configuration of a grid; records are appended to the
+    # json lines file out (if given) as they finish. returns the records
+    info = run_info()
+    records = []
+    for list_len, n_subj, param_set in grid_configs(grid):
+        record = {'run': info, **run_config(list_len, n_subj, param_set, **config_kws)}
+        records.append(record)
+        if out is not None:
+            with open(out, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        if callback is not None:
+            callback(record)
+    return records
+
+
+def load_results(path):
+    # flat DataFrame of benchmark records (one row per configuration and
+    # run), with nested fields joined by '.', e.g. stages.fit.time
+    with open(path) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    return pd.json_normalize(records)
+
+
+CONFIG_KEYS = ['config.list_len', 'config.n_subj', 'config.param_set',
+               'config.n_trials', 'config.fit_method', 'config.trace_memory']
+
+
+def compare_runs(baseline, current, time_tol=1.25, memory_tol=1.25,
+                 error_tol=0.02):
+    # compare the latest record of each configuration in two results
+    # files (or frames from load_results). returns one row per stage or
+    # recovery measure of each configuration found in both, with the
+    # baseline and current values, their ratio (or difference, for
+    # errors), and whether the change is a regression: time or memory
+    # above tol times the baseline, or rmse more than error_tol worse
+    base = load_results(baseline) if isinstance(baseline, str) else baseline
+    curr = load_results(current) if isinstance(current, str) else current
+    base = base.drop_duplicates(CONFIG_KEYS, keep='last').set_index(CONFIG_KEYS)
+    curr = curr.drop_duplicates(CONFIG_KEYS, keep='last').set_index(CONFIG_KEYS)
+    common = base.index.intersection(curr.index)
+    rows = []
+    for column in curr.columns:
+        if column.startswith('stages.') and column in base.columns:
+            kind = 'time' if column.endswith('.time') else 'memory'
+            tol = time_tol if kind == 'time' else memory_tol
+            b = base.loc[common, column].to_numpy(dtype=float)
+            c = curr.loc[common, column].to_numpy(dtype=float)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                change = c / b
+            regression = change > tol
+        elif column.startswith('recovery.') and column.endswith('.rmse') and column in base.columns:
+            b = base.loc[common, column].to_numpy(dtype=float)
+            c = curr.loc[common, column].to_numpy(dtype=float)
+            change = c - b
+            regression = change > error_tol
+        else:
+            continue
+        frame = common.to_frame(index=False)
+        frame.columns = [name.split('.', 1)[1] for name in CONFIG_KEYS]
+        frame['measure'] = column
+        frame['baseline'] = b
+        frame['current'] = c
+        frame['change'] = change
+        frame['regression'] = regression
+        rows.append(frame)
+    if not rows:
+        return pd.DataFrame()
+    return pd.concat(rows, ignore_index=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='parameter recovery benchmarks')
+    sub = parser.add_subparsers(dest='command', required=True)
+    run = sub.add_parser('run', help='run a benchmark grid')
+    run.add_argument('--grid', default='quick', choices=list(GRIDS))
+    run.add_argument('--out', default='bench.jsonl')
+    run.add_argument('--n-trials', type=int, default=10)
+    run.add_argument('--fit', default='group', choices=['group', 'indiv'])
+    run.add_argument('--n-starts', type=int, default=2)
+    run.add_argument('--n-jobs', type=int, default=1)
+    run.add_argument('--seed', type=int, default=0)
+    run.add_argument('--no-memory', action='store_true',
+                     help='do not trace memory (faster, times not comparable to traced runs)')
+    comp = sub.add_parser('compare', help='compare two results files')
+    comp.add_argument('baseline')
+    comp.add_argument('current')
+    comp.add_argument('--time-tol', type=float, default=1.25)
+    comp.add_argument('--error-tol', type=float, default=0.02)
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        def report(record):
+            config = record['config']
+            stages = ', '.join(f"{name} {s['time']:.2f}s" for name, s in record['stages'].items())
+            rmse = ', '.join(f"{name} {r['rmse']:.3f}" for name, r in record['recovery'].items())
+            print(f"LL={config['list_len']} n_subj={config['n_subj']} "
+                  f"{config['param_set']}: {stages}; rmse {rmse}")
+        run_suite(args.grid, out=args.out, callback=report, n_trials=args.n_trials,
+                  seed=args.seed, fit_method=args.fit, n_starts=args.n_starts,
+                  n_jobs=args.n_jobs, trace_memory=not args.no_memory)
+    else:
+        result = compare_runs(args.baseline, args.current, time_tol=args.time_tol,
+                              error_tol=args.error_tol)
+        with pd.option_context('display.max_rows', None, 'display.width', 200):
+            print(result)
+        if not result.empty and result['regression'].any():
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
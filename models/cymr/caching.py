@@ -0,0 +1,143 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+# content hashes for data, patterns and parameter definitions, and a
+# small result cache (in memory, optionally backed by a directory of json
+# files) used to memoize likelihood evaluations and fits.
+
+
+def hash_parts(*parts):
+    h = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode()
+        h.update(part)
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def data_hash(data):
+    # hash of the values (not the index) of a free recall DataFrame, or
+    # of prepared data (cmr_l.PreparedData)
+    if hasattr(data, 'content_hash'):
+        return data.content_hash()
+    row_hash = pd.util.hash_pandas_object(data, index=False).to_numpy()
+    return hash_parts(','.join(map(str, data.columns)), row_hash.tobytes())
+
+
+def patterns_hash(patterns):
+    # hash of a cymr patterns dict. arrays are hashed by content; objects
+    # like item_patterns.LocalistPatterns are hashed by their repr, so an
+    # implicit identity is never made dense just to be hashed
+    if patterns is None:
+        return hash_parts('none')
+    parts = [np.asarray(patterns['items']).astype(str).tobytes()]
+    for kind in ('vector', 'similarity'):
+        for name, value in sorted(patterns.get(kind, {}).items()):
+            if isinstance(value, np.ndarray):
+                parts.extend([kind, name, str(value.shape), value.tobytes()])
+            elif hasattr(value, 'tocsr'):
+                value = value.tocsr()
+                parts.extend([kind, name, str(value.shape), value.indptr.tobytes(),
+                              value.indices.tobytes(), value.data.tobytes()])
+            else:
+                parts.extend([kind, name, repr(value)])
+    return hash_parts(*parts)
+
+
+PARAM_DEF_FIELDS = ('options', 'fixed', 'free', 'dependent', 'dynamic',
+                    'sublayers', 'weights', 'sublayer_param')
+
+
+def param_def_hash(param_def):
+    # hash of a cymr Parameters object (or None), over every field it
+    # has (the repr leaves out options, weights and sublayers). dict
+    # entries are sorted, except for dependent parameters, which are
+    # evaluated in order
+    if param_def is None:
+        return hash_parts('none')
+    spec = {}
+    for field in PARAM_DEF_FIELDS:
+        if not hasattr(param_def, field):
+            continue
+        value = getattr(param_def, field)
+        if field == 'dependent':
+            spec[field] = [[name, plain_value(expr)] for name, expr in value.items()]
+        else:
+            spec[field] = canonical_value(value)
+    return hash_parts(json.dumps(spec))
+
+
+def canonical_value(value):
+    # json-serializable form of nested dicts and sequences with sorted
+    # dict entries; keys that are not strings (e.g. the region tuples of
+    # cymr weights) are kept as values
+    if isinstance(value, dict):
+        items = [[canonical_value(k), canonical_value(v)] for k, v in value.items()]
+        return sorted(items, key=json.dumps)
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [canonical_value(v) for v in value]
+    return plain_value(value)
+
+
+def param_key(param):
+    # stable string for a dict of parameter values
+    return json.dumps({k: plain_value(v) for k, v in sorted(param.items())})
+
+
+def plain_value(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return value
+
+
+class ResultCache:
+    # dict-like store of json-serializable results keyed by strings.
+    # with a directory, each result is also written to <dir>/<key>.json
+    # so later runs (and other processes) can reuse it
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.memory = {}
+        self.hits = 0
+        self.misses = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def key(self, *parts):
+        return hash_parts(*parts)
+
+    def get(self, key):
+        if key in self.memory:
+            self.hits += 1
+            return self.memory[key]
+        if self.directory is not None:
+            path = os.path.join(self.directory, key + '.json')
+            if os.path.exists(path):
+                with open(path) as f:
+                    value = json.load(f)
+                self.memory[key] = value
+                self.hits += 1
+                return value
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        self.memory[key] = value
+        if self.directory is not None:
+            path = os.path.join(self.directory, key + '.json')
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(value, f)
+            os.replace(tmp_path, path)
+
+    def clear(self):
+        self.memory.clear()
+        self.hits = 0
+        self.misses = 0
@@ -0,0 +1,1047 @@
+import ast
+from collections import OrderedDict
+import functools
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+import profiling
+
+# NumPy version of the CMR-L likelihood (models/CMR_L), with a list
+# dimension. every list in a batch is simulated at once: context is a
+# [lists x units] array and the weights are [lists x units x units]
+# arrays, so each encoding step, recall step and context update is a
+# single vectorized operation over lists. the structure follows the
+# MATLAB code: check_param, init_network, present_items, p_recall,
+# p_stop and reactivate_item correspond to the *_cmr.m files, and
+# likelihood_batch is the trial loop of cmr_general.
+#
+# parameters can be scalars (all lists), [lists] arrays (e.g. subject
+# parameters repeated for each list), or, for parameters used during
+# recall (B_rec, B_s, T, X1, X2, ...), [lists x recall events] arrays,
+# which play the role of var_param in the MATLAB code.
+#
+# unit layout for list length LL (0-indexed): items 0..LL-1, then LL
+# interpresentation distractor units if B_ipi is set, then one
+# retention-interval unit if B_ri is set, then the start-of-list unit.
+
+AMIN = 0.000001
+PMIN = 0.000001
+
+# parameters that are strings or matrices rather than per-list numbers
+OPTION_PARAM = ('sampling_rule', 'stop_rule', 'sem_mat',
+                'B_s_init_transient')
+
+# parts of the MATLAB model that are not ported
+UNSUPPORTED_PARAM = ('I', 'rehearsal', 'control_proc', 'initiation_control')
+
+# numeric parameters the engine uses, including the MATLAB shorthands
+# (B, P, G, D, C, S) that check_param resolves
+MODEL_PARAM = ('B', 'B_enc', 'B_rec', 'B_ipi', 'B_ri', 'B_s', 'B_s_init',
+               'P', 'P1', 'P2', 'L', 'G', 'D', 'Dfc', 'Dcf', 'C', 'Afc', 'Acf',
+               'S', 'Sfc', 'Scf', 'T', 'X1', 'X2', 'ST', 'k', 'xz', 'lat_inh')
+
+# cymr (and MATLAB) parameters the engine has no counterpart for; these
+# are accepted only at the value that leaves a cymr model unchanged
+NOOP_PARAM = {'B_start': 0, 'w_loc': 1, 'Aff': 0, 'Dff': 0, 'Lfc': 1, 'Lcf': 1}
+
+# options that are ported
+STOP_RULES = ('op',)
+SAMPLING_RULES = ('classic', 'power', 'logistic')
+
+
+def check_param(param, expr_names=()):
+    # fill in defaults, as in check_param_cmr.m. parameters the engine
+    # does not use are rejected rather than ignored, unless they only
+    # feed dependent or dynamic parameter expressions (expr_names)
+    param = dict(param)
+    used = [name for name in UNSUPPORTED_PARAM if param.get(name)]
+    if used:
+        raise ValueError(f'parameters {used} are not supported; '
+                         f'these must be unset or zero: {list(UNSUPPORTED_PARAM)}')
+    unknown = [name for name in param
+               if name not in MODEL_PARAM and name not in OPTION_PARAM
+               and name not in UNSUPPORTED_PARAM and name not in NOOP_PARAM
+               and name not in expr_names]
+    if unknown:
+        raise ValueError(f'parameters {unknown} are not supported; '
+                         f'supported: {list(MODEL_PARAM + OPTION_PARAM)}')
+    changed = [name for name, value in NOOP_PARAM.items()
+               if name in param and name not in expr_names
+               and np.any(np.asarray(param[name], dtype=float) != value)]
+    if changed:
+        raise ValueError(f'parameters {changed} are not supported; '
+                         f'these must be unset or at their no-op values: {NOOP_PARAM}')
+
+    param.setdefault('lat_inh', 0)
+    param.setdefault('B_s_init_transient', False)
+    if 'B' in param:
+        param.setdefault('B_enc', param['B'])
+        param.setdefault('B_rec', param['B'])
+    if 'P' in param:
+        param.setdefault('P1', param['P'])
+
+    if 'Dfc' not in param:
+        if param.get('G') is not None:
+            param['Dfc'] = (1 - param['G']) / param['G']
+        else:
+            param['Dfc'] = 0
+    # setting diagonal, so don't need the G parameter to vary
+    param['G'] = 1
+    if 'D' in param:
+        param['Dcf'] = param['D']
+    param.setdefault('Dcf', 0)
+    param.setdefault('P2', 1000000)
+    param.setdefault('Lfc', 1)
+    param.setdefault('Lcf', 1)
+
+    if 'C' in param:
+        param['Acf'] = param['C']
+    param.setdefault('Acf', 0)
+    if 'S' in param:
+        param['Scf'] = param['S']
+    param.setdefault('Scf', 0)
+    param.setdefault('Sfc', 0)
+    param.setdefault('Afc', 0)
+    param.setdefault('T', 1)
+    param.setdefault('stop_rule', 'op')
+    param.setdefault('sampling_rule', 'classic')
+    if param['stop_rule'] not in STOP_RULES:
+        raise ValueError(f"unknown stop_rule {param['stop_rule']!r}; "
+                         f'supported: {list(STOP_RULES)}')
+    if param['sampling_rule'] not in SAMPLING_RULES:
+        raise ValueError(f"unknown sampling_rule {param['sampling_rule']!r}; "
+                         f'supported: {list(SAMPLING_RULES)}')
+    return param
+
+
+def network_layout(param, LL):
+    # unit indices for a list of length LL
+    n_units = LL
+    ipi_units = None
+    ri_unit = None
+    if 'B_ipi' in param:
+        ipi_units = np.arange(LL, 2 * LL)
+        n_units += LL
+    if 'B_ri' in param:
+        ri_unit = n_units
+        n_units += 1
+    s_unit = n_units
+    n_units += 1
+    return {'LL': LL, 'n_units': n_units, 'ipi_units': ipi_units,
+            'ri_unit': ri_unit, 's_unit': s_unit}
+
+
+def list_param(param, name, n_lists):
+    # [lists] array of a parameter that is fixed within each list
+    value = np.asarray(param[name], dtype=float)
+    if value.ndim > 1:
+        raise ValueError(f'parameter {name} cannot vary within a list')
+    return np.broadcast_to(value, (n_lists,))
+
+
+def event_param(param, name, n_lists, event):
+    # [lists] array of a parameter at a given recall event
+    value = np.asarray(param[name], dtype=float)
+    if value.ndim == 2:
+        value = value[:, event]
+    return np.broadcast_to(value, (n_lists,))
+
+
+def scale_context(cdot, B):
+    return np.sqrt(1 + B ** 2 * (cdot ** 2 - 1)) - (B * cdot)
+
+
+def normalize_rows(x):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return x / np.linalg.norm(x, axis=-1, keepdims=True)
+
+
+def init_network(param, layout, n_lists, pres_itemnos=None):
+    # initial context and weights for a batch of lists, as in
+    # init_network_cmr.m. pres_itemnos ([lists x LL] pool indices) is
+    # only needed when param['sem_mat'] is set
+    LL = layout['LL']
+    n = layout['n_units']
+    items = np.arange(LL)
+    G = list_param(param, 'G', n_lists)
+    Afc = list_param(param, 'Afc', n_lists)
+    Acf = list_param(param, 'Acf', n_lists)
+    Dfc = list_param(param, 'Dfc', n_lists)
+    Dcf = list_param(param, 'Dcf', n_lists)
+
+    c = np.zeros((n_lists, n))
+    c[:, layout['s_unit']] = 1
+
+    w_fc = np.zeros((n_lists, n, n))
+    w_fc[:, np.arange(n), np.arange(n)] = (1 - G)[:, None]
+    w_cf = np.zeros((n_lists, n, n))
+    w_cf_pre = np.zeros((n_lists, n, n))
+
+    w_fc[:, :LL, :LL] += Afc[:, None, None]
+    w_cf_pre[:, :LL, :LL] += Acf[:, None, None]
+
+    # diagonal strength for item self-associations (overrides Afc)
+    diag = w_fc[:, items, items]
+    w_fc[:, items, items] = np.where((Dfc != 0)[:, None], Dfc[:, None], diag)
+    diag = w_cf[:, items, items]
+    w_cf[:, items, items] = np.where((Dcf != 0)[:, None], Dcf[:, None], diag)
+
+    if param.get('sem_mat') is not None:
+        if pres_itemnos is None:
+            raise ValueError('pres_itemnos is required with sem_mat')
+        sem_mat = np.asarray(param['sem_mat'])
+        semantic = sem_mat[pres_itemnos[:, :, None], pres_itemnos[:, None, :]]
+        Sfc = list_param(param, 'Sfc', n_lists)
+        Scf = list_param(param, 'Scf', n_lists)
+        w_fc[:, :LL, :LL] += semantic * Sfc[:, None, None]
+        w_cf_pre[:, :LL, :LL] += semantic * Scf[:, None, None]
+    return c, w_fc, w_cf, w_cf_pre
+
+
+def present_items(c, w_fc, w_cf, param, layout):
+    # study phase for a batch of lists, as in present_items_cmr.m.
+    # c, w_fc and w_cf are updated in place and returned
+    n_lists = c.shape[0]
+    LL = layout['LL']
+    rows = np.arange(n_lists)
+    B_enc = list_param(param, 'B_enc', n_lists)
+    P1 = list_param(param, 'P1', n_lists)
+    P2 = list_param(param, 'P2', n_lists)
+    L = list_param(param, 'L', n_lists) if 'L' in param else 0
+    # assuming orthogonal item representations, an orthogonal initial
+    # state of context, and no off-diagonal pre-experimental
+    # associations on Mfc, the item input to context is a unit vector
+    orth = (list_param(param, 'Afc', n_lists) == 0) & \
+           (list_param(param, 'Sfc', n_lists) == 0)
+    rho_orth = np.sqrt(1 - B_enc ** 2)
+
+    if layout['ipi_units'] is not None:
+        B_ipi = list_param(param, 'B_ipi', n_lists)
+        rho_ipi = np.sqrt(1 - B_ipi ** 2)
+
+    for i in range(LL):
+        if layout['ipi_units'] is not None:
+            # interpresentation interval distraction
+            c *= rho_ipi[:, None]
+            c[:, layout['ipi_units'][i]] += B_ipi
+
+        if orth.all():
+            c *= rho_orth[:, None]
+            c[:, i] += B_enc
+        else:
+            # must calculate the actual projection
+            c_in = normalize_rows(w_fc[:, :, i])
+            rho = scale_context(np.einsum('ij,ij->i', c, c_in), B_enc)
+            c_proj = rho[:, None] * c + B_enc[:, None] * c_in
+            c_unit = rho_orth[:, None] * c
+            c_unit[:, i] += B_enc
+            c = np.where(orth[:, None], c_unit, c_proj)
+
+        # primacy
+        P = (P1 * np.exp(-P2 * i)) + 1 + L
+
+        # update weights
+        w_fc[:, :, i] += c
+        w_cf[rows, i, :] += P[:, None] * c
+
+    if layout['ri_unit'] is not None:
+        # end-of-list distraction
+        B_ri = list_param(param, 'B_ri', n_lists)
+        c *= np.sqrt(1 - B_ri ** 2)[:, None]
+        c[:, layout['ri_unit']] += B_ri
+    return c, w_fc, w_cf
+
+
+# parameters that determine the network state at the end of the study
+# period when the closed-form encoding applies
+ENCODING_PARAM = ('G', 'Dfc', 'Dcf', 'Acf', 'B_enc', 'P1', 'P2', 'L',
+                  'B_ipi', 'B_ri')
+
+
+def use_closed_form(param, n_lists):
+    # the closed form holds under the same condition present_items uses
+    # for its shortcut: orthogonal item inputs to context on every list
+    return bool(np.all(list_param(param, 'Afc', n_lists) == 0) and
+                np.all(list_param(param, 'Sfc', n_lists) == 0))
+
+
+def closed_form_encoding(param, layout):
+    # end-of-list context and weights for one list, without stepping
+    # through the items. with orthonormal inputs each study step scales
+    # context by rho = rho_ipi * rho_enc and adds a new unit, so the
+    # context after item i is
+    #   start unit:  rho ** (i + 1)
+    #   item j <= i: B_enc * rho ** (i - j)
+    #   ipi j <= i:  B_ipi * rho_enc * rho ** (i - j)
+    # and w_fc[:, i] and w_cf[i, :] / P_i are that context.
+    # param: dict of scalar parameter values
+    LL = layout['LL']
+    n = layout['n_units']
+    items = np.arange(LL)
+    B_enc = param['B_enc']
+    rho_enc = np.sqrt(1 - B_enc ** 2)
+    rho = rho_enc
+    if layout['ipi_units'] is not None:
+        rho = rho * np.sqrt(1 - param['B_ipi'] ** 2)
+
+    # [units x LL] context after each item
+    lag = items[None, :] - items[:, None]
+    decay = np.where(lag >= 0, rho ** np.maximum(lag, 0), 0)
+    contexts = np.zeros((n, LL))
+    contexts[:LL] = B_enc * decay
+    if layout['ipi_units'] is not None:
+        contexts[layout['ipi_units']] = param['B_ipi'] * rho_enc * decay
+    contexts[layout['s_unit']] = rho ** (items + 1)
+
+    c = contexts[:, LL - 1].copy()
+    if layout['ri_unit'] is not None:
+        c *= np.sqrt(1 - param['B_ri'] ** 2)
+        c[layout['ri_unit']] += param['B_ri']
+
+    P = (param['P1'] * np.exp(-param['P2'] * items)) + 1 + param.get('L', 0)
+    w_fc = np.eye(n) * (1 - param['G'])
+    w_cf = np.zeros((n, n))
+    if param['Dfc'] != 0:
+        w_fc[items, items] = param['Dfc']
+    if param['Dcf'] != 0:
+        w_cf[items, items] = param['Dcf']
+    w_cf[:LL, :LL] += param['Acf']
+    w_fc[:, :LL] += contexts
+    w_cf[:LL, :] += P[:, None] * contexts.T
+    return c, w_fc, w_cf
+
+
+class EncodingCache:
+    # least-recently-used store of network states after the study
+    # period, keyed on the study structure and encoding parameters.
+    # lists with the same key share one stored state, so encoding cost
+    # scales with the number of distinct study structures and parameter
+    # sets rather than the number of lists
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.states = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        state = self.states.get(key)
+        if state is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.states.move_to_end(key)
+        return state
+
+    def put(self, key, state):
+        for array in state:
+            array.flags.writeable = False
+        self.states[key] = state
+        self.states.move_to_end(key)
+        while len(self.states) > self.maxsize:
+            self.states.popitem(last=False)
+
+    def clear(self):
+        self.states.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self.states), 'maxsize': self.maxsize}
+
+
+# shared by all likelihood calls in the session
+encoding_cache = EncodingCache()
+
+
+@profiling.timed('encoding')
+def encode_groups(param, layout, n_lists, pres_itemnos=None, cache=None):
+    # distinct network states after the study period: a list of
+    # (context, w_fc, w_cf + w_cf_pre) tuples, one per group of lists
+    # with the same encoding parameters (and, if semantic associations
+    # are used, the same presented items), and the [lists] group index.
+    # each group's state comes from the cache or is computed once (in
+    # closed form in the orthogonal case)
+    if cache is None:
+        cache = encoding_cache
+    closed = use_closed_form(param, n_lists)
+    names = [name for name in ENCODING_PARAM + ('Afc', 'Sfc', 'Scf') if name in param]
+    values = np.stack([list_param(param, name, n_lists) for name in names], axis=1)
+    semantic = param.get('sem_mat') is not None and (
+        np.any(list_param(param, 'Sfc', n_lists) != 0) or
+        np.any(list_param(param, 'Scf', n_lists) != 0))
+    if semantic:
+        sem_mat = np.asarray(param['sem_mat'])
+        sem_key = hashlib.sha1(np.ascontiguousarray(sem_mat).view(np.uint8)).hexdigest()
+        values = np.concatenate([values, pres_itemnos.astype(float)], axis=1)
+    else:
+        sem_key = None
+    unique, first, inverse = np.unique(values, axis=0, return_index=True,
+                                       return_inverse=True)
+    inverse = inverse.reshape(-1)
+    struct = (layout['LL'], layout['n_units'], layout['ipi_units'] is not None,
+              layout['ri_unit'] is not None, tuple(names), sem_key, closed)
+    keys = [struct + (row.tobytes(),) for row in unique]
+    states = [cache.get(key) for key in keys]
+
+    missing = [k for k, state in enumerate(states) if state is None]
+    if missing:
+        rows = first[missing]
+        sub = {name: values[rows, n] for n, name in enumerate(names)}
+        sub_items = None
+        if semantic:
+            sub['sem_mat'] = sem_mat
+            sub_items = pres_itemnos[rows]
+        if closed:
+            computed = []
+            for m in range(len(rows)):
+                row_param = {name: sub[name][m] for name in names}
+                c, w_fc, w_cf = closed_form_encoding(row_param, layout)
+                if semantic:
+                    # semantic pre-experimental associations on w_cf
+                    LL = layout['LL']
+                    items = sub_items[m]
+                    w_cf[:LL, :LL] += sem_mat[np.ix_(items, items)] * row_param['Scf']
+                computed.append((c, w_fc, w_cf))
+        else:
+            c, w_fc, w_cf, w_cf_pre = init_network(sub, layout, len(rows), sub_items)
+            c, w_fc, w_cf = present_items(c, w_fc, w_cf, sub, layout)
+            w_cf = w_cf + w_cf_pre
+            computed = [(c[m], w_fc[m], w_cf[m]) for m in range(len(rows))]
+        for k, state in zip(missing, computed):
+            cache.put(keys[k], state)
+            states[k] = state
+    return states, inverse
+
+
+def encode_lists(param, layout, n_lists, pres_itemnos=None, cache=None):
+    # network state after the study period for a batch of lists:
+    # context, w_fc, and w_cf + w_cf_pre. if all lists share one state,
+    # the weights are read-only broadcast views
+    states, inverse = encode_groups(param, layout, n_lists, pres_itemnos, cache)
+    if len(states) == 1:
+        c, w_fc, w_cf = states[0]
+        n = w_fc.shape[0]
+        return (np.repeat(c[None, :], n_lists, axis=0),
+                np.broadcast_to(w_fc, (n_lists, n, n)),
+                np.broadcast_to(w_cf, (n_lists, n, n)))
+    c, w_fc, w_cf = [np.stack(parts) for parts in zip(*states)]
+    return c[inverse], w_fc[inverse], w_cf[inverse]
+
+
+@profiling.timed('stop')
+def p_stop(output_pos, param, LL, n_lists, event, p_min=PMIN):
+    # [lists] stop probability, as in p_stop_cmr.m ('op' rule)
+    if param['stop_rule'] != 'op':
+        raise ValueError(f"unknown stop_rule {param['stop_rule']!r}; "
+                         f'supported: {list(STOP_RULES)}')
+    X1 = event_param(param, 'X1', n_lists, event)
+    X2 = event_param(param, 'X2', n_lists, event)
+    p = np.clip(X1 * np.exp(X2 * output_pos), p_min, 1 - p_min)
+    return np.where(output_pos == LL, 1.0, p)
+
+
+@profiling.timed('recall')
+def p_recall(w_cf_all, c, recalled, output_pos, param, layout, event):
+    # [lists x LL+1] probability of each recall event, as in
+    # p_recall_cmr.m; the last column is the probability of stopping.
+    # w_cf_all: w_cf + w_cf_pre
+    # recalled: [lists x LL] boolean, items already recalled
+    n_lists = c.shape[0]
+    LL = layout['LL']
+    f_in = np.einsum('bij,bj->bi', w_cf_all[:, :LL, :], c)
+    f_in = np.where(f_in < AMIN, AMIN, f_in)
+
+    rule = param['sampling_rule']
+    if rule == 'power':
+        T = event_param(param, 'T', n_lists, event)
+        if 'ST' in param:
+            ST = event_param(param, 'ST', n_lists, event)
+            s = np.sum(np.where(recalled, 0, f_in), axis=1)
+            T = np.where(ST != 0, T * s ** ST, T)
+        strength = f_in ** T[:, None]
+    elif rule == 'classic':
+        T = event_param(param, 'T', n_lists, event)
+        strength = np.exp((2 * f_in) / T[:, None])
+    elif rule == 'logistic':
+        k = event_param(param, 'k', n_lists, event)
+        xz = event_param(param, 'xz', n_lists, event)
+        strength = 1 / (1 + np.exp(-1 * k[:, None] * (f_in - xz[:, None])))
+    else:
+        raise ValueError(f'unknown sampling_rule {rule!r}; '
+                         f'supported: {list(SAMPLING_RULES)}')
+
+    lat_inh = event_param(param, 'lat_inh', n_lists, event)
+    if np.any(lat_inh != 0):
+        max_str = np.max(strength, axis=1, keepdims=True)
+        trans = (strength / max_str) * lat_inh[:, None]
+        max_trans = np.max(trans, axis=1, keepdims=True)
+        inhib = max_str * (np.exp(trans) / np.exp(max_trans))
+        strength = np.where((lat_inh != 0)[:, None], inhib, strength)
+
+    # if strength is zero for everything, set equal support for everything
+    strength = np.where(np.sum(strength, axis=1, keepdims=True) == 0, 1.0, strength)
+
+    # set activation of previously recalled items to 0
+    strength = np.where(recalled, 0, strength)
+
+    p = np.empty((n_lists, LL + 1))
+    p[:, LL] = p_stop(output_pos, param, LL, n_lists, event)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        p_item = (1 - p[:, LL:]) * (strength / np.sum(strength, axis=1, keepdims=True))
+    # if stop probability is 1, recalling any item is impossible
+    p[:, :LL] = np.where(p[:, LL:] == 1, 0, p_item)
+    return p
+
+
+@profiling.timed('context')
+def reactivate_item(c, w_fc, unit, B_rec, index=None):
+    # reactivate recalled items and update context, as in
+    # reactivate_item_cmr.m. unit: [lists] recalled item units
+    # index: optional row of w_fc to use for each list
+    if index is None:
+        index = np.arange(c.shape[0])
+    c_in = normalize_rows(w_fc[index, :, unit])
+    rho = scale_context(np.einsum('ij,ij->i', c, c_in), B_rec)
+    return rho[:, None] * c + B_rec[:, None] * c_in
+
+
+@profiling.timed('context')
+def shift_context(c, unit, B):
+    # push an orthogonal unit (e.g. start-of-list context) into context
+    rho = scale_context(c[:, unit], B)
+    c_new = rho[:, None] * c
+    c_new[:, unit] += B
+    return c_new
+
+
+def likelihood_batch(param, recalls, LL, pres_itemnos=None):
+    # log likelihood for a batch of lists with the same length, as in
+    # cmr_general.m. param must already have defaults set (check_param).
+    # recalls: [lists x recalls] serial positions (1-indexed) of recalled
+    #   items, zero-padded on the right, repeats and intrusions removed
+    # returns [lists x recalls+1] log likelihood of each recall event
+    # and the stop event; padding is NaN
+    recalls = np.asarray(recalls, dtype=np.int64)
+    n_lists, max_rec = recalls.shape
+    rows = np.arange(n_lists)
+    n_rec = np.count_nonzero(recalls, axis=1)
+    # recall sequences with the stop event coded as LL + 1
+    seq = np.zeros((n_lists, max_rec + 1), dtype=np.int64)
+    seq[:, :max_rec] = recalls
+    seq[rows, n_rec] = LL + 1
+
+    layout = network_layout(param, LL)
+    c, w_fc, w_cf_all = encode_lists(param, layout, n_lists, pres_itemnos)
+
+    logl = np.full((n_lists, max_rec + 1), np.nan)
+    recalled = np.zeros((n_lists, LL), dtype=bool)
+    transient = bool(param.get('B_s_init_transient'))
+    for i in range(int(n_rec.max(initial=0)) + 1):
+        active = i <= n_rec
+        if 'B_s' in param:
+            # at end of list, assume some of start list context is
+            # pushed into context
+            if i == 0 and 'B_s_init' in param:
+                c_state = c
+                B_s = event_param(param, 'B_s_init', n_lists, i)
+            else:
+                B_s = event_param(param, 'B_s', n_lists, i)
+            use = event_param(param, 'B_s', n_lists, i) > 0
+            c = np.where(use[:, None], shift_context(c, layout['s_unit'], B_s), c)
+
+        # probability of all possible events
+        p = p_recall(w_cf_all, c, recalled, i, param, layout, i)
+        event = seq[:, i]
+        with np.errstate(divide='ignore'):
+            logl[:, i] = np.where(active, np.log(p[rows, np.maximum(event, 1) - 1]), np.nan)
+
+        # if you didn't actually recall the first item then context
+        # proceeds as if you hadn't folded start context into it
+        if i == 0 and transient and 'B_s' in param and 'B_s_init' in param:
+            c = np.where((event != 1)[:, None], c_state, c)
+
+        # reactivate the item and reinstate context
+        cont = i < n_rec
+        if not cont.any():
+            break
+        unit = np.where(cont, event - 1, 0)
+        B_rec = event_param(param, 'B_rec', n_lists, i)
+        c = np.where(cont[:, None], reactivate_item(c, w_fc, unit, B_rec), c)
+        recalled[rows[cont], unit[cont]] = True
+    return logl
+
+
+def varying_param(param, n_lists):
+    # names of the numeric parameters that differ between lists or
+    # between recall events
+    names = []
+    for name, value in param.items():
+        if name in OPTION_PARAM:
+            continue
+        value = np.asarray(value, dtype=float)
+        if value.ndim >= 1 and n_lists > 1 and np.any(value != value[:1]):
+            names.append(name)
+    return names
+
+
+def likelihood_trie(param, recalls, LL, pres_itemnos=None):
+    # same as likelihood_batch, but recall sequences are organized as a
+    # prefix trie and each distinct prefix is evaluated only once. a
+    # node at depth i is a set of lists with the same encoding state,
+    # the same first i recalls, and the same values of every parameter
+    # that varies across lists at events 0..i; all of its lists have the
+    # same context and recall probabilities at event i, so p_recall and
+    # the context update are done per node and the results scattered
+    # back to lists. the per-list log likelihood is identical to
+    # likelihood_batch; the saving grows with the number of lists that
+    # share starting recalls (e.g. many replicates of one parameter set)
+    recalls = np.asarray(recalls, dtype=np.int64)
+    n_lists, max_rec = recalls.shape
+    rows = np.arange(n_lists)
+    n_rec = np.count_nonzero(recalls, axis=1)
+    seq = np.zeros((n_lists, max_rec + 1), dtype=np.int64)
+    seq[:, :max_rec] = recalls
+    seq[rows, n_rec] = LL + 1
+
+    layout = network_layout(param, LL)
+    states, group = encode_groups(param, layout, n_lists, pres_itemnos)
+    c0, w_fc, w_cf_all = [np.stack(parts) for parts in zip(*states)]
+    varying = varying_param(param, n_lists)
+
+    logl = np.full((n_lists, max_rec + 1), np.nan)
+    transient = (bool(param.get('B_s_init_transient')) and 'B_s' in param
+                 and 'B_s_init' in param)
+    # node of each active list; at depth 0, nodes are keyed on encoding
+    # group and parameter values
+    active = rows
+    parent = group
+    item = np.zeros(n_lists, dtype=np.int64)
+    c_parent = c0
+    recalled_parent = np.zeros((len(states), LL), dtype=bool)
+    for i in range(int(n_rec.max(initial=0)) + 1):
+        key = np.column_stack([parent, item] +
+                              [event_param(param, name, n_lists, i)[active]
+                               for name in varying])
+        _, first, node = np.unique(key, axis=0, return_index=True,
+                                   return_inverse=True)
+        node = node.reshape(-1)
+        n_nodes = first.shape[0]
+        node_lists = active[first]
+        node_parent = parent[first]
+        node_group = group[node_lists]
+        node_param = take_lists(param, node_lists)
+
+        # context and recalled items of each node, from its parent
+        c = c_parent[node_parent]
+        recalled = recalled_parent[node_parent]
+        if i > 0:
+            unit = item[first] - 1
+            B_rec = event_param(parent_param, 'B_rec', len(c_parent), i - 1)[node_parent]
+            c = reactivate_item(c, w_fc, unit, B_rec, node_group)
+            recalled[np.arange(n_nodes), unit] = True
+
+        if 'B_s' in node_param:
+            if i == 0 and 'B_s_init' in node_param:
+                c_state = c
+                B_s = event_param(node_param, 'B_s_init', n_nodes, i)
+            else:
+                B_s = event_param(node_param, 'B_s', n_nodes, i)
+            use = event_param(node_param, 'B_s', n_nodes, i) > 0
+            c = np.where(use[:, None], shift_context(c, layout['s_unit'], B_s), c)
+
+        if len(states) == 1:
+            w_cf_nodes = np.broadcast_to(w_cf_all[0], (n_nodes,) + w_cf_all.shape[1:])
+        else:
+            w_cf_nodes = w_cf_all[node_group]
+        p = p_recall(w_cf_nodes, c, recalled, i, node_param, layout, i)
+        event = seq[active, i]
+        with np.errstate(divide='ignore'):
+            logl[active, i] = np.log(p[node, event - 1])
+
+        # lists that go on to another recall become children of this node
+        cont = i < n_rec[active]
+        if not cont.any():
+            break
+        if i == 0 and transient:
+            # context proceeds from the unshifted state unless the first
+            # item was recalled first
+            c_parent = np.concatenate([c, c_state])
+            recalled_parent = np.concatenate([recalled, recalled])
+            parent = np.where(event[cont] == 1, node[cont], node[cont] + n_nodes)
+            parent_param = take_lists(param, np.concatenate([node_lists, node_lists]))
+        else:
+            c_parent = c
+            recalled_parent = recalled
+            parent = node[cont]
+            parent_param = node_param
+        active = active[cont]
+        item = event[cont]
+    return logl
+
+
+@profiling.timed('prepare')
+def prepare_lists(data, recall_keys=None):
+    # convert free recall data in psifr/cymr format to list arrays.
+    # recall events are matched to study events in the same list by
+    # item; intrusions and repeats are removed, as the model can't make
+    # them. returns a dict with:
+    # subject, list: [lists] identifiers, in order of appearance
+    # list_length: [lists] number of study events
+    # pres_itemnos: [lists x max LL] item_index of study events, -1 pad
+    # recalls: [lists x max recalls] serial positions, 0 pad
+    # recall_keys: dict of [lists x max recalls] values of each key at
+    #   the (cleaned) recall events, NaN pad
+    # the dict is a PreparedData, so covariates can be swapped later
+    recall_keys = list(recall_keys or [])
+    trial_type = data['trial_type'].to_numpy()
+    study = data.loc[trial_type == 'study', ['subject', 'list', 'position', 'item', 'item_index']]
+    recall = data.loc[trial_type == 'recall', ['subject', 'list', 'position', 'item'] + recall_keys]
+
+    list_id = study.groupby(['subject', 'list'], sort=False, observed=True).ngroup().to_numpy()
+    n_lists = int(list_id.max(initial=-1)) + 1
+    first = np.unique(list_id, return_index=True)[1]
+    subject = study['subject'].to_numpy()[first]
+    list_num = study['list'].to_numpy()[first]
+    list_length = np.bincount(list_id, minlength=n_lists)
+    position = study['position'].to_numpy().astype(np.int64)
+
+    pres_itemnos = np.full((n_lists, int(list_length.max(initial=0))), -1, dtype=np.int64)
+    item_index = study['item_index'].to_numpy()
+    if not np.isnan(np.asarray(item_index, dtype=float)).any():
+        pres_itemnos[list_id, position - 1] = item_index.astype(np.int64)
+
+    # serial position of each recalled item, from the study event with
+    # the same item in the same list
+    keys = pd.DataFrame({'subject': study['subject'].to_numpy(),
+                         'list': study['list'].to_numpy(),
+                         'item': study['item'].to_numpy().astype(str),
+                         'list_id': list_id, 'input': position})
+    rec = pd.DataFrame({'subject': recall['subject'].to_numpy(),
+                        'list': recall['list'].to_numpy(),
+                        'item': recall['item'].to_numpy().astype(str),
+                        'output': recall['position'].to_numpy().astype(np.int64),
+                        'event': np.arange(len(recall))})
+    for key in recall_keys:
+        rec[key] = recall[key].to_numpy()
+    rec = rec.merge(keys, on=['subject', 'list', 'item'], how='inner', sort=False)
+    rec = rec.sort_values(['list_id', 'output'], kind='stable')
+    rec = rec[~rec.duplicated(['list_id', 'input'])]
+
+    rec_list = rec['list_id'].to_numpy()
+    out_ind = rec.groupby('list_id', sort=False).cumcount().to_numpy()
+    n_rec = np.bincount(rec_list, minlength=n_lists)
+    recalls = np.zeros((n_lists, int(n_rec.max(initial=0))), dtype=np.int64)
+    recalls[rec_list, out_ind] = rec['input'].to_numpy()
+    covariates = {}
+    for key in recall_keys:
+        values = np.full(recalls.shape, np.nan)
+        values[rec_list, out_ind] = rec[key].to_numpy(dtype=float)
+        covariates[key] = values
+    lists = {'subject': subject, 'list': list_num, 'list_length': list_length,
+             'pres_itemnos': pres_itemnos, 'recalls': recalls,
+             'recall_keys': covariates}
+    events = pd.DataFrame({'subject': recall['subject'].to_numpy(),
+                           'list': recall['list'].to_numpy(),
+                           'position': recall['position'].to_numpy()})
+    event_values = {key: recall[key].to_numpy(dtype=float) for key in recall_keys}
+    return PreparedData(lists, events, (rec_list, out_ind, rec['event'].to_numpy()),
+                        event_values)
+
+
+class PreparedData(dict):
+    # prepared lists, plus what is needed to swap a recall covariate
+    # without preparing the data again. a covariate can be replaced (e.g.
+    # scrambled, or mixed with noise) with with_covariate, which shares
+    # every other array with the original. works anywhere prepared lists
+    # do, and likelihood (and Model.likelihood) accept it in place of a
+    # DataFrame.
+    # events: subject, list and position of each recall event of the
+    #   data (including intrusions and repeats), in data order
+    # event_index: list index, output index and event number of each
+    #   recall event that is kept in the recalls matrix
+    # event_values: dict of [events] values of each recall key
+
+    def __init__(self, lists, events, event_index, event_values):
+        super().__init__(lists)
+        self.events = events
+        self.event_index = event_index
+        self.event_values = event_values
+        self._hash = None
+
+    @property
+    def n_events(self):
+        return len(self.events)
+
+    def with_covariate(self, key, values):
+        # copy with the recall key set to values (one per recall event,
+        # in data order)
+        values = np.asarray(values, dtype=float)
+        if values.shape != (self.n_events,):
+            raise ValueError('values must have one entry per recall event')
+        rows, cols, event = self.event_index
+        matrix = np.full(self['recalls'].shape, np.nan)
+        matrix[rows, cols] = values[event]
+        out = PreparedData(self, self.events, self.event_index,
+                           {**self.event_values, key: values})
+        out['recall_keys'] = {**self['recall_keys'], key: matrix}
+        return out
+
+    def content_hash(self):
+        # hash of the arrays used by the likelihood (caching.data_hash
+        # uses it for prepared data)
+        if self._hash is None:
+            h = hashlib.sha1()
+            for name in ('subject', 'list', 'list_length', 'pres_itemnos', 'recalls'):
+                value = np.asarray(self[name])
+                h.update(name.encode() + str(value.shape).encode())
+                h.update(value.astype(str).tobytes() if value.dtype == object else value.tobytes())
+            for key, value in sorted(self['recall_keys'].items()):
+                h.update(key.encode() + value.tobytes())
+            self._hash = h.hexdigest()
+        return self._hash
+
+
+def as_lists(data, recall_keys=None):
+    # prepared lists for free recall data, or the data themselves if
+    # they are already prepared. data on disk (list_store.ListStore, or
+    # a view of one) are read from the store
+    if hasattr(data, 'prepared'):
+        data = data.prepared()
+    if isinstance(data, dict):
+        missing = set(recall_keys or []) - set(data['recall_keys'])
+        if missing:
+            raise ValueError(f'prepared data do not have recall keys: {sorted(missing)}')
+        return data
+    return prepare_lists(data, recall_keys)
+
+
+def select_lists(lists, index):
+    # prepared lists for a subset of lists (index: positions or mask)
+    out = {name: value[index] for name, value in lists.items()
+           if name != 'recall_keys'}
+    out['recall_keys'] = {key: values[index]
+                          for key, values in lists['recall_keys'].items()}
+    return out
+
+
+def tile_lists(lists, n_copies):
+    # n_copies of prepared lists stacked end to end, with the subject of
+    # copy i set to i (so each copy can get its own parameters)
+    n_lists = lists['subject'].shape[0]
+    out = {name: np.concatenate([value] * n_copies)
+           for name, value in lists.items() if name != 'recall_keys'}
+    out['subject'] = np.repeat(np.arange(n_copies), n_lists)
+    out['recall_keys'] = {key: np.concatenate([values] * n_copies)
+                          for key, values in lists['recall_keys'].items()}
+    return out
+
+
+# numpy functions and constants available in dynamic parameter
+# expressions, besides the parameters and recall keys
+EXPR_NAMESPACE = {k: v for k, v in vars(np).items()
+                  if not k.startswith('_') and (callable(v) or isinstance(v, float))}
+
+# syntax allowed in dynamic parameter expressions: arithmetic,
+# comparisons, constants, names, and calls to numpy functions
+EXPR_NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Compare, ast.Call,
+              ast.Name, ast.Constant, ast.keyword, ast.Tuple, ast.List,
+              ast.expr_context, ast.operator, ast.unaryop, ast.cmpop)
+
+
+@functools.lru_cache(maxsize=None)
+def compile_expression(expr, variables):
+    # parse a dynamic parameter expression (e.g.
+    # 'clip(B_rec + hcmp * neural_scaling, 0, 1)') once into a vectorized
+    # function. variables: sorted tuple of the parameter and recall key
+    # names that can be used; these take precedence over numpy names.
+    # returns the function and the names of its arguments, in order.
+    # compiled functions are cached on the expression and variables, so
+    # repeated likelihood calls (fits, sweeps) skip parsing entirely
+    tree = ast.parse(expr, mode='eval')
+    args = []
+    for node in ast.walk(tree):
+        if not isinstance(node, EXPR_NODES):
+            raise ValueError(f'unsupported syntax in dynamic parameter: {expr}')
+        if isinstance(node, ast.Call) and not (
+                isinstance(node.func, ast.Name) and node.func.id not in variables
+                and node.func.id in EXPR_NAMESPACE):
+            raise ValueError(f'only numpy functions can be called in: {expr}')
+        if isinstance(node, ast.Name):
+            if node.id in variables:
+                if node.id not in args:
+                    args.append(node.id)
+            elif node.id not in EXPR_NAMESPACE:
+                raise ValueError(f'unknown name {node.id} in dynamic parameter: {expr}')
+    source = f'lambda {", ".join(args)}: {expr}'
+    func = eval(compile(source, '<dynamic>', 'eval'), dict(EXPR_NAMESPACE))
+    return func, tuple(args)
+
+
+@functools.lru_cache(maxsize=None)
+def expression_names(expr):
+    # names used in a dependent or dynamic parameter expression
+    return frozenset(node.id for node in ast.walk(ast.parse(expr, mode='eval'))
+                     if isinstance(node, ast.Name))
+
+
+def eval_dependent(param, dependent):
+    # param with dependent parameters set from expressions of the other
+    # parameters, in order, as cymr's Parameters.eval_dependent. values
+    # can be scalars or per-list arrays
+    param = dict(param)
+    for name, expr in (dependent or {}).items():
+        names = tuple(sorted(n for n in param if n not in OPTION_PARAM))
+        func, args = compile_expression(expr, names)
+        value = np.asarray(func(*[np.asarray(param[arg], dtype=float) for arg in args]),
+                           dtype=float)
+        param[name] = float(value) if value.ndim == 0 else value
+    return param
+
+
+@profiling.timed('expand')
+def expand_param(lists, param, subj_param=None, dynamic=None, dependent=None):
+    # per-list parameter arrays for prepared lists.
+    # param: dict of parameter values for all subjects
+    # subj_param: optional dict of {subject: dict of values}
+    # dynamic: optional dict of {param name: expression} evaluated on the
+    #   recall keys, e.g. {'B_rec': 'clip(B_rec + hcmp * neural_scaling, 0, 1)'}
+    #   giving [lists x recall events] values for all events in one
+    #   vectorized call (see compile_expression); events without a value
+    #   (padding and the stop event) keep the list value
+    # dependent: optional dict of {param name: expression} of the other
+    #   parameters (see eval_dependent), set per list before dynamic
+    #   parameters
+    n_lists = lists['subject'].shape[0]
+    if subj_param:
+        names = set(param).union(*[set(p) for p in subj_param.values()])
+    else:
+        names = set(param)
+    full = {}
+    for name in names:
+        if name in OPTION_PARAM:
+            full[name] = param[name]
+            continue
+        if subj_param and any(name in p for p in subj_param.values()):
+            lookup = {s: p.get(name, param.get(name, np.nan))
+                      for s, p in subj_param.items()}
+            values = pd.Series(lists['subject']).map(lookup).to_numpy(dtype=float)
+            if name in param:
+                values = np.where(np.isnan(values), param[name], values)
+            full[name] = values
+        else:
+            full[name] = param[name]
+    if dependent:
+        full = eval_dependent(full, dependent)
+    exprs = list((dependent or {}).values()) + list((dynamic or {}).values())
+    full = check_param(full, set().union(*map(expression_names, exprs)))
+
+    if dynamic:
+        n_events = lists['recalls'].shape[1] + 1
+        variables = {name: np.broadcast_to(np.asarray(value, dtype=float), (n_lists,))[:, None]
+                     for name, value in full.items() if name not in OPTION_PARAM}
+        variables.update(lists['recall_keys'])
+        names = tuple(sorted(variables))
+        with profiling.phase('dynamic'):
+            for name, expr in dynamic.items():
+                func, args = compile_expression(expr, names)
+                with np.errstate(invalid='ignore'):
+                    values = np.asarray(func(*[variables[arg] for arg in args]), dtype=float)
+                base = np.broadcast_to(np.asarray(full[name], dtype=float), (n_lists,))
+                events = np.repeat(base[:, None], n_events, axis=1)
+                values = np.broadcast_to(values, (n_lists, n_events - 1))
+                events[:, :-1] = np.where(np.isnan(values), base[:, None], values)
+                full[name] = events
+    return full
+
+
+def take_lists(param, index):
+    # parameters for a subset of lists
+    out = {}
+    for name, value in param.items():
+        arr = np.asarray(value) if name not in OPTION_PARAM else None
+        if arr is not None and arr.ndim >= 1 and arr.dtype != object:
+            out[name] = arr[index]
+        else:
+            out[name] = value
+    return out
+
+
+@profiling.timed('likelihood', memory=True)
+def likelihood_lists(lists, param, batch_size=1000, method='batch'):
+    # [lists x recalls+1] log likelihood for prepared lists and expanded
+    # parameters. lists with the same length are stacked into batches of
+    # at most batch_size lists
+    # method: 'batch' evaluates every list at every event; 'trie'
+    #   evaluates each distinct recall prefix once (likelihood_trie)
+    if method == 'batch':
+        evaluate = likelihood_batch
+    elif method == 'trie':
+        evaluate = likelihood_trie
+    else:
+        raise ValueError(f'unknown method: {method}')
+    n_lists, max_rec = lists['recalls'].shape
+    logl = np.full((n_lists, max_rec + 1), np.nan)
+    for LL in np.unique(lists['list_length']):
+        group = np.flatnonzero(lists['list_length'] == LL)
+        for start in range(0, group.shape[0], batch_size):
+            index = group[start:start + batch_size]
+            logl[index] = evaluate(
+                take_lists(param, index), lists['recalls'][index], int(LL),
+                lists['pres_itemnos'][index, :LL])
+    return logl
+
+
+def likelihood(data, param, subj_param=None, recall_keys=None, dynamic=None,
+               batch_size=1000, method='batch', dependent=None):
+    # log likelihood for each subject, in the format of cymr's
+    # likelihood: a DataFrame indexed by subject with logl and n (the
+    # number of recall and stop events)
+    # data: DataFrame, data prepared with prepare_lists, or a
+    #   list_store.ListStore (covariates are then taken from the prepared
+    #   data)
+    if dynamic and recall_keys is None and isinstance(data, pd.DataFrame):
+        raise ValueError('recall_keys are needed to evaluate dynamic parameters')
+    lists = as_lists(data, recall_keys)
+    full = expand_param(lists, param, subj_param, dynamic, dependent)
+    logl = likelihood_lists(lists, full, batch_size, method)
+    return subject_totals(lists, logl)
+
+
+@profiling.timed('totals')
+def subject_totals(lists, logl):
+    # sum a [lists x events] log likelihood matrix by subject
+    totals = pd.DataFrame({'subject': lists['subject'],
+                           'logl': np.nansum(logl, axis=1),
+                           'n': np.count_nonzero(~np.isnan(logl), axis=1)})
+    totals = totals.groupby('subject', sort=False).sum()
+    return totals
+
+
+class Model:
+    # the engine with the likelihood interface of a cymr model, so it
+    # can be used in place of cmr.CMR by sweep.likelihood_sweep and
+    # permutation.permutation_test, with either a DataFrame or prepared
+    # data. dependent and dynamic recall parameters come from param_def.
+    # items are localist, with item weights Dfc and Dcf (as with cymr
+    # weights 'Dfc * loc' and 'Dcf * loc'), so patterns are not used;
+    # semantic associations are set with the sem_mat parameter. cymr
+    # parameters without a counterpart here (B_start, w_loc, Aff, Dff,
+    # Lfc, Lcf) must be at their no-op values (NOOP_PARAM), and any other
+    # name the engine does not use raises a ValueError (check_param)
+
+    def __init__(self, method='batch', batch_size=1000):
+        self.method = method
+        self.batch_size = batch_size
+
+    def likelihood(self, data, group_param, subj_param=None, param_def=None,
+                   patterns=None, study_keys=None, recall_keys=None):
+        dynamic = dependent = None
+        if param_def is not None:
+            dynamic = getattr(param_def, 'dynamic', {}).get('recall') or None
+            dependent = getattr(param_def, 'dependent', None) or None
+        return likelihood(data, group_param, subj_param, recall_keys, dynamic,
+                          self.batch_size, self.method, dependent)
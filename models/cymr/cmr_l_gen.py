@@ -0,0 +1,301 @@
+import numpy as np
+import pandas as pd
+
+import cmr_l
+
+try:
+    from numba import njit
+    HAVE_NUMBA = True
+except ImportError:
+    njit = None
+    HAVE_NUMBA = False
+
+# constants of the recall rule, as plain globals for the kernel
+AMIN = cmr_l.AMIN
+PMIN = cmr_l.PMIN
+
+# generation of recall sequences with the cmr_l model (localist CMR),
+# for many lists per call. encoding uses the engine's cached (closed
+# form) study-period states; the recall loop, which is sequential within
+# a list (sample an event, check the stop rule, reinstate context,
+# suppress the recalled item), runs either in a compiled kernel (numba;
+# one list at a time, with no python overhead per recall) or, without
+# numba, vectorized over lists with the same functions the likelihood
+# uses. the kernel handles the standard model (classic sampling rule,
+# 'op' stop rule, no start-context shifts or lateral inhibition); other
+# parameter sets always use the vectorized path.
+#
+# both paths draw one uniform number per list and output position from
+# the same generator and use it the same way, so they give the same
+# sequences for a given seed (up to rounding in the cue strengths).
+# dynamic parameters (e.g. B_rec driven by 'hcmp') take the covariate
+# at each output position from the guiding data, as cymr's generate
+# does, so the guiding data should have a recall event for every
+# position (e.g. create_expt with dummy_recalls=True).
+
+
+def _recall_loop(c0, w_fc, w_cf, group, LL, T, X1, X2, B_rec, u, recalls):
+    # fill recalls ([lists x LL], zeros) with the serial positions of
+    # recalled items. c0, w_fc, w_cf: study-period states of each
+    # encoding group; group: [lists] group index; T, X1, X2, B_rec, u:
+    # [lists x LL + 1] parameters and uniform draws at each output.
+    # compiled with numba as _recall_kernel; run as plain python (engine
+    # 'python') it is only useful for checking the kernel
+    n_lists = group.shape[0]
+    n_units = c0.shape[1]
+    c = np.empty(n_units)
+    strength = np.empty(LL)
+    recalled = np.zeros(LL, dtype=np.bool_)
+    for n in range(n_lists):
+        g = group[n]
+        for k in range(n_units):
+            c[k] = c0[g, k]
+        for j in range(LL):
+            recalled[j] = False
+        for i in range(LL + 1):
+            if i == LL:
+                p_stop = 1.0
+            else:
+                p_stop = X1[n, i] * np.exp(X2[n, i] * i)
+                p_stop = min(max(p_stop, PMIN), 1 - PMIN)
+            if u[n, i] < p_stop:
+                break
+
+            # cue strengths of items not yet recalled
+            total = 0.0
+            for j in range(LL):
+                f_in = 0.0
+                for k in range(n_units):
+                    f_in += w_cf[g, j, k] * c[k]
+                if f_in < AMIN:
+                    f_in = AMIN
+                strength[j] = np.exp((2 * f_in) / T[n, i])
+                total += strength[j]
+            if total == 0:
+                for j in range(LL):
+                    strength[j] = 1.0
+            total = 0.0
+            for j in range(LL):
+                if recalled[j]:
+                    strength[j] = 0.0
+                total += strength[j]
+
+            # sample an item
+            target = u[n, i] - p_stop
+            cum = 0.0
+            item = -1
+            for j in range(LL):
+                if strength[j] > 0:
+                    item = j
+                    cum += (1 - p_stop) * (strength[j] / total)
+                    if target < cum:
+                        break
+            recalls[n, i] = item + 1
+            recalled[item] = True
+
+            # reinstate the item's context
+            norm = 0.0
+            for k in range(n_units):
+                norm += w_fc[g, k, item] ** 2
+            norm = np.sqrt(norm)
+            cdot = 0.0
+            for k in range(n_units):
+                cdot += c[k] * w_fc[g, k, item] / norm
+            B = B_rec[n, i]
+            rho = np.sqrt(1 + B ** 2 * (cdot ** 2 - 1)) - (B * cdot)
+            for k in range(n_units):
+                c[k] = rho * c[k] + B * w_fc[g, k, item] / norm
+    return recalls
+
+
+# the compiled kernel, if numba is installed
+_recall_kernel = njit(cache=True)(_recall_loop) if HAVE_NUMBA else None
+
+
+def use_kernel(param):
+    # whether the compiled kernel handles these parameters
+    return (param['sampling_rule'] == 'classic' and param['stop_rule'] == 'op'
+            and 'B_s' not in param and 'ST' not in param
+            and np.all(np.asarray(param['lat_inh']) == 0))
+
+
+def event_matrix(param, name, n_lists, n_events):
+    # [lists x events] values of a parameter at each output position;
+    # positions past the last covariate value use the last column (the
+    # list value, for dynamic parameters)
+    value = np.asarray(param[name], dtype=float)
+    if value.ndim < 2:
+        return np.repeat(np.broadcast_to(value, (n_lists,))[:, None], n_events, axis=1)
+    if value.shape[1] >= n_events:
+        return np.ascontiguousarray(value[:, :n_events])
+    pad = np.repeat(value[:, -1:], n_events - value.shape[1], axis=1)
+    return np.concatenate([value, pad], axis=1)
+
+
+def recall_batch(param, LL, u, pres_itemnos=None, engine='auto'):
+    # [lists x LL] serial positions (1-indexed, zero pad) of recalls
+    # for a batch of lists with the same length.
+    # param: parameters with defaults set (check_param); recall
+    #   parameters can be [lists x events]
+    # u: [lists x LL + 1] uniform draws, one per output position
+    # engine: 'kernel' (compiled; requires numba), 'numpy', 'auto' (the
+    #   kernel if numba is installed and supports the parameters), or
+    #   'python' (the kernel's loop uncompiled, for testing; slow)
+    n_lists = u.shape[0]
+    if engine == 'auto':
+        engine = 'kernel' if HAVE_NUMBA and use_kernel(param) else 'numpy'
+    layout = cmr_l.network_layout(param, LL)
+    if engine in ('kernel', 'python'):
+        if engine == 'kernel' and not HAVE_NUMBA:
+            raise ValueError("engine 'kernel' requires numba; "
+                             "use engine='numpy' or 'auto' without it")
+        if not use_kernel(param):
+            raise ValueError('parameters are not supported by the kernel')
+        kernel = _recall_kernel if engine == 'kernel' else _recall_loop
+        states, group = cmr_l.encode_groups(param, layout, n_lists, pres_itemnos)
+        c0, w_fc, w_cf = [np.ascontiguousarray(np.stack(parts)) for parts in zip(*states)]
+        mats = [event_matrix(param, name, n_lists, LL + 1) for name in ('T', 'X1', 'X2', 'B_rec')]
+        recalls = np.zeros((n_lists, LL), dtype=np.int64)
+        return kernel(c0, w_fc, w_cf, group.astype(np.int64), LL, *mats,
+                      np.ascontiguousarray(u), recalls)
+    elif engine == 'numpy':
+        return _recall_numpy(param, layout, u, pres_itemnos)
+    raise ValueError(f'unknown engine: {engine}')
+
+
+def _recall_numpy(param, layout, u, pres_itemnos=None):
+    # the recall loop vectorized over lists, following likelihood_batch
+    LL = layout['LL']
+    n_lists = u.shape[0]
+    rows = np.arange(n_lists)
+    c, w_fc, w_cf_all = cmr_l.encode_lists(param, layout, n_lists, pres_itemnos)
+    recalls = np.zeros((n_lists, LL), dtype=np.int64)
+    recalled = np.zeros((n_lists, LL), dtype=bool)
+    active = np.ones(n_lists, dtype=bool)
+    transient = bool(param.get('B_s_init_transient'))
+    for i in range(LL + 1):
+        if 'B_s' in param:
+            if i == 0 and 'B_s_init' in param:
+                c_state = c
+                B_s = cmr_l.event_param(param, 'B_s_init', n_lists, i)
+            else:
+                B_s = cmr_l.event_param(param, 'B_s', n_lists, i)
+            use = cmr_l.event_param(param, 'B_s', n_lists, i) > 0
+            c = np.where(use[:, None], cmr_l.shift_context(c, layout['s_unit'], B_s), c)
+
+        p = cmr_l.p_recall(w_cf_all, c, recalled, i, param, layout, i)
+        p_stop = p[:, LL]
+        active &= ~(u[:, i] < p_stop)
+        target = u[:, i] - p_stop
+        cum = np.cumsum(p[:, :LL], axis=1)
+        # first item whose cumulative probability passes the draw; if
+        # rounding leaves the draw past the end, the last possible item
+        item = np.argmax(target[:, None] < cum, axis=1)
+        past = ~np.any(target[:, None] < cum, axis=1)
+        last = LL - 1 - np.argmax(p[:, LL - 1::-1] > 0, axis=1)
+        item = np.where(past, last, item)
+
+        if i == 0 and transient and 'B_s' in param and 'B_s_init' in param:
+            c = np.where(((item + 1 != 1) | ~active)[:, None], c_state, c)
+        if not active.any():
+            break
+        recalls[rows[active], i] = item[active] + 1
+        recalled[rows[active], item[active]] = True
+        B_rec = cmr_l.event_param(param, 'B_rec', n_lists, i)
+        unit = np.where(active, item, 0)
+        c = np.where(active[:, None], cmr_l.reactivate_item(c, w_fc, unit, B_rec), c)
+    return recalls
+
+
+def recall_lists(lists, param, rng=None, engine='auto', batch_size=1000):
+    # [lists x max LL] simulated recalls (serial positions, zero pad) for
+    # prepared lists (cmr_l.prepare_lists) and expanded parameters
+    # (cmr_l.expand_param). lists with the same length are simulated in
+    # batches of at most batch_size lists.
+    # rng: seed or np.random.Generator
+    rng = np.random.default_rng(rng)
+    n_lists = lists['list_length'].shape[0]
+    max_len = int(lists['list_length'].max(initial=0))
+    u = rng.random((n_lists, max_len + 1))
+    recalls = np.zeros((n_lists, max_len), dtype=np.int64)
+    for LL in np.unique(lists['list_length']):
+        LL = int(LL)
+        group = np.flatnonzero(lists['list_length'] == LL)
+        for start in range(0, group.shape[0], batch_size):
+            index = group[start:start + batch_size]
+            recalls[index, :LL] = recall_batch(
+                cmr_l.take_lists(param, index), LL, u[index, :LL + 1],
+                lists['pres_itemnos'][index, :LL], engine)
+    return recalls
+
+
+def generate(data, param, subj_param=None, dynamic=None, recall_keys=None,
+             n_rep=1, seed=None, engine='auto', rep_key='rep'):
+    # simulate free recall for the study lists in data, in the format of
+    # generation.generate: study events of each list followed by the
+    # simulated recall events, lists of replicate i numbered
+    # i * max_list + list (within subject), a rep_key column, and
+    # recall_keys values copied from the guiding recall events at the
+    # same output position.
+    # data: free recall data (cymr format), e.g. from create_expt
+    # param, subj_param, dynamic: as for cmr_l.likelihood
+    # recall_keys: covariates of the guiding recall events (used by
+    #   dynamic parameters)
+    # seed: int, SeedSequence or None
+    # engine: see recall_batch
+    recall_keys = list(recall_keys or [])
+    lists = cmr_l.prepare_lists(data, recall_keys)
+    full = cmr_l.expand_param(lists, param, subj_param, dynamic)
+    n_lists = lists['subject'].shape[0]
+    index = np.tile(np.arange(n_lists), n_rep)
+    rep = np.repeat(np.arange(n_rep), n_lists)
+    rep_lists = cmr_l.select_lists(lists, index)
+    recalls = recall_lists(rep_lists, cmr_l.take_lists(full, index), seed, engine)
+
+    # study events of each list, in list order
+    study = data.loc[(data['trial_type'] == 'study').to_numpy()]
+    list_id = study.groupby(['subject', 'list'], sort=False, observed=True).ngroup().to_numpy()
+    subject = lists['subject']
+    max_list = pd.Series(lists['list']).groupby(subject).transform('max').to_numpy()
+    list_num = rep * max_list[index] + lists['list'][index]
+
+    order = np.argsort(list_id, kind='stable')
+    starts = np.searchsorted(list_id[order], np.arange(n_lists))
+    counts = lists['list_length']
+    study_rows = order[np.concatenate([np.arange(s, s + c) for s, c in zip(starts[index], counts[index])])]
+    study_list = np.repeat(np.arange(index.shape[0]), counts[index])
+    study_frame = study.iloc[study_rows].reset_index(drop=True)
+    study_frame['list'] = list_num[study_list].astype(study['list'].dtype)
+
+    # recall events: item of each recalled position from the study
+    # events of its list
+    rec_list, rec_out = np.nonzero(recalls)
+    first = np.concatenate([[0], np.cumsum(counts[index])[:-1]])
+    rec_rows = first[rec_list] + recalls[rec_list, rec_out] - 1
+    rec_frame = study_frame.iloc[rec_rows].reset_index(drop=True)
+    rec_frame['trial_type'] = 'recall'
+    rec_frame['position'] = (rec_out + 1).astype(study['position'].dtype)
+    for key in recall_keys:
+        values = rep_lists['recall_keys'][key]
+        if values.shape[1] > 0:
+            rec_frame[key] = values[rec_list, np.minimum(rec_out, values.shape[1] - 1)]
+            rec_frame.loc[rec_out >= values.shape[1], key] = np.nan
+        else:
+            rec_frame[key] = np.nan
+    study_frame[rep_key] = rep[study_list].astype(np.int32)
+    rec_frame[rep_key] = rep[rec_list].astype(np.int32)
+
+    study_frame['_order'] = study_list
+    rec_frame['_order'] = rec_list
+    study_frame['_phase'] = 0
+    rec_frame['_phase'] = 1
+    sim = pd.concat([study_frame, rec_frame], ignore_index=True)
+    if isinstance(data['trial_type'].dtype, pd.CategoricalDtype):
+        sim['trial_type'] = pd.Categorical(sim['trial_type'],
+                                           categories=data['trial_type'].cat.categories)
+    # lists in subject order, then replicate, as in generation.generate
+    subj_order = pd.factorize(subject)[0][index]
+    sim['_subj'] = subj_order[sim['_order'].to_numpy()]
+    sim['_rep'] = rep[sim['_order'].to_numpy()]
+    sim = sim.sort_values(['_subj', '_rep', '_order', '_phase', 'position'], kind='stable')
+    return sim.drop(columns=['_order', '_phase', '_subj', '_rep']).reset_index(drop=True)
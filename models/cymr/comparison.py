@@ -0,0 +1,131 @@
+import numpy as np
+import pandas as pd
+
+# model comparison with information criteria, vectorized over any number
+# of model variants. logl, n (number of recall and stop events) and k
+# (number of free parameters) are arrays of any shape that broadcast
+# against each other, e.g. the [B_rec x neural_scaling] grid of a sweep
+# with a scalar n and k. frames from sweep.likelihood_sweep and from
+# fitting (fit_indiv, fit_group, fit_nested) have logl and n columns (and
+# k, for fits), and can be passed to criteria and compare directly.
+
+CRITERIA = ('aic', 'aicc', 'bic')
+
+
+def aic(logl, k):
+    # Akaike information criterion
+    return -2 * np.asarray(logl, dtype=float) + 2 * np.asarray(k, dtype=float)
+
+
+def aicc(logl, n, k):
+    # AIC with correction for finite samples; inf where n <= k + 1
+    n = np.asarray(n, dtype=float)
+    k = np.asarray(k, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        correction = np.where(n - k - 1 > 0, 2 * k * (k + 1) / (n - k - 1), np.inf)
+    return aic(logl, k) + correction
+
+
+def bic(logl, n, k):
+    # Bayesian information criterion
+    n = np.asarray(n, dtype=float)
+    k = np.asarray(k, dtype=float)
+    return -2 * np.asarray(logl, dtype=float) + k * np.log(n)
+
+
+def akaike_weights(ic, axis=None):
+    # relative likelihood of each model, exp(-delta / 2) normalized to
+    # sum to one, from an array of AIC, AICc or BIC values. weights are
+    # taken over axis (default: all models in the array); models with a
+    # NaN or infinite criterion get zero weight
+    ic = np.asarray(ic, dtype=float)
+    finite = np.isfinite(ic)
+    best = np.min(np.where(finite, ic, np.inf), axis=axis, keepdims=True)
+    with np.errstate(invalid='ignore'):
+        rel = np.where(finite, np.exp(-0.5 * (ic - best)), 0.0)
+        return rel / np.sum(rel, axis=axis, keepdims=True)
+
+
+def criteria(results, k=None, n=None):
+    # copy of a results frame with aic, aicc and bic columns.
+    # results: frame with logl and n columns, and k unless given
+    # k, n: number of free parameters and of data points, overriding the
+    #   columns (scalar or one value per row)
+    results = results.copy()
+    if k is not None:
+        results['k'] = k
+    if n is not None:
+        results['n'] = n
+    if 'k' not in results:
+        raise ValueError('number of free parameters (k) must be specified')
+    logl = results['logl'].to_numpy(dtype=float)
+    n = results['n'].to_numpy(dtype=float)
+    k = results['k'].to_numpy(dtype=float)
+    results['aic'] = aic(logl, k)
+    results['aicc'] = aicc(logl, n, k)
+    results['bic'] = bic(logl, n, k)
+    return results
+
+
+def total(results, by=None):
+    # sum logl, n and k over the rows of a results frame, e.g. the
+    # subjects of a fit (each subject has its own k parameters). by:
+    # optional column(s) to total within
+    results = _with_columns(results)
+    columns = ['logl', 'n', 'k']
+    if by is None:
+        return results[columns].sum().to_frame().T.astype({'n': int, 'k': int})
+    return results.groupby(by, sort=False)[columns].sum().reset_index()
+
+
+def compare(models, k=None, criterion='aicc', by=None):
+    # compare a set of models, each a results frame with one row per
+    # variant (e.g. a sweep result, or fit results after total). the
+    # best variant of each model (lowest criterion) is compared with
+    # the others.
+    # models: dict of {model name: results frame}
+    # k: number of free parameters, as a dict of {model name: k} or one
+    #   value for all models (default: the k column of each frame)
+    # by: optional column(s) (e.g. 'subject', with sweep results from
+    #   by_subject=True or fits indexed by subject) to compare within;
+    #   weights then sum to one for each group
+    # returns a frame with one row per model (and group), with the
+    # columns of the best variant, aic, aicc and bic, and the Akaike
+    # weight of each criterion (w_aic, w_aicc, w_bic)
+    frames = []
+    for name, results in models.items():
+        model_k = k.get(name) if isinstance(k, dict) else k
+        results = criteria(_with_columns(results), model_k)
+        if by is None:
+            best = results.loc[[results[criterion].idxmin()]]
+        else:
+            best = results.loc[results.groupby(by, sort=False)[criterion].idxmin()]
+        best.insert(0, 'model', name)
+        frames.append(best)
+    table = pd.concat(frames, ignore_index=True)
+    for name in CRITERIA:
+        values = table[name].to_numpy(dtype=float)
+        if by is None:
+            table['w_' + name] = akaike_weights(values)
+        else:
+            group = table.groupby(by, sort=False).ngroup().to_numpy()
+            table['w_' + name] = _group_weights(values, group)
+    return table
+
+
+def _with_columns(results):
+    # move a named index (e.g. subject, for fit results) into the columns
+    if results.index.name is not None:
+        return results.reset_index()
+    return results.reset_index(drop=True)
+
+
+def _group_weights(ic, group):
+    # akaike_weights within each group label
+    finite = np.isfinite(ic)
+    n_groups = int(group.max(initial=-1)) + 1
+    best = np.full(n_groups, np.inf)
+    np.minimum.at(best, group[finite], ic[finite])
+    with np.errstate(invalid='ignore'):
+        rel = np.where(finite, np.exp(-0.5 * (ic - best[group])), 0.0)
+    return rel / np.bincount(group, weights=rel, minlength=n_groups)[group]
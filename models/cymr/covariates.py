@@ -0,0 +1,74 @@
+import numpy as np
+import pandas as pd
+
+# carrying recall-event covariates (e.g. a neural signal like 'hcmp')
+# from the frame that guided a simulation onto the simulated output.
+# a recall event is identified by subject, list and output position.
+# cymr's generate numbers the lists of replicate i as
+# i * max_list + list, so simulated list numbers are folded back onto
+# the original lists (per subject) and the replicate index falls out.
+
+
+def match_recall_events(orig_df, new_df):
+    # returns three arrays:
+    # new_rows: row positions of recall events in new_df that have a
+    #   matching recall event in orig_df
+    # orig_rows: the matching row positions in orig_df
+    # rep: replicate index for every row of new_df
+    # the match is computed once, so covariates can be copied (or
+    # shuffled and copied) repeatedly with plain array indexing
+    # with list numbers from 0, list 0 of replicate i + 1 and the last
+    # list of replicate i would get the same number, so the fold needs
+    # lists numbered from 1
+    if len(orig_df) and orig_df['list'].min() < 1:
+        raise ValueError('list numbers must start at 1 to identify replicates')
+    max_list = orig_df.groupby('subject', observed=True)['list'].max()
+    new_max = new_df['subject'].map(max_list).to_numpy()
+    if np.isnan(new_max.astype(float)).any():
+        raise ValueError('new_df has subjects that are not in orig_df')
+    new_list = new_df['list'].to_numpy().astype(np.int64)
+    rep = (new_list - 1) // new_max.astype(np.int64)
+    src_list = new_list - rep * new_max.astype(np.int64)
+
+    orig_mask = (orig_df['trial_type'] == 'recall').to_numpy()
+    new_mask = (new_df['trial_type'] == 'recall').to_numpy()
+    orig_keys = pd.DataFrame({
+        'subject': orig_df['subject'].to_numpy()[orig_mask],
+        'list': orig_df['list'].to_numpy()[orig_mask].astype(np.int64),
+        'position': orig_df['position'].to_numpy()[orig_mask].astype(np.int64),
+        'orig_row': np.flatnonzero(orig_mask),
+    })
+    new_keys = pd.DataFrame({
+        'subject': new_df['subject'].to_numpy()[new_mask],
+        'list': src_list[new_mask],
+        'position': new_df['position'].to_numpy()[new_mask].astype(np.int64),
+        'new_row': np.flatnonzero(new_mask),
+    })
+    matched = new_keys.merge(orig_keys, on=['subject', 'list', 'position'],
+                             how='inner', validate='many_to_one')
+    return (matched['new_row'].to_numpy(), matched['orig_row'].to_numpy(),
+            rep)
+
+
+def carry_recall_keys(orig_df, new_df, keys, rep_key=None, match=None):
+    # copy the recall_keys columns in keys from orig_df onto the matching
+    # recall events of new_df. rows without a match are left as they
+    # were (NaN if the column is new). if rep_key is given, the
+    # replicate index is also stored in that column.
+    # match: output of match_recall_events, to skip recomputing it
+    if isinstance(keys, str):
+        keys = [keys]
+    if match is None:
+        match = match_recall_events(orig_df, new_df)
+    new_rows, orig_rows, rep = match
+    for key in keys:
+        values = orig_df[key].to_numpy()
+        if key in new_df.columns:
+            column = new_df[key].to_numpy(copy=True)
+        else:
+            column = np.full(len(new_df), np.nan, dtype=np.result_type(values.dtype, float))
+        column[new_rows] = values[orig_rows]
+        new_df[key] = column
+    if rep_key is not None:
+        new_df[rep_key] = rep.astype(np.int32)
+    return new_df
@@ -8,6 +8,8 @@ from cymr import parameters
 from cymr import network
 
 import synth_data_convenience as sdc
+import cmr_l
+import fitting
 
 param_def = parameters.Parameters()
 
@@ -30,6 +32,9 @@ param_def.fixed = {'B_enc': 0.7, 'B_rec': 0.5,
 
 param_def.weights = {'fcf': {'loc': 'w_loc'}}
 
+# cymr draws from numpy's global generator; seed it so the simulated data
+# (and so the fit cache keys below) are the same on every run
+np.random.seed(42)
 sim_data = model.generate(synth_study, param_def, patterns=patterns, weights=param_def.weights)
 
 sim_merged = fr.merge_free_recall(sim_data)
@@ -39,14 +44,31 @@ rec_pos = fr.spc(sim_merged)
 #plt.savefig('temp_spc.pdf')
 
 
-param_def.add_free(B_enc=(0, 1))
-
-
-#                  'P1': (0, 15), 'P2': (0, 3),
-#                  'T': (0.01, 0.5)}
-print('running fit 1: \nB_enc (0, 1)')
-results1 = model.fit_indiv(sim_data, param_def,
-                           patterns=patterns, n_jobs=2)
+# the fits use the cmr_l engine, which has no counterpart for the
+# cymr-only parameters above (w_loc, Dff, Aff, Lfc, Lcf, B_start). at
+# these values they leave the cymr model unchanged, so the generating
+# model is cmr_l with the remaining parameters, and those are what is fit
+cymr_only = [name for name in param_def.fixed if name in cmr_l.NOOP_PARAM]
+changed = [name for name in cymr_only
+           if param_def.fixed[name] != cmr_l.NOOP_PARAM[name]]
+if changed:
+    raise ValueError(f'{changed} have no cmr_l counterpart at these values')
+fit_def = parameters.Parameters()
+fit_def.fixed = {name: value for name, value in param_def.fixed.items()
+                 if name not in cymr_only}
+
+# fit a ladder of nested models: B_enc, then B_enc and B_rec, then P1 and
+# P2 as well. each stage starts from the per-subject estimates of the
+# stage before, and stages are cached on disk (keyed on the data and
+# parameter definitions, with a fixed seed for the starting points), so
+# rerunning the script only refits what changed
+stages = [{'B_enc': (0, 1)},
+          {'B_rec': (0, 1)},
+          {'P1': (0, 15), 'P2': (0, 3)}]
+print('running fits: \nB_enc (0, 1)\n+ B_rec (0, 1)\n+ P1 (0, 15), P2 (0, 3)')
+(results1, results2, results3), fit_cost = fitting.fit_nested(
+    sim_data, fit_def, stages, n_jobs=2, rng=1, cache='fit_cache')
+print(fit_cost)
 
 # histogram of best-fit values of B_enc
 fig, ax = plt.subplots()
@@ -63,11 +85,6 @@ ax.axvline(x=param_def.fixed['B_enc'], color='b', linestyle='dashed', linewidth=
 fig.savefig('B_enc_hist_fit1.pdf')
 # print('hi')
 
-param_def.add_free(B_rec=(0, 1))
-print('running fit 2: \nB_enc (0, 1)\nB_rec (0, 1)')
-results2 = model.fit_indiv(sim_data, param_def,
-                           patterns=patterns, n_jobs=2)
-
 # scatterplot fitted values of B_enc and B_rec
 ax.cla()
 ax.scatter(results2['B_enc'], results2['B_rec'])
@@ -75,10 +92,5 @@ ax.plot(param_def.fixed['B_enc'], param_def.fixed['B_rec'],
         'ro')
 fig.savefig('B_scat_fit2.pdf')
 
-param_def.add_free(P1=(0, 15), P2=(0, 3))
-print('running fit 3: \nP1 (0, 15)\nP2 (0, 3)')
-results3 = model.fit_indiv(sim_data, param_def,
-                           patterns=patterns, n_jobs=2)
-
 
 print('hi')
@@ -7,10 +7,10 @@ import seaborn as sns
 
 from psifr import fr
 from cymr import models
-from cymr import network
 from cymr import cmr_lba
 
 import synth_data_convenience as sdc
+import lba
 
 patterns = sdc.create_patterns(20)
 n_subj = 20
@@ -34,11 +34,9 @@ tau = 0
 # v is vector of support for each item
 v = [1, 2, 5]
 
-resp = np.zeros((1000,), dtype=int)
-rt = np.zeros((1000,), dtype=float)
-
-for i in range(1000):
-    resp[i], rt[i] = network.sample_response_lba(A, b, v, s, tau)
+# 1000 draws at once; shared_start matches network.sample_response_lba
+resp, rt = lba.sample_response(A, b, v, s, tau, n=1000, shared_start=True,
+                               rng=np.random.default_rng(42))
 
 # fig, ax = plt.subplots()
 # ax.hist(rt,50)
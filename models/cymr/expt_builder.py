@@ -0,0 +1,111 @@
+import numpy as np
+import pandas as pd
+
+# array-based construction of synthetic study (and dummy recall) events.
+# the whole experiment is laid out with numpy index arithmetic and turned
+# into a single DataFrame at the end, so cost grows linearly with the
+# number of events instead of with repeated pd.concat calls.
+
+# random item orders are drawn in blocks of lists, so the temporary
+# random-key matrix stays at roughly this many elements
+_BLOCK_ELEMENTS = 2 ** 22
+
+
+def build_expt(patterns, n_subj, n_trials, list_len, dummy_recalls=False,
+               item_order='fixed', rng=None, subjects=None):
+    # patterns: dict with an 'items' array (as made by create_patterns)
+    # n_subj: number of subjects
+    # n_trials: lists per subject, an int or one value per subject
+    # list_len: items per list, an int or one value per subject
+    # dummy_recalls: if True, each list also gets one recall event per
+    #   study event, in serial order (used to hang neural signals on)
+    # item_order: 'fixed' presents items 0..list_len-1 in order on every
+    #   list (the original tutorial design), 'random' draws list_len
+    #   distinct items from the pool in random order for each list
+    # rng: seed or np.random.Generator, used when item_order is 'random'
+    # subjects: optional subject ids, default is 1..n_subj
+    if subjects is None:
+        subjects = np.arange(1, n_subj + 1)
+    subjects = np.asarray(subjects)
+    if subjects.shape[0] != n_subj:
+        raise ValueError('subjects must have n_subj entries')
+    trials = np.broadcast_to(np.asarray(n_trials, dtype=np.int64), (n_subj,))
+    lens = np.broadcast_to(np.asarray(list_len, dtype=np.int64), (n_subj,))
+
+    items = np.asarray(patterns['items'])
+    pool_size = items.shape[0]
+    if n_subj > 0 and lens.max() > pool_size:
+        raise ValueError(f'list length {lens.max()} exceeds pool size {pool_size}')
+
+    # one entry per list
+    n_lists = int(trials.sum())
+    list_subj = np.repeat(subjects, trials)
+    list_num = np.arange(n_lists) - np.repeat(np.cumsum(trials) - trials, trials) + 1
+    list_ll = np.repeat(lens, trials)
+
+    # one entry per study event
+    n_events = int(list_ll.sum())
+    event_list = np.repeat(np.arange(n_lists), list_ll)
+    position = np.arange(n_events) - np.repeat(np.cumsum(list_ll) - list_ll, list_ll)
+
+    if item_order == 'fixed':
+        item_index = position
+    elif item_order == 'random':
+        order = draw_item_orders(pool_size, n_lists, int(list_ll.max(initial=0)), rng)
+        item_index = order[event_list, position]
+    else:
+        raise ValueError(f'unknown item_order: {item_order}')
+
+    # event rows, in the order they appear in the frame
+    rows = np.arange(n_events)
+    trial_type = np.zeros(n_events, dtype=np.int8)
+    if dummy_recalls:
+        # each list is its study block followed by its recall block; a
+        # stable sort on list keeps study events (first half) in front
+        rows = np.concatenate([rows, rows])
+        trial_type = np.concatenate([trial_type, np.ones(n_events, dtype=np.int8)])
+        order = np.argsort(event_list[rows], kind='stable')
+        rows = rows[order]
+        trial_type = trial_type[order]
+
+    ev_list = event_list[rows]
+    ev_item = item_index[rows]
+    return pd.DataFrame({
+        'subject': list_subj[ev_list].astype(np.int32),
+        'list': list_num[ev_list].astype(np.int32),
+        'trial_type': pd.Categorical.from_codes(trial_type, categories=['study', 'recall']),
+        'position': (position[rows] + 1).astype(np.int32),
+        'item_index': ev_item.astype(np.int32),
+        'item': _item_column(items, ev_item),
+    })
+
+
+def draw_item_orders(pool_size, n_lists, n_items, rng=None):
+    # [n_lists x n_items] matrix of distinct pool indices in random order.
+    # the n_items smallest of a row of uniform random keys, taken in
+    # sorted order, are a uniformly random ordered sample from the pool
+    rng = np.random.default_rng(rng)
+    order = np.empty((n_lists, n_items), dtype=np.int64)
+    if n_items == 0:
+        return order
+    block = max(1, _BLOCK_ELEMENTS // pool_size)
+    for start in range(0, n_lists, block):
+        stop = min(start + block, n_lists)
+        keys = rng.random((stop - start, pool_size), dtype=np.float32)
+        if n_items < pool_size:
+            picked = np.argpartition(keys, n_items - 1, axis=1)[:, :n_items]
+        else:
+            picked = np.broadcast_to(np.arange(pool_size), keys.shape)
+        picked_keys = np.take_along_axis(keys, picked, axis=1)
+        order[start:stop] = np.take_along_axis(
+            picked, np.argsort(picked_keys, axis=1), axis=1)
+    return order
+
+
+def _item_column(items, item_index):
+    # categorical item names if the pool names are unique, which is the
+    # normal case; otherwise fall back to a plain lookup
+    categories = pd.Index(items)
+    if categories.is_unique:
+        return pd.Categorical.from_codes(item_index, categories=categories)
+    return items[item_index]
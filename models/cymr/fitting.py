@@ -0,0 +1,559 @@
+import copy
+import time
+
+import numpy as np
+import pandas as pd
+from scipy import optimize, special
+from joblib import Parallel, delayed
+
+import caching
+import cmr_l
+import profiling
+
+# maximum likelihood fits of CMR with the cmr_l engine, using gradients
+# and bounded quasi-Newton search (L-BFGS-B) from several starting
+# points, in place of the derivative-free search of fit_indiv.
+#
+# the likelihood is smooth in the continuous parameters, so the gradient
+# is taken by central differences. all 2k + 1 points of the stencil are
+# stacked along the list dimension of the engine (one copy of the
+# subject's lists per point) and evaluated in a single batched call, so
+# the value and gradient together cost about one vectorized likelihood
+# evaluation. points next to a bound are moved inside it.
+#
+# parameters are taken from a cymr Parameters object: fixed values,
+# free parameters with bounds, and dynamic recall parameters
+# (param_def.dynamic['recall']), using the parameter names of cmr_l.
+
+# penalty for parameter values where the likelihood is not finite
+BAD_FIT = 1e10
+
+# cache used by fit_nested when none is passed in; lives for the python
+# session
+default_cache = caching.ResultCache()
+
+# seed for the starting points of cached fits when none is given (fresh
+# entropy would give a new cache key, and so a refit, on every call)
+DEFAULT_SEED = 0
+
+
+def param_parts(param_def):
+    # fixed values, free names, bounds, dynamic recall expressions and
+    # dependent parameter expressions from a cymr Parameters object
+    names = list(param_def.free)
+    bounds = np.array([param_def.free[name] for name in names], dtype=float)
+    dynamic = dict(getattr(param_def, 'dynamic', {}).get('recall', {}))
+    dependent = dict(getattr(param_def, 'dependent', None) or {})
+    return dict(param_def.fixed), names, bounds, dynamic, dependent
+
+
+def bad_fit(x, anchor):
+    # objective and gradient where the likelihood is not finite: above
+    # any real fit, and rising with distance from anchor (the last point
+    # with a finite likelihood), so the line search backs off and the
+    # optimizer never sees a stationary point there
+    d = np.ravel(x) - np.ravel(anchor)
+    dist = np.linalg.norm(d)
+    if dist == 0:
+        d = np.ones_like(d)
+        dist = np.linalg.norm(d)
+    return BAD_FIT * (1 + dist), BAD_FIT * d / dist
+
+
+def stencil(x, bounds, rel_step=1e-6):
+    # [2k + 1 x k] points for central differences around x: x, then
+    # x + h_i e_i, then x - h_i e_i, with h_i relative to the range of
+    # parameter i and the points clipped to the bounds. x may also be a
+    # [subjects x k] matrix, giving [2k + 1 x subjects x k] points where
+    # parameter i is moved for every subject at once
+    k = x.shape[-1]
+    h = rel_step * (bounds[:, 1] - bounds[:, 0])
+    points = np.tile(x, (2 * k + 1,) + (1,) * x.ndim)
+    offset = np.diag(h).reshape((k,) + (1,) * (x.ndim - 1) + (k,))
+    points[1:k + 1] += offset
+    points[k + 1:] -= offset
+    return np.clip(points, bounds[:, 0], bounds[:, 1])
+
+
+class Objective:
+    # negative log likelihood and its gradient for one set of prepared
+    # lists, as a function of the free parameters. n_eval counts batched
+    # likelihood calls
+
+    def __init__(self, lists, fixed, names, bounds, dynamic=None,
+                 rel_step=1e-6, method='batch', dependent=None):
+        self.lists = lists
+        self.fixed = fixed
+        self.names = names
+        self.bounds = bounds
+        self.dynamic = dynamic or None
+        self.dependent = dependent or None
+        self.rel_step = rel_step
+        self.method = method
+        self.n_lists = lists['subject'].shape[0]
+        self.stacked = cmr_l.tile_lists(lists, 2 * len(names) + 1)
+        self.anchor = bounds.mean(axis=1)
+        self.n_eval = 0
+
+    def logl_points(self, points, lists=None):
+        # [points] total log likelihood at each row of points
+        if lists is None:
+            lists = cmr_l.tile_lists(self.lists, points.shape[0])
+        param = dict(self.fixed)
+        for i, name in enumerate(self.names):
+            param[name] = np.repeat(points[:, i], self.n_lists)
+        full = cmr_l.expand_param(lists, param, dynamic=self.dynamic,
+                                  dependent=self.dependent)
+        logl = cmr_l.likelihood_lists(lists, full, method=self.method)
+        self.n_eval += 1
+        return np.nansum(logl, axis=1).reshape(points.shape[0], self.n_lists).sum(axis=1)
+
+    @profiling.timed('objective')
+    def __call__(self, x):
+        k = len(self.names)
+        x = np.asarray(x, dtype=float)
+        points = stencil(x, self.bounds, self.rel_step)
+        logl = self.logl_points(points, self.stacked)
+        if not np.all(np.isfinite(logl)):
+            return bad_fit(x, self.anchor)
+        self.anchor = x.copy()
+        step = points[1:k + 1].diagonal() - points[k + 1:].diagonal()
+        grad = (logl[1:k + 1] - logl[k + 1:]) / step
+        return -logl[0], -grad
+
+
+def start_points(bounds, n_starts, rng=None, x0=None):
+    # [n_starts x k] starting points: x0 (if given) and then points drawn
+    # uniformly within the bounds
+    rng = np.random.default_rng(rng)
+    k = bounds.shape[0]
+    starts = bounds[:, 0] + rng.random((n_starts, k)) * (bounds[:, 1] - bounds[:, 0])
+    if x0 is not None:
+        starts[0] = np.clip(x0, bounds[:, 0], bounds[:, 1])
+    return starts
+
+
+def fit_lists(lists, fixed, names, bounds, dynamic=None, n_starts=4,
+              rng=None, x0=None, rel_step=1e-6, method='batch', options=None,
+              dependent=None):
+    # fit prepared lists (e.g. one subject, or a view of a
+    # list_store.ListStore). returns a dict with the best parameters,
+    # logl, n (number of recall and stop events), k, and the cost of the
+    # search: n_eval (batched likelihood calls) and n_iter (quasi-Newton
+    # iterations, over all starts)
+    lists = cmr_l.as_lists(lists)
+    objective = Objective(lists, fixed, names, bounds, dynamic, rel_step, method,
+                          dependent)
+    best = None
+    n_iter = 0
+    for start in start_points(bounds, n_starts, rng, x0):
+        res = optimize.minimize(objective, start, jac=True, method='L-BFGS-B',
+                                bounds=bounds, options=options)
+        n_iter += res.nit
+        if best is None or res.fun < best.fun:
+            best = res
+    param = dict(fixed)
+    param.update(zip(names, best.x.tolist()))
+    param = cmr_l.eval_dependent(param, dependent)
+    n = int(np.sum(lists['recalls'] > 0) + lists['recalls'].shape[0])
+    return {**param, 'logl': -float(best.fun), 'n': n, 'k': len(names),
+            'n_eval': objective.n_eval, 'n_iter': n_iter}
+
+
+def fit_indiv(data, param_def, recall_keys=None, n_starts=4, n_jobs=1,
+              rng=None, x0=None, rel_step=1e-6, method='batch', options=None):
+    # fit each subject separately.
+    # data: free recall data (cymr format), data prepared with
+    #   cmr_l.prepare_lists, or a list_store.ListStore (workers then read
+    #   their subject from the store instead of receiving a copy)
+    # param_def: cymr Parameters with fixed, free, dependent and
+    #   dynamic recall parameters
+    # recall_keys: data columns used by dynamic parameters
+    # n_starts: number of starting points per subject
+    # rng: seed or SeedSequence; each subject gets its own child stream,
+    #   so results do not depend on n_jobs
+    # x0: optional DataFrame (indexed by subject) or dict of starting
+    #   values for the free parameters, used as the first start
+    # options: passed to scipy.optimize.minimize
+    # returns a DataFrame indexed by subject with the parameters, logl,
+    # n, k, n_eval and n_iter, like cymr's fit_indiv
+    fixed, names, bounds, dynamic, dependent = param_parts(param_def)
+    lists = cmr_l.as_lists(data, recall_keys)
+    subjects = pd.unique(lists['subject'])
+    seed = rng if isinstance(rng, np.random.SeedSequence) else np.random.SeedSequence(rng)
+    seeds = seed.spawn(len(subjects))
+    starts = [_subject_start(x0, subject, names) for subject in subjects]
+
+    if hasattr(data, 'view'):
+        subsets = [data.view(lists['subject'] == subject) for subject in subjects]
+    else:
+        subsets = [cmr_l.select_lists(lists, lists['subject'] == subject)
+                   for subject in subjects]
+    tasks = [(subsets[i], fixed, names, bounds, dynamic, n_starts, seeds[i],
+              starts[i], rel_step, method, options, dependent)
+             for i in range(len(subjects))]
+    if n_jobs == 1:
+        out = [fit_lists(*task) for task in tasks]
+    else:
+        out = Parallel(n_jobs=n_jobs)(delayed(fit_lists)(*task) for task in tasks)
+    results = pd.DataFrame(out, index=pd.Index(subjects, name='subject'))
+    return results
+
+
+def _subject_start(x0, subject, names):
+    if x0 is None:
+        return None
+    if isinstance(x0, pd.DataFrame):
+        if subject not in x0.index:
+            return None
+        return x0.loc[subject, names].to_numpy(dtype=float)
+    return np.array([x0[name] for name in names], dtype=float)
+
+
+def stage_param_defs(param_def, stages):
+    # list of Parameters for a ladder of nested models: stage i frees
+    # the parameters of param_def.free and of stages[0..i], each a dict
+    # of {name: (lower, upper)}
+    defs = []
+    current = param_def
+    for stage in stages:
+        current = copy.deepcopy(current)
+        current.set_free(**stage)
+        defs.append(current)
+    return defs
+
+
+def warm_start(prev, param_def, names):
+    # starting values for a larger model from the fit of a smaller one:
+    # previous estimates where available; newly freed parameters start
+    # at their fixed value (the value they had in the smaller model) or
+    # the middle of their range
+    x0 = pd.DataFrame(index=prev.index)
+    for name in names:
+        if name in prev.columns:
+            x0[name] = prev[name]
+        elif name in param_def.fixed:
+            x0[name] = param_def.fixed[name]
+        else:
+            x0[name] = np.mean(param_def.free[name])
+    return x0
+
+
+def fit_nested(data, param_def, stages, recall_keys=None, n_starts=4,
+               n_starts_warm=1, n_jobs=1, rng=None, cache=None,
+               rel_step=1e-6, method='batch', options=None):
+    # fit a ladder of nested models, each warm-started from the fit of
+    # the one before.
+    # param_def: cymr Parameters for the smallest model; stages: list of
+    #   dicts of parameters to free at each step (see stage_param_defs),
+    #   e.g. [{'B_enc': (0, 1)}, {'B_rec': (0, 1)}, {'P1': (0, 15), 'P2': (0, 3)}]
+    # n_starts: starting points for the first stage; later stages use
+    #   the warm start plus n_starts_warm - 1 random points
+    # cache: caching.ResultCache (use a directory to keep fits between
+    #   runs), a directory path, None for the module default, or False.
+    #   each stage is keyed on the data, its parameter definitions, the
+    #   fit settings (including the seed) and the key of the stage
+    #   before it
+    # rng: seed or SeedSequence for the starting points; with a cache
+    #   and no rng, DEFAULT_SEED is used so repeated calls hit the cache
+    # returns a list with the results of each stage (as fit_indiv) and a
+    # DataFrame with the cost of each stage: its free parameters, whether
+    # it came from the cache, batched likelihood calls, quasi-Newton
+    # iterations, time, and total logl
+    if cache is None:
+        cache = default_cache
+    elif isinstance(cache, str):
+        cache = caching.ResultCache(cache)
+    if rng is None and cache is not False:
+        rng = DEFAULT_SEED
+    seed = rng if isinstance(rng, np.random.SeedSequence) else np.random.SeedSequence(rng)
+    settings = caching.param_key({'recall_keys': recall_keys, 'n_starts': n_starts,
+                                  'n_starts_warm': n_starts_warm,
+                                  'seed': [str(seed.entropy), list(seed.spawn_key),
+                                           seed.n_children_spawned],
+                                  'rel_step': rel_step, 'method': method,
+                                  'options': options})
+    stage_seeds = seed.spawn(len(stages))
+    data_key = caching.data_hash(data)
+
+    results = []
+    costs = []
+    prev = None
+    prev_key = ''
+    for i, stage_def in enumerate(stage_param_defs(param_def, stages)):
+        key = None
+        if cache is not False:
+            key = cache.key(prev_key, data_key, caching.param_def_hash(stage_def),
+                            settings, str(i))
+        names = list(stage_def.free)
+        start = time.perf_counter()
+        stored = cache.get(key) if cache is not False else None
+        if stored is not None:
+            res = pd.DataFrame(stored['results']).set_index('subject')
+            n_eval = n_iter = 0
+        else:
+            x0 = None if prev is None else warm_start(prev, stage_def, names)
+            res = fit_indiv(data, stage_def, recall_keys=recall_keys,
+                            n_starts=n_starts if prev is None else n_starts_warm,
+                            n_jobs=n_jobs, rng=stage_seeds[i], x0=x0,
+                            rel_step=rel_step, method=method, options=options)
+            n_eval = int(res['n_eval'].sum())
+            n_iter = int(res['n_iter'].sum())
+            if cache is not False:
+                frame = res.reset_index()
+                cache.put(key, {'results': {c: [caching.plain_value(v) for v in frame[c]]
+                                            for c in frame.columns}})
+        costs.append({'stage': i, 'free': ' '.join(names),
+                      'cached': stored is not None, 'n_eval': n_eval,
+                      'n_iter': n_iter, 'time': time.perf_counter() - start,
+                      'logl': float(res['logl'].sum())})
+        results.append(res)
+        prev = res
+        prev_key = key or ''
+    return results, pd.DataFrame(costs)
+
+
+# group fits: all subjects in one batched likelihood call. each subject
+# has its own parameter vector, and the objective is a function of the
+# [subjects x k] matrix of all of them. subjects are independent, so
+# moving parameter i of every subject at once gives every subject's
+# partial derivative for i, and the 2k + 1 stencil points cover the
+# whole gradient: one call over (2k + 1) x all lists per optimizer step,
+# for every subject.
+#
+# with a population prior, subject parameters are random effects: on the
+# logit scale within their bounds, each free parameter is normal over
+# subjects with mean mu and standard deviation sigma. the population
+# parameters are fit by empirical Bayes (EM with a Laplace approximation
+# of each subject's posterior, as in Huys et al., 2011): alternate
+# finding the posterior mode of all subjects at once, and setting mu and
+# sigma from the modes and their posterior variances.
+
+# lower limit on the population standard deviation (logit scale)
+MIN_SIGMA = 0.05
+
+# step (relative to the parameter range) for the curvature used in the
+# Laplace approximation
+CURV_STEP = 1e-3
+
+
+def to_logit(x, bounds):
+    # logit-scale values of parameters x ([..., k]) within their bounds,
+    # and the derivative of the logit with respect to x
+    width = bounds[:, 1] - bounds[:, 0]
+    u = np.clip((x - bounds[:, 0]) / width, 1e-6, 1 - 1e-6)
+    return np.log(u) - np.log1p(-u), 1 / (width * u * (1 - u))
+
+
+def from_logit(z, bounds):
+    # parameter values from logit-scale values
+    return bounds[:, 0] + (bounds[:, 1] - bounds[:, 0]) * special.expit(z)
+
+
+def log_prior(x, bounds, mu, sigma):
+    # [subjects] log density of each subject's parameters ([subjects x k])
+    # under the population prior, taken on the logit scale (the posterior
+    # mode is found on that scale, so there is no Jacobian term), and its
+    # [subjects x k] gradient with respect to x
+    z, dz = to_logit(x, bounds)
+    r = (z - mu) / sigma
+    logp = np.sum(-0.5 * r ** 2 - np.log(sigma) - 0.5 * np.log(2 * np.pi), axis=-1)
+    return logp, -r / sigma * dz
+
+
+class GroupObjective:
+    # negative log likelihood (plus log prior, if a population prior is
+    # set) and its gradient for all subjects, as a function of the
+    # flattened [subjects x k] matrix of free parameters. n_eval counts
+    # batched likelihood calls
+
+    def __init__(self, lists, fixed, names, bounds, dynamic=None,
+                 rel_step=1e-6, method='batch', dependent=None):
+        self.lists = lists
+        self.fixed = fixed
+        self.names = names
+        self.bounds = bounds
+        self.dynamic = dynamic or None
+        self.dependent = dependent or None
+        self.rel_step = rel_step
+        self.method = method
+        self.codes, self.subjects = pd.factorize(lists['subject'])
+        self.n_subj = self.subjects.shape[0]
+        self.n_lists = self.codes.shape[0]
+        self.stacked = cmr_l.tile_lists(lists, 2 * len(names) + 1)
+        self.anchor = np.tile(bounds.mean(axis=1), (self.n_subj, 1))
+        self.prior = None
+        self.n_eval = 0
+
+    def logl_subjects(self, points, lists=None):
+        # [points x subjects] log likelihood of each subject, for
+        # [points x subjects x k] parameters
+        n_points = points.shape[0]
+        if lists is None:
+            lists = cmr_l.tile_lists(self.lists, n_points)
+        param = dict(self.fixed)
+        for i, name in enumerate(self.names):
+            param[name] = points[:, self.codes, i].ravel()
+        full = cmr_l.expand_param(lists, param, dynamic=self.dynamic,
+                                  dependent=self.dependent)
+        logl = np.nansum(cmr_l.likelihood_lists(lists, full, method=self.method), axis=1)
+        self.n_eval += 1
+        group = (np.repeat(np.arange(n_points), self.n_lists) * self.n_subj +
+                 np.tile(self.codes, n_points))
+        total = np.bincount(group, weights=logl, minlength=n_points * self.n_subj)
+        return total.reshape(n_points, self.n_subj)
+
+    def curvature(self, x):
+        # [subjects x k] second derivative of each subject's log
+        # likelihood in each of its parameters, by central differences
+        # with a wider step (one batched call). NaN where a bound leaves
+        # no room on one side
+        k = len(self.names)
+        points = stencil(x, self.bounds, CURV_STEP)
+        logl = self.logl_subjects(points, self.stacked)
+        diag = np.arange(k)
+        h_up = (points[1 + diag, :, diag] - x.T).T
+        h_down = (x.T - points[1 + k + diag, :, diag]).T
+        f_up = logl[1:k + 1].T
+        f_down = logl[k + 1:].T
+        f0 = logl[0][:, None]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            d2 = 2 * (f_up * h_down + f_down * h_up - f0 * (h_up + h_down)) / (
+                h_up * h_down * (h_up + h_down))
+        return np.where((h_up > 0) & (h_down > 0), d2, np.nan)
+
+    @profiling.timed('objective')
+    def __call__(self, x):
+        k = len(self.names)
+        x = np.asarray(x, dtype=float).reshape(self.n_subj, k)
+        points = stencil(x, self.bounds, self.rel_step)
+        logl = self.logl_subjects(points, self.stacked)
+        if not np.all(np.isfinite(logl)):
+            return bad_fit(x, self.anchor)
+        self.anchor = x.copy()
+        diag = np.arange(k)
+        step = (points[1 + diag, :, diag] - points[1 + k + diag, :, diag]).T
+        grad = (logl[1:k + 1] - logl[k + 1:]).T / step
+        f = -logl[0].sum()
+        if self.prior is not None:
+            logp, dlogp = log_prior(x, self.bounds, *self.prior)
+            f -= logp.sum()
+            grad += dlogp
+        return f, -grad.ravel()
+
+
+def _minimize_group(objective, start, options=None):
+    # posterior mode (or maximum likelihood) for all subjects from one
+    # [subjects x k] start. returns the estimates, each subject's log
+    # likelihood at them, and the number of iterations
+    bounds = np.tile(objective.bounds, (objective.n_subj, 1))
+    res = optimize.minimize(objective, start.ravel(), jac=True, method='L-BFGS-B',
+                            bounds=bounds, options=options)
+    x = res.x.reshape(start.shape)
+    logl = objective.logl_subjects(x[None])[0]
+    return x, logl, res.nit
+
+
+def _group_start(lists, fixed, names, bounds, dynamic, start, rel_step,
+                 method, options, dependent=None):
+    # one maximum likelihood start of a group fit, in its own objective
+    # (so starts can run in separate processes)
+    lists = cmr_l.as_lists(lists)
+    objective = GroupObjective(lists, fixed, names, bounds, dynamic, rel_step, method,
+                               dependent)
+    x, logl, n_iter = _minimize_group(objective, start, options)
+    return x, logl, n_iter, objective.n_eval
+
+
+def fit_group(data, param_def, recall_keys=None, n_starts=4, n_jobs=1,
+              rng=None, x0=None, prior=True, max_em=50, tol=1e-3,
+              rel_step=1e-6, method='batch', options=None):
+    # fit all subjects together, with one batched likelihood call per
+    # optimizer step for the whole group.
+    # data, param_def, recall_keys, rel_step, method, options: as for
+    #   fit_indiv
+    # n_starts: starting points for the maximum likelihood fit; each is
+    #   a joint search over all subjects, and starts run in parallel over
+    #   n_jobs processes. each subject keeps its best start
+    # rng: seed or SeedSequence for the starting points
+    # x0: optional starting values (DataFrame indexed by subject, or dict)
+    #   used as the first start
+    # prior: if True, fit a population prior by empirical Bayes, starting
+    #   from the maximum likelihood estimates, and return each subject's
+    #   posterior mode; if False, return maximum likelihood estimates
+    # max_em, tol: limit on EM iterations, and tolerance on the change in
+    #   mu and sigma for convergence
+    # returns a DataFrame indexed by subject with the parameters, logl
+    # (log likelihood, without the prior), n and k, like fit_indiv; and a
+    # DataFrame indexed by free parameter with the population mu and
+    # sigma (logit scale) and the population median on the parameter
+    # scale. the population frame's attrs hold the cost of the fit
+    # (n_eval, n_iter, n_em)
+    fixed, names, bounds, dynamic, dependent = param_parts(param_def)
+    lists = cmr_l.as_lists(data, recall_keys)
+    codes, subjects = pd.factorize(lists['subject'])
+    k = len(names)
+    seed = rng if isinstance(rng, np.random.SeedSequence) else np.random.SeedSequence(rng)
+    starts = start_points(np.tile(bounds, (len(subjects), 1)), n_starts, seed)
+    starts = starts.reshape(n_starts, len(subjects), k)
+    if x0 is not None:
+        for s, subject in enumerate(subjects):
+            start = _subject_start(x0, subject, names)
+            if start is not None:
+                starts[0, s] = np.clip(start, bounds[:, 0], bounds[:, 1])
+
+    # maximum likelihood, keeping the best start for each subject
+    shared = data if hasattr(data, 'prepared') else lists
+    tasks = [(shared, fixed, names, bounds, dynamic, start, rel_step, method, options,
+              dependent)
+             for start in starts]
+    if n_jobs == 1:
+        out = [_group_start(*task) for task in tasks]
+    else:
+        out = Parallel(n_jobs=n_jobs)(delayed(_group_start)(*task) for task in tasks)
+    all_logl = np.array([o[1] for o in out])
+    best = np.argmax(np.where(np.isnan(all_logl), -np.inf, all_logl), axis=0)
+    x = np.array([o[0] for o in out])[best, np.arange(len(subjects))]
+    logl = all_logl[best, np.arange(len(subjects))]
+    n_eval = sum(o[3] for o in out)
+    n_iter = sum(o[2] for o in out)
+
+    # empirical Bayes estimate of the population prior
+    z = to_logit(x, bounds)[0]
+    mu = z.mean(axis=0)
+    sigma = np.maximum(z.std(axis=0), MIN_SIGMA)
+    n_em = 0
+    if prior:
+        objective = GroupObjective(lists, fixed, names, bounds, dynamic, rel_step, method,
+                                   dependent)
+        for n_em in range(1, max_em + 1):
+            objective.prior = (mu, sigma)
+            x, logl, nit = _minimize_group(objective, x, options)
+            n_iter += nit
+            # posterior variance of each subject's parameters (logit
+            # scale), from the curvature of the log posterior
+            z, dz = to_logit(x, bounds)
+            d2 = np.nan_to_num(objective.curvature(x), nan=0.0)
+            post_var = 1 / (np.maximum(-d2, 0) / dz ** 2 + 1 / sigma ** 2)
+            new_mu = z.mean(axis=0)
+            new_sigma = np.sqrt(np.mean((z - new_mu) ** 2 + post_var, axis=0))
+            new_sigma = np.maximum(new_sigma, MIN_SIGMA)
+            change = max(np.max(np.abs(new_mu - mu)), np.max(np.abs(new_sigma - sigma)))
+            mu, sigma = new_mu, new_sigma
+            if change < tol:
+                break
+        n_eval += objective.n_eval
+
+    param = [cmr_l.eval_dependent(dict(fixed, **dict(zip(names, row.tolist()))), dependent)
+             for row in x]
+    n = (np.bincount(codes, weights=np.sum(lists['recalls'] > 0, axis=1),
+                     minlength=len(subjects)) + np.bincount(codes, minlength=len(subjects)))
+    results = pd.DataFrame(param, index=pd.Index(subjects, name='subject'))
+    results['logl'] = logl
+    results['n'] = n.astype(int)
+    results['k'] = k
+    population = pd.DataFrame({'mu': mu, 'sigma': sigma,
+                               'median': from_logit(mu, bounds)},
+                              index=pd.Index(names, name='param'))
+    population.attrs.update({'n_eval': n_eval, 'n_iter': n_iter, 'n_em': n_em})
+    return results, population
@@ -0,0 +1,104 @@
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+
+import covariates as cov
+
+# reproducible, parallel generation of simulated data with cymr models.
+# the work is split into units of one subject x one replicate, and each
+# unit gets its own child of a single SeedSequence, so a given seed
+# gives bit-identical output whatever n_jobs is. cymr draws from numpy's
+# legacy global generator, so each unit sets that state from its child
+# stream before simulating (and restores it afterwards).
+#
+# output follows cymr's generate: lists of replicate i are numbered
+# i * max_list + list. in addition, each row has the replicate index
+# (rep_key), and any recall_keys are copied from the guiding data onto
+# the simulated recall events, so no fixup (e.g. fix_hcmp_field) is
+# needed.
+
+
+def unit_seeds(seed, n_subj, n_rep):
+    # [n_subj x n_rep] object array of SeedSequences, one per unit.
+    # seed: int, sequence of ints, SeedSequence, or None for fresh
+    # entropy (available afterwards as the entropy of the root sequence)
+    root = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    children = np.empty(n_subj * n_rep, dtype=object)
+    children[:] = root.spawn(n_subj * n_rep)
+    return root, children.reshape(n_subj, n_rep)
+
+
+def legacy_state(seed_seq):
+    # state tuple for np.random.set_state drawn from a SeedSequence
+    return np.random.RandomState(np.random.MT19937(seed_seq)).get_state()
+
+
+def generate(model, data, group_param, subj_param=None, param_def=None,
+             patterns=None, study_keys=None, recall_keys=None, n_rep=1,
+             seed=None, n_jobs=1, rep_key='rep'):
+    # model: cymr model
+    # data, group_param, subj_param, param_def, patterns, study_keys,
+    #   recall_keys: as for model.generate
+    # n_rep: number of replicates of each subject
+    # seed: int, SeedSequence, or None; with None, the entropy used is
+    #   stored in sim.attrs['seed_entropy'] so the run can be repeated
+    # n_jobs: number of worker processes
+    # rep_key: column for the replicate index
+    # returns the simulated data for all units, ordered by subject and
+    # then replicate
+    root = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    chunks = iter_generate(model, data, group_param, subj_param=subj_param,
+                           param_def=param_def, patterns=patterns,
+                           study_keys=study_keys, recall_keys=recall_keys,
+                           n_rep=n_rep, seed=root, n_jobs=n_jobs, rep_key=rep_key)
+    sim = pd.concat(list(chunks), axis=0, ignore_index=True)
+    sim.attrs['seed_entropy'] = root.entropy
+    return sim
+
+
+def iter_generate(model, data, group_param, subj_param=None, param_def=None,
+                  patterns=None, study_keys=None, recall_keys=None, n_rep=1,
+                  seed=None, n_jobs=1, rep_key='rep'):
+    # same as generate, but yields the simulated data one subject at a
+    # time (all replicates of the subject, in order), so a large run
+    # never has to be held in memory at once. workers simulate ahead of
+    # the consumer; chunks are yielded in subject order
+    subjects = data['subject'].unique()
+    root, seeds = unit_seeds(seed, len(subjects), n_rep)
+    kws = {'group_param': group_param, 'subj_param': subj_param,
+           'param_def': param_def, 'patterns': patterns,
+           'study_keys': study_keys, 'recall_keys': recall_keys}
+    tasks = ((model, data.loc[data['subject'] == subject], seeds[s], kws, rep_key)
+             for s, subject in enumerate(subjects))
+    if n_jobs == 1:
+        chunks = (_generate_subject(*task) for task in tasks)
+    else:
+        chunks = Parallel(n_jobs=n_jobs, return_as='generator')(
+            delayed(_generate_subject)(*task) for task in tasks)
+    yield from chunks
+
+
+def _generate_subject(model, subject_data, seeds, kws, rep_key):
+    frames = [_generate_unit(model, subject_data, rep, seed_seq, kws, rep_key)
+              for rep, seed_seq in enumerate(seeds)]
+    return pd.concat(frames, axis=0, ignore_index=True)
+
+
+def _generate_unit(model, subject_data, rep, seed_seq, kws, rep_key):
+    # cymr extends the recall_keys list it is given, so pass a copy
+    recall_keys = kws['recall_keys']
+    if recall_keys:
+        kws = dict(kws, recall_keys=list(recall_keys))
+    state = np.random.get_state()
+    np.random.set_state(legacy_state(seed_seq))
+    try:
+        rep_data = model.generate(subject_data, n_rep=1, **kws)
+    finally:
+        np.random.set_state(state)
+
+    max_list = subject_data['list'].max()
+    rep_data['list'] = rep * max_list + rep_data['list']
+    if recall_keys:
+        rep_data = cov.carry_recall_keys(subject_data, rep_data, recall_keys)
+    rep_data[rep_key] = np.int32(rep)
+    return rep_data
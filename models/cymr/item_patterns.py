@@ -0,0 +1,160 @@
+import os
+import hashlib
+import json
+from string import ascii_letters
+
+import numpy as np
+
+# factory for the patterns dict that cymr expects:
+# {'items': [pool] array of item names,
+#  'vector': {name: [pool x units] array of item vectors}}
+# localist vectors are stored as an implicit identity matrix by default,
+# so pools with thousands of items don't pay for a dense np.eye.
+
+
+class LocalistPatterns:
+    # implicit [n x n] identity matrix. only the rows (and columns) that
+    # are indexed get built, and np.asarray gives the dense matrix for
+    # code that really needs it
+
+    def __init__(self, n, dtype=float):
+        self.n = int(n)
+        self.dtype = np.dtype(dtype)
+
+    @property
+    def shape(self):
+        return (self.n, self.n)
+
+    @property
+    def ndim(self):
+        return 2
+
+    def __len__(self):
+        return self.n
+
+    def __repr__(self):
+        return f'LocalistPatterns(n={self.n}, dtype={self.dtype})'
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > 2:
+            raise IndexError('too many indices for localist patterns')
+        rows = np.arange(self.n)[key[0]]
+        cols = np.arange(self.n)[key[1]] if len(key) == 2 else np.arange(self.n)
+        out = np.equal.outer(rows, cols).astype(self.dtype)
+        return out
+
+    def __array__(self, dtype=None, copy=None):
+        return np.eye(self.n, dtype=dtype or self.dtype)
+
+    def toarray(self):
+        return np.eye(self.n, dtype=self.dtype)
+
+    def tosparse(self):
+        from scipy import sparse
+        return sparse.identity(self.n, dtype=self.dtype, format='csr')
+
+
+def item_names(pool_size):
+    # a, b, ... Z, aa, ab, ... so the first 52 names match the original
+    # ascii_letters pool and larger pools still get unique names
+    names = []
+    for i in range(pool_size):
+        name = ''
+        i += 1
+        while i > 0:
+            i, r = divmod(i - 1, len(ascii_letters))
+            name = ascii_letters[r] + name
+        names.append(name)
+    return np.array(names)
+
+
+def load_wordpool(path):
+    # one item per line, blank lines ignored
+    with open(path) as f:
+        words = [line.strip() for line in f]
+    return np.array([w for w in words if w])
+
+
+def localist_vectors(pool_size, fmt='implicit'):
+    # fmt: 'implicit' (LocalistPatterns), 'sparse' (scipy csr) or 'dense'
+    if fmt == 'implicit':
+        return LocalistPatterns(pool_size)
+    elif fmt == 'sparse':
+        return LocalistPatterns(pool_size).tosparse()
+    elif fmt == 'dense':
+        return np.eye(pool_size)
+    else:
+        raise ValueError(f'unknown localist format: {fmt}')
+
+
+def distributed_vectors(pool_size, n_units, rng=None, normalize=True):
+    # random-normal item vectors, scaled to unit length by default
+    rng = np.random.default_rng(rng)
+    vectors = rng.standard_normal((pool_size, n_units))
+    if normalize:
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+def create_patterns(pool_size=None, items=None, wordpool=None,
+                    localist='implicit', distributed=None, seed=None,
+                    cache_dir=None):
+    # items come from (in order of preference) an explicit list, a
+    # wordpool file, or generated names; pool_size truncates the first
+    # two and sets the size of the third.
+    # localist: format of the 'loc' vectors (see localist_vectors), or
+    #   None to leave them out
+    # distributed: dict of {vector name: n_units} for random-normal
+    #   vectors, e.g. {'dist': 300}. each set gets its own child stream
+    #   of seed, so adding a set doesn't change the others
+    # cache_dir: if set, the item names and distributed vectors are
+    #   stored there and reloaded on later calls with the same settings.
+    #   unseeded distributed vectors are never cached
+    if items is None and wordpool is not None:
+        items = load_wordpool(wordpool)
+    if items is None:
+        if pool_size is None:
+            raise ValueError('one of pool_size, items or wordpool is required')
+        items = item_names(pool_size)
+    items = np.asarray(items)
+    if pool_size is not None:
+        if pool_size > items.shape[0]:
+            raise ValueError(f'pool_size {pool_size} exceeds {items.shape[0]} available items')
+        items = items[:pool_size]
+    distributed = dict(distributed or {})
+
+    cache_file = None
+    if cache_dir is not None and (seed is not None or not distributed):
+        key = _cache_key(items, distributed, seed)
+        cache_file = os.path.join(cache_dir, f'patterns_{key}.npz')
+
+    if cache_file is not None and os.path.exists(cache_file):
+        with np.load(cache_file, allow_pickle=False) as saved:
+            items = saved['items']
+            vectors = {name: saved[f'vector_{name}'] for name in distributed}
+    else:
+        streams = np.random.SeedSequence(seed).spawn(len(distributed))
+        vectors = {}
+        for (name, n_units), stream in zip(sorted(distributed.items()), streams):
+            vectors[name] = distributed_vectors(items.shape[0], n_units,
+                                                np.random.default_rng(stream))
+        if cache_file is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            # write then rename, so a parallel run never reads half a file
+            tmp_file = cache_file[:-len('.npz')] + f'.{os.getpid()}.tmp.npz'
+            np.savez(tmp_file, items=items,
+                     **{f'vector_{name}': vec for name, vec in vectors.items()})
+            os.replace(tmp_file, cache_file)
+
+    if localist is not None:
+        vectors = {'loc': localist_vectors(items.shape[0], localist), **vectors}
+    return {'items': items, 'vector': vectors}
+
+
+def _cache_key(items, distributed, seed):
+    spec = {'items': [str(i) for i in items],
+            'distributed': sorted(distributed.items()),
+            'seed': seed}
+    return hashlib.sha1(json.dumps(spec).encode()).hexdigest()[:16]
@@ -0,0 +1,175 @@
+import numpy as np
+from scipy import special
+
+# linear ballistic accumulator (Brown & Heathcote, 2008), vectorized over
+# trials. drift rates are a [trials x accumulators] matrix (or a single
+# vector shared by all trials); A, b, s and tau can be scalars or
+# [trials] arrays. every function works on all trials at once, so
+# sampling N responses or evaluating N response densities is one array
+# operation instead of N calls to cymr's network.sample_response_lba or
+# lba.response_pdf.
+#
+# A: upper end of the start point distribution
+# b: response threshold
+# s: standard deviation of drift rates
+# tau: non-decision time
+
+
+def _trial_param(x, n_trials):
+    # [trials x 1] array of a trial parameter
+    return np.broadcast_to(np.asarray(x, dtype=float), (n_trials,))[:, None]
+
+
+def _drifts(v, n=None):
+    v = np.asarray(v, dtype=float)
+    if v.ndim == 1:
+        v = v[None, :]
+    if n is not None:
+        v = np.broadcast_to(v, (n, v.shape[1]))
+    return v
+
+
+def normpdf(x):
+    return np.exp(-(x ** 2) / 2) / np.sqrt(2 * np.pi)
+
+
+def normcdf(x):
+    return special.ndtr(x)
+
+
+def tpdf(t, A, b, v, s):
+    # density of one accumulator reaching threshold at decision time t
+    # (all arguments broadcast); zero for t <= 0
+    t = np.asarray(t, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        g = (b - A - t * v) / (t * s)
+        h = (b - t * v) / (t * s)
+        f = (-v * normcdf(g) + s * normpdf(g) + v * normcdf(h) - s * normpdf(h)) / A
+    return np.where(t > 0, f, 0.0)
+
+
+def tcdf(t, A, b, v, s):
+    # probability of one accumulator reaching threshold by decision time
+    # t; zero for t <= 0
+    t = np.asarray(t, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ts = t * s
+        e1 = ((b - A - t * v) / A) * normcdf((b - A - t * v) / ts)
+        e2 = ((b - t * v) / A) * normcdf((b - t * v) / ts)
+        e3 = (ts / A) * normpdf((b - A - t * v) / ts)
+        e4 = (ts / A) * normpdf((b - t * v) / ts)
+        F = 1 + e1 - e2 + e3 - e4
+    return np.where(t > 0, F, 0.0)
+
+
+def _others(x):
+    # product over all other columns, for each column (without dividing,
+    # so columns with x == 0 are handled exactly)
+    left = np.ones_like(x)
+    right = np.ones_like(x)
+    left[:, 1:] = np.cumprod(x[:, :-1], axis=1)
+    right[:, :-1] = np.cumprod(x[:, :0:-1], axis=1)[:, ::-1]
+    return left * right
+
+
+def defective_pdf(t, v, A, b, s, tau=0):
+    # [trials x accumulators] density of each accumulator finishing first
+    # at response time t ([trials]); summing over accumulators and
+    # integrating over t gives the probability that any accumulator
+    # finishes, which is less than one if drifts can be negative
+    v = _drifts(v)
+    t = np.asarray(t, dtype=float)
+    v = _drifts(v, max(v.shape[0], t.size))
+    n_trials = v.shape[0]
+    A, b, s, tau = [_trial_param(x, n_trials) for x in (A, b, s, tau)]
+    dt = np.broadcast_to(t, (n_trials,))[:, None] - tau
+    surv = 1 - tcdf(dt, A, b, v, s)
+    return tpdf(dt, A, b, v, s) * _others(surv)
+
+
+def defective_cdf(t, v, A, b, s, tau=0, n_nodes=16, n_panels=32):
+    # [trials x accumulators] probability of each accumulator finishing
+    # first by response time t, by Gauss-Legendre quadrature of
+    # defective_pdf over the decision time. the interval [0, t - tau] is
+    # split into panels that halve in width toward zero, so the
+    # quadrature stays accurate when t is far out in the tail
+    v = _drifts(v)
+    t = np.asarray(t, dtype=float)
+    v = _drifts(v, max(v.shape[0], t.size))
+    n_trials, n_acc = v.shape
+    A, b, s, tau = [_trial_param(x, n_trials) for x in (A, b, s, tau)]
+    dt = np.maximum(np.broadcast_to(t, (n_trials,))[:, None] - tau, 0)
+    x, w = np.polynomial.legendre.leggauss(n_nodes)
+    edges = 2.0 ** -np.arange(n_panels + 1)
+    edges[-1] = 0
+    lo = edges[1:, None]
+    width = edges[:-1, None] - lo
+    # decision times at the quadrature nodes: [trials x panels * nodes]
+    nodes = (lo + width * (x + 1) / 2).ravel()
+    weights = (width / 2 * w).ravel()
+    u = dt * nodes
+    dens = tpdf(u[:, :, None], A[:, :, None], b[:, :, None], v[:, None, :], s[:, :, None])
+    surv = 1 - tcdf(u[:, :, None], A[:, :, None], b[:, :, None], v[:, None, :], s[:, :, None])
+    flat = _others(surv.reshape(-1, n_acc)).reshape(surv.shape)
+    return dt * np.einsum('n,tnk->tk', weights, dens * flat)
+
+
+def p_no_response(v, s):
+    # [trials] probability that every drift rate is negative, so that no
+    # accumulator ever finishes
+    v = _drifts(v)
+    s = _trial_param(s, v.shape[0])
+    return np.prod(normcdf(-v / s), axis=1)
+
+
+def response_pdf(t, response, v, A, b, s):
+    # [trials] density of a response at decision time t, conditional on
+    # some accumulator finishing, as in cymr's lba.response_pdf.
+    # response: [trials] accumulator index; an index equal to the number
+    # of accumulators is a termination event and gives the probability
+    # that no accumulator finishes
+    v = _drifts(v)
+    response = np.asarray(response)
+    t = np.asarray(t, dtype=float)
+    n_trials = max(v.shape[0], response.size, t.size)
+    v = _drifts(v, n_trials)
+    n_acc = v.shape[1]
+    response = np.broadcast_to(response, (n_trials,))
+    p_neg = p_no_response(v, s)
+    dens = defective_pdf(t, v, A, b, s)
+    rows = np.arange(n_trials)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pdf = dens[rows, np.minimum(response, n_acc - 1)] / (1 - p_neg)
+    pdf = np.where(response == n_acc, p_neg, pdf)
+    return np.where(np.broadcast_to(t, (n_trials,)) > 0, pdf, 0.0)
+
+
+def sample_response(A, b, v, s, tau, n=None, shared_start=False, rng=None):
+    # sample a response and response time for each trial.
+    # v: [trials x accumulators] drift rates, or a vector of drift rates
+    #   to use for n trials
+    # shared_start: use one start point for all accumulators in a trial,
+    #   as cymr's network.sample_response_lba does; by default each
+    #   accumulator has its own start point, as in the standard LBA (and
+    #   in tpdf and tcdf)
+    # rng: seed or np.random.Generator
+    # trials where every drift is negative are redrawn, so every trial
+    # ends in a response. returns [trials] response index and [trials]
+    # response time
+    rng = np.random.default_rng(rng)
+    v = _drifts(v, n)
+    n_trials, n_acc = v.shape
+    A, b, s, tau = [_trial_param(x, n_trials) for x in (A, b, s, tau)]
+    response = np.zeros(n_trials, dtype=int)
+    rt = np.zeros(n_trials)
+    todo = np.arange(n_trials)
+    while todo.size:
+        n_start = 1 if shared_start else n_acc
+        k = rng.uniform(size=(todo.size, n_start)) * A[todo]
+        d = rng.normal(v[todo], s[todo])
+        with np.errstate(divide='ignore'):
+            t = np.where(d > 0, (b[todo] - k) / d, np.inf)
+        response[todo] = np.argmin(t, axis=1)
+        rt[todo] = tau[todo, 0] + np.min(t, axis=1)
+        todo = todo[np.all(d <= 0, axis=1)]
+    return response, rt
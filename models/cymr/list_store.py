@@ -0,0 +1,249 @@
+import os
+import json
+import shutil
+
+import numpy as np
+import pandas as pd
+
+import caching
+import cmr_l
+
+# prepared free recall data on disk, as flat arrays that worker processes
+# memory-map read-only instead of receiving a pickled copy of the data.
+# a store is a directory of .npy files:
+#   list_subject, list_num, list_length: [lists] (subjects as codes into
+#     the labels in meta.json)
+#   study_offsets, recall_offsets: [lists + 1] offsets of each list into
+#     the flat arrays below
+#   study_items: item_index of every study event (-1 if missing)
+#   recalls: serial position of every (cleaned) recall event
+#   key_<name>: value of recall key name at every (cleaned) recall event
+#   event_*: subject code, list, position, list index, output index and
+#     values of the recall keys of every recall event in the data (what
+#     PreparedData needs to swap a covariate)
+#
+# a ListStore pickles as its path, so passing it (or a view of some of
+# its lists) to joblib workers costs the same however large the data
+# are; each worker maps the files and only builds padded arrays for the
+# lists it evaluates. stores work anywhere prepared data do (cmr_l
+# likelihood and Model, fitting, sweep, permutation).
+#
+#   list_store.write_store('data.lists', data, recall_keys=['hcmp'])
+#   store = list_store.ListStore('data.lists')
+#   fitting.fit_indiv(store, param_def, n_jobs=8)
+
+VERSION = 1
+
+
+def write_store(path, data, recall_keys=None):
+    # write free recall data (DataFrame, or prepared with
+    # cmr_l.prepare_lists) to a store at path, replacing any store there.
+    # returns the ListStore
+    lists = cmr_l.as_lists(data, recall_keys)
+    keys = sorted(lists['recall_keys'])
+    codes, labels = pd.factorize(lists['subject'])
+    list_length = np.asarray(lists['list_length'])
+    recalls = lists['recalls']
+    n_rec = np.count_nonzero(recalls, axis=1)
+    arrays = {
+        'list_subject': codes.astype(np.int32),
+        'list_num': np.asarray(lists['list'], dtype=np.int64),
+        'list_length': list_length.astype(np.int32),
+        'study_offsets': _offsets(list_length),
+        'study_items': _flatten(lists['pres_itemnos'], list_length).astype(np.int32),
+        'recall_offsets': _offsets(n_rec),
+        'recalls': _flatten(recalls, n_rec).astype(np.int32),
+    }
+    for key in keys:
+        arrays['key_' + key] = _flatten(lists['recall_keys'][key], n_rec).astype(float)
+
+    meta = {'version': VERSION, 'n_lists': int(list_length.shape[0]),
+            'recall_keys': keys, 'max_length': int(list_length.max(initial=0)),
+            'max_recalls': int(recalls.shape[1]), 'hash': _content_hash(lists),
+            'subjects': [caching.plain_value(s) for s in labels]}
+    if isinstance(lists, cmr_l.PreparedData):
+        events = lists.events
+        rows, cols, event = lists.event_index
+        event_codes = pd.Index(labels).get_indexer(events['subject'].to_numpy())
+        arrays.update({
+            'event_subject': event_codes.astype(np.int32),
+            'event_list': events['list'].to_numpy().astype(np.int64),
+            'event_position': events['position'].to_numpy().astype(np.int64),
+            'event_row': np.asarray(rows, dtype=np.int64),
+            'event_col': np.asarray(cols, dtype=np.int64),
+            'event_num': np.asarray(event, dtype=np.int64),
+        })
+        for key in keys:
+            arrays['event_key_' + key] = np.asarray(lists.event_values[key], dtype=float)
+        meta['events'] = True
+    else:
+        meta['events'] = False
+
+    # write to a temporary directory and move it into place, so readers
+    # never see a partial store
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    for name, value in arrays.items():
+        np.save(os.path.join(tmp_path, name + '.npy'), value)
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+    return ListStore(path)
+
+
+def _content_hash(lists):
+    if isinstance(lists, cmr_l.PreparedData):
+        return lists.content_hash()
+    return cmr_l.PreparedData(lists, None, None, {}).content_hash()
+
+
+def _offsets(counts):
+    offsets = np.zeros(counts.shape[0] + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets
+
+
+def _flatten(matrix, counts):
+    # the first counts[i] entries of each row, end to end
+    return matrix[np.arange(matrix.shape[1]) < counts[:, None]]
+
+
+def _padded(flat, offsets, index, width, fill):
+    # [len(index) x width] rows of a flat array, padded with fill
+    start = offsets[index]
+    count = offsets[index + 1] - start
+    out = np.full((index.shape[0], width), fill, dtype=flat.dtype)
+    rows = np.repeat(np.arange(index.shape[0]), count)
+    cols = np.arange(rows.shape[0]) - np.repeat(np.cumsum(count) - count, count)
+    out[rows, cols] = flat[np.repeat(start, count) + cols]
+    return out
+
+
+class ListStore:
+    # read-only, memory-mapped access to a store written by write_store
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta['version'] != VERSION:
+            raise ValueError(f"unsupported store version: {self.meta['version']}")
+        self.arrays = {}
+        for name in os.listdir(path):
+            if name.endswith('.npy'):
+                self.arrays[name[:-4]] = np.load(os.path.join(path, name), mmap_mode='r')
+        self.subjects = np.array(self.meta['subjects'])
+        self._prepared = None
+
+    def __reduce__(self):
+        # pickle as the path; workers map the files themselves
+        return ListStore, (self.path,)
+
+    def __repr__(self):
+        return f'ListStore({self.path!r})'
+
+    @property
+    def n_lists(self):
+        return self.meta['n_lists']
+
+    @property
+    def recall_keys(self):
+        return self.meta['recall_keys']
+
+    def content_hash(self):
+        # hash of the prepared data the store was written from
+        # (caching.data_hash uses it)
+        return self.meta['hash']
+
+    def subject_lists(self, subject):
+        # indices of the lists of a subject
+        code = np.flatnonzero(self.subjects == subject)
+        return np.flatnonzero(np.isin(self.arrays['list_subject'], code))
+
+    def view(self, index):
+        # lazy view of some of the lists (index: positions or mask), to
+        # pass to workers in place of the lists themselves
+        return ListView(self, index)
+
+    def prepared(self, index=None):
+        # prepared lists (as from cmr_l.prepare_lists), for all lists or
+        # for a subset (index: positions or mask). all lists give a
+        # PreparedData (built once per process); a subset gives a plain
+        # dict of lists, like cmr_l.select_lists
+        if index is None and self._prepared is not None:
+            return self._prepared
+        a = self.arrays
+        rows = np.arange(self.n_lists) if index is None else np.arange(self.n_lists)[index]
+        if index is None:
+            max_len, max_rec = self.meta['max_length'], self.meta['max_recalls']
+        else:
+            max_len = int(a['list_length'][rows].max(initial=0))
+            counts = a['recall_offsets'][rows + 1] - a['recall_offsets'][rows]
+            max_rec = int(counts.max(initial=0))
+        recalls = _padded(a['recalls'], a['recall_offsets'], rows, max_rec, 0)
+        lists = {
+            'subject': self.subjects[a['list_subject'][rows]],
+            'list': np.array(a['list_num'][rows]),
+            'list_length': a['list_length'][rows].astype(np.int64),
+            'pres_itemnos': _padded(a['study_items'], a['study_offsets'], rows,
+                                    max_len, -1).astype(np.int64),
+            'recalls': recalls.astype(np.int64),
+            'recall_keys': {key: _padded(a['key_' + key], a['recall_offsets'], rows,
+                                         max_rec, np.nan)
+                            for key in self.recall_keys},
+        }
+        if index is not None:
+            return lists
+        if not self.meta['events']:
+            self._prepared = lists
+            return lists
+
+        events = pd.DataFrame({'subject': self.subjects[a['event_subject']],
+                               'list': np.array(a['event_list']),
+                               'position': np.array(a['event_position'])})
+        event_index = (np.array(a['event_row']), np.array(a['event_col']),
+                       np.array(a['event_num']))
+        event_values = {key: np.array(a['event_key_' + key]) for key in self.recall_keys}
+        self._prepared = cmr_l.PreparedData(lists, events, event_index, event_values)
+        self._prepared._hash = self.content_hash()
+        return self._prepared
+
+    # the PreparedData interface, for permutation tests on a store
+
+    @property
+    def events(self):
+        return self.prepared().events
+
+    @property
+    def n_events(self):
+        return self.prepared().n_events
+
+    @property
+    def event_values(self):
+        return self.prepared().event_values
+
+    def with_covariate(self, key, values):
+        return self.prepared().with_covariate(key, values)
+
+
+class ListView:
+    # some of the lists of a store; pickles as the store path and the
+    # list indices
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = np.arange(store.n_lists)[index]
+
+    @property
+    def recall_keys(self):
+        return self.store.recall_keys
+
+    def content_hash(self):
+        return caching.hash_parts(self.store.content_hash(), self.index.tobytes())
+
+    def prepared(self):
+        return self.store.prepared(self.index)
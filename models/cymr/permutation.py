@@ -0,0 +1,187 @@
+import numpy as np
+from scipy import stats
+from joblib import Parallel, delayed
+
+# permutation tests for recall-event covariates (e.g. scrambling a neural
+# signal like 'hcmp'). each scramble has its own child stream of one
+# seed, so results don't depend on n_jobs or batch size, and a batch only
+# draws the shuffles it evaluates (memory does not grow with n_perm).
+# scrambles are evaluated in rounds of n_jobs batches; each batch works
+# on its own copy of the data and only swaps the covariate column
+# between evaluations. after every round the p-value and its confidence
+# interval are updated, and the test stops once the interval is clear
+# of alpha.
+
+
+def perm_seeds(n_perm, rng=None):
+    # one SeedSequence per scramble, spawned from a seed, SeedSequence or
+    # np.random.Generator
+    if isinstance(rng, np.random.Generator):
+        root = rng.bit_generator.seed_seq
+    elif isinstance(rng, np.random.SeedSequence):
+        root = rng
+    else:
+        root = np.random.SeedSequence(rng)
+    return root.spawn(n_perm)
+
+
+def shuffle_indices(n_events, seeds, strata=None):
+    # [scrambles x n_events] matrix, one row per seed in seeds; row i
+    # reorders the covariate values for scramble i. strata: optional
+    # integer label per event; values are only shuffled among events with
+    # the same label. the integer label plus a uniform key in [0, 1)
+    # sorts events by stratum first and in random order within stratum
+    keys = np.array([np.random.default_rng(seed).random(n_events) for seed in seeds])
+    keys = keys.reshape(len(seeds), n_events)
+    if strata is None:
+        return np.argsort(keys, axis=1)
+    strata = np.asarray(strata)
+    order = np.argsort(strata, kind='stable')
+    shuffled = np.argsort(keys + strata, axis=1)
+    idx = np.empty_like(shuffled)
+    idx[:, order] = shuffled
+    return idx
+
+
+def strata_codes(data, rows, strata):
+    # integer stratum label for each of the given rows, from one or more
+    # columns (e.g. ['subject'] or ['subject', 'list'])
+    if strata is None:
+        return None
+    if isinstance(strata, str):
+        strata = [strata]
+    if hasattr(data, 'events'):
+        # prepared data: rows are recall events
+        data = data.events
+    sub = data.iloc[rows][strata]
+    return sub.groupby(strata, sort=False, observed=True).ngroup().to_numpy()
+
+
+def iter_permutation_test(model, data, param_def, key, n_perm=1000,
+                          patterns=None, values=None, observed=None,
+                          strata=None, n_jobs=1, batch_size=10, alpha=0.05,
+                          conf=0.99, early_stop=True, rng=None,
+                          **likelihood_kws):
+    # yields a summary dict after each round of scrambles (see
+    # permutation_test for the arguments and the fields of the summary)
+    param = param_def.fixed.copy()
+    if hasattr(data, 'with_covariate'):
+        rows = np.arange(data.n_events)
+        if values is None:
+            values = data.event_values[key]
+    else:
+        rows = np.flatnonzero((data['trial_type'] == 'recall').to_numpy())
+        if values is None:
+            values = data[key].to_numpy()[rows]
+    values = np.asarray(values)
+    if values.shape[0] != rows.shape[0]:
+        raise ValueError('values must have one entry per recall event')
+
+    if observed is None:
+        res = model.likelihood(data, param, param_def=param_def,
+                               patterns=patterns, **likelihood_kws)
+        observed = float(np.sum(res['logl']))
+
+    seeds = perm_seeds(n_perm, rng)
+    codes = strata_codes(data, rows, strata)
+    logl_perm = np.full(n_perm, np.nan)
+    n_done = 0
+    round_size = max(n_jobs, 1) * batch_size
+    with Parallel(n_jobs=n_jobs) as parallel:
+        while n_done < n_perm:
+            stop = min(n_done + round_size, n_perm)
+            blocks = np.array_split(np.arange(n_done, stop), max(n_jobs, 1))
+            blocks = [b for b in blocks if b.size]
+            out = parallel(
+                delayed(_eval_scrambles)(model, data, param, param_def, patterns,
+                                         key, rows, values,
+                                         [seeds[i] for i in b], codes,
+                                         likelihood_kws)
+                for b in blocks)
+            for b, block_logl in zip(blocks, out):
+                logl_perm[b] = block_logl
+            n_done = stop
+
+            summary = _summary(observed, logl_perm[:n_done], alpha, conf)
+            summary['stopped_early'] = False
+            decided = summary['ci'][1] < alpha or summary['ci'][0] > alpha
+            if early_stop and decided and n_done < n_perm:
+                summary['stopped_early'] = True
+                yield summary
+                return
+            yield summary
+
+
+def permutation_test(model, data, param_def, key, n_perm=1000, patterns=None,
+                     values=None, observed=None, strata=None, n_jobs=1,
+                     batch_size=10, alpha=0.05, conf=0.99, early_stop=True,
+                     rng=None, callback=None, **likelihood_kws):
+    # model, data, param_def, patterns: as for model.likelihood; the
+    #   fixed values of param_def are evaluated. data can also be
+    #   prepared (cmr_l.prepare_lists, with cmr_l.Model); each scramble
+    #   then only replaces the covariate array
+    # key: covariate column to scramble across recall events
+    # values: values to scramble (one per recall event, in data order);
+    #   default is the current values of key in data
+    # observed: log-likelihood to compare against; default is the
+    #   likelihood of data with the covariate intact
+    # strata: column(s) to shuffle within, e.g. 'subject' or
+    #   ['subject', 'list']; default shuffles across all recall events
+    # batch_size: scrambles per worker per round
+    # alpha, conf: stop once the conf-level interval on the p-value
+    #   excludes alpha (if early_stop)
+    # rng: seed, SeedSequence or np.random.Generator for the shuffles
+    # callback: called with the running summary after each round
+    # returns a dict with observed, logl_perm (scrambles evaluated so
+    # far), n_perm, n_exceed (scrambles with logl >= observed), pval
+    # ((n_exceed + 1) / (n_perm + 1)), ci (conf-level Clopper-Pearson
+    # interval on pval, as n_exceed + 1 of n_perm + 1) and stopped_early
+    summary = None
+    for summary in iter_permutation_test(
+            model, data, param_def, key, n_perm=n_perm, patterns=patterns,
+            values=values, observed=observed, strata=strata, n_jobs=n_jobs,
+            batch_size=batch_size, alpha=alpha, conf=conf,
+            early_stop=early_stop, rng=rng, **likelihood_kws):
+        if callback is not None:
+            callback(summary)
+    return summary
+
+
+def _eval_scrambles(model, data, param, param_def, patterns, key, rows,
+                    values, seeds, strata, likelihood_kws):
+    perm_idx = shuffle_indices(rows.shape[0], seeds, strata)
+    if hasattr(data, 'with_covariate'):
+        # prepared data: swap in each scramble without copying the rest
+        block_logl = np.empty(perm_idx.shape[0])
+        for i, idx in enumerate(perm_idx):
+            res = model.likelihood(data.with_covariate(key, values[idx]), param,
+                                   param_def=param_def, patterns=patterns,
+                                   **likelihood_kws)
+            block_logl[i] = np.sum(res['logl'])
+        return block_logl
+    data = data.copy()
+    column = data[key].to_numpy(dtype=float, copy=True)
+    block_logl = np.empty(perm_idx.shape[0])
+    for i, idx in enumerate(perm_idx):
+        column[rows] = values[idx]
+        data[key] = column
+        res = model.likelihood(data, param, param_def=param_def,
+                               patterns=patterns, **likelihood_kws)
+        block_logl[i] = np.sum(res['logl'])
+    return block_logl
+
+
+def _summary(observed, logl_perm, alpha, conf):
+    n = logl_perm.shape[0]
+    k = int(np.sum(logl_perm >= observed))
+    return {'observed': observed, 'logl_perm': logl_perm.copy(), 'n_perm': n,
+            'n_exceed': k, 'pval': (k + 1) / (n + 1),
+            'ci': clopper_pearson(k + 1, n + 1, conf)}
+
+
+def clopper_pearson(k, n, conf=0.95):
+    # exact binomial confidence interval for k successes out of n
+    tail = (1 - conf) / 2
+    lower = stats.beta.ppf(tail, k, n - k + 1) if k > 0 else 0.0
+    upper = stats.beta.ppf(1 - tail, k + 1, n - k) if k < n else 1.0
+    return float(lower), float(upper)
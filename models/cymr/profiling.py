@@ -0,0 +1,179 @@
+import contextlib
+import functools
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+# opt-in profiling of the python model path (cmr_l and fitting). the
+# phases of a likelihood evaluation are marked with timed (functions) or
+# phase (blocks); while a profile is active, each records its call count
+# and its own time (time in nested phases is counted in those phases, so
+# shares add up to the total). when no profile is active, a marked
+# function costs one global lookup per call.
+#
+# phases in cmr_l: prepare (DataFrame to list arrays), expand (parameter
+# arrays), dynamic (dynamic parameter expressions), likelihood
+# (bookkeeping of the recall loop), encoding (study period), recall
+# (cue strengths and recall probabilities), stop (stop probabilities),
+# context (context updates), totals (per-subject sums). in fitting:
+# objective (everything in the optimizer outside the likelihood).
+#
+#   with profiling.profile() as prof:
+#       fitting.fit_indiv(data, param_def)
+#   print(prof.summary())
+
+# the active Profile, or None
+_active = None
+
+
+class Profile:
+    # phase timings, cache counts and (optionally) memory for one
+    # profiling session
+
+    def __init__(self, memory=False, caches=None):
+        self.memory = memory
+        self.caches = dict(caches or {})
+        self.calls = {}
+        self.times = {}
+        self.peaks = []
+        self.cache_counts = {}
+        self.wall = 0.0
+        self._stack = []
+
+    def _enter(self):
+        self._stack.append(0.0)
+
+    def _exit(self, name, elapsed):
+        # elapsed: wall time of the phase, including nested phases
+        child = self._stack.pop()
+        self.calls[name] = self.calls.get(name, 0) + 1
+        self.times[name] = self.times.get(name, 0.0) + elapsed - child
+        if self._stack:
+            self._stack[-1] += elapsed
+
+    def summary(self):
+        # DataFrame indexed by phase with calls, time (s, excluding
+        # nested phases), time per call (ms) and share of the profiled
+        # wall time; 'other' is time outside any marked phase
+        names = sorted(self.times, key=self.times.get, reverse=True)
+        times = np.array([self.times[n] for n in names])
+        calls = np.array([self.calls[n] for n in names])
+        other = max(self.wall - times.sum(), 0.0)
+        frame = pd.DataFrame({'calls': np.append(calls, 0),
+                              'time': np.append(times, other)},
+                             index=pd.Index(names + ['other'], name='phase'))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            frame['ms_per_call'] = np.where(frame['calls'] > 0,
+                                            1000 * frame['time'] / frame['calls'], np.nan)
+            frame['share'] = frame['time'] / self.wall if self.wall > 0 else np.nan
+        return frame
+
+    def cache_summary(self):
+        # DataFrame indexed by cache with hits, misses and hit rate
+        # during the session
+        frame = pd.DataFrame(self.cache_counts, index=['hits', 'misses']).T
+        frame.index.name = 'cache'
+        total = frame['hits'] + frame['misses']
+        frame['hit_rate'] = (frame['hits'] / total).where(total > 0)
+        return frame
+
+    def memory_summary(self):
+        # peak memory (MB above the start of the call) per likelihood
+        # call, if memory was traced
+        peaks = np.array(self.peaks) / 2 ** 20
+        if peaks.size == 0:
+            return pd.Series({'calls': 0, 'mean_mb': np.nan, 'max_mb': np.nan})
+        return pd.Series({'calls': peaks.size, 'mean_mb': peaks.mean(),
+                          'max_mb': peaks.max()})
+
+
+def _cache_counts(caches):
+    # current hit and miss counts of the model caches and any extra
+    # caches (objects with hits and misses attributes)
+    import cmr_l
+    info = cmr_l.compile_expression.cache_info()
+    counts = {'encoding': (cmr_l.encoding_cache.hits, cmr_l.encoding_cache.misses),
+              'expression': (info.hits, info.misses)}
+    for name, cache in caches.items():
+        counts[name] = (cache.hits, cache.misses)
+    return counts
+
+
+@contextlib.contextmanager
+def profile(memory=False, caches=None):
+    # profile the enclosed code; yields the Profile, which is complete
+    # when the block exits.
+    # memory: also record the peak memory of each likelihood call with
+    #   tracemalloc (slows python-heavy code)
+    # caches: optional dict of {name: cache} of other caches to count,
+    #   e.g. {'sweep': sweep.default_cache}
+    global _active
+    if _active is not None:
+        raise RuntimeError('a profile is already active')
+    prof = Profile(memory, caches)
+    before = _cache_counts(prof.caches)
+    started = memory and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    _active = prof
+    start = time.perf_counter()
+    try:
+        yield prof
+    finally:
+        prof.wall = time.perf_counter() - start
+        _active = None
+        if started:
+            tracemalloc.stop()
+        after = _cache_counts(prof.caches)
+        prof.cache_counts = {name: {'hits': after[name][0] - before[name][0],
+                                    'misses': after[name][1] - before[name][1]}
+                             for name in after}
+
+
+def timed(name, memory=False):
+    # decorator marking a function as a phase. memory: record the peak
+    # memory of each call when the profile traces memory (for top-level
+    # calls like the likelihood, not nested phases)
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            prof = _active
+            if prof is None:
+                return func(*args, **kwargs)
+            trace = memory and prof.memory
+            if trace:
+                tracemalloc.reset_peak()
+                base = tracemalloc.get_traced_memory()[0]
+            prof._enter()
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                prof._exit(name, time.perf_counter() - start)
+                if trace:
+                    prof.peaks.append(tracemalloc.get_traced_memory()[1] - base)
+        return wrapper
+    return decorate
+
+
+@contextlib.contextmanager
+def _phase(prof, name):
+    prof._enter()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        prof._exit(name, time.perf_counter() - start)
+
+
+_null = contextlib.nullcontext()
+
+
+def phase(name):
+    # context manager marking a block as a phase
+    prof = _active
+    if prof is None:
+        return _null
+    return _phase(prof, name)
@@ -0,0 +1,199 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+
+import item_patterns
+
+# semantic similarity of the items in a word pool, for pre-experimental
+# associations (Sfc/Scf, or cmr_l's sem_mat). similarity is the cosine of
+# word embeddings, as in helpers/cosdist.m, computed for the whole pool
+# at once in blocks of rows (float32 throughout) so a large pool never
+# needs more than [block x pool] working memory. words without an
+# embedding get zero similarity to everything, like cosdist_onetomany.m
+# does for zero vectors.
+#
+# with a cache directory, the [pool x pool] matrix is stored as a .npy
+# file keyed by the pool and the contents of the embedding file, and is
+# returned memory-mapped read-only; submatrix then reads only the rows
+# a list needs.
+#
+#   sim = semantic.similarity_matrix('resources/iEEG_FR_nouns.txt',
+#                                    'glove.6B.300d.txt', cache_dir='cache')
+#   sem = semantic.submatrix(sim, pres_itemnos)  # [lists x LL x LL]
+
+VERSION = 1
+
+
+def file_hash(path, chunk_size=2 ** 20):
+    # sha1 of the contents of a file, read in chunks
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def load_embeddings(path, words, lowercase=True):
+    # [words x dim] float32 embedding of each word, from a local file:
+    # text with one word and its values per line (GloVe, or word2vec
+    # text format with a header line), or .npz with 'words' and 'vectors'
+    # arrays. only the rows for words are kept, so large files are never
+    # loaded whole. if lowercase, words are matched regardless of case
+    # (the first match in the file is used).
+    # returns the vectors (zero rows for words that were not found) and
+    # a boolean [words] array of which were found
+    words = [str(w) for w in words]
+    keys = [w.lower() for w in words] if lowercase else words
+    rows = {}
+    for i, key in enumerate(keys):
+        rows.setdefault(key, []).append(i)
+
+    vectors = None
+    found = np.zeros(len(words), dtype=bool)
+    if path.endswith('.npz'):
+        with np.load(path, allow_pickle=False) as saved:
+            file_words = saved['words'].astype(str)
+            if lowercase:
+                file_words = np.char.lower(file_words)
+            matched = {}
+            for j, word in enumerate(file_words):
+                if word in rows and word not in matched:
+                    matched[word] = j
+            vectors = np.zeros((len(words), saved['vectors'].shape[1]), dtype=np.float32)
+            for word, j in matched.items():
+                vectors[rows[word]] = saved['vectors'][j]
+                found[rows[word]] = True
+        return vectors, found
+
+    with open(path, encoding='utf-8', errors='replace') as f:
+        for n, line in enumerate(f):
+            word, _, values = line.rstrip().partition(' ')
+            if n == 0 and _is_header(line):
+                continue
+            if lowercase:
+                word = word.lower()
+            if word not in rows or found[rows[word][0]]:
+                continue
+            vec = np.array(values.split(), dtype=np.float32)
+            if vectors is None:
+                vectors = np.zeros((len(words), vec.shape[0]), dtype=np.float32)
+            elif vec.shape[0] != vectors.shape[1]:
+                raise ValueError(f'embedding for {word} has {vec.shape[0]} values; '
+                                 f'expected {vectors.shape[1]}')
+            vectors[rows[word]] = vec
+            found[rows[word]] = True
+            if found.all():
+                break
+    if vectors is None:
+        vectors = np.zeros((len(words), 0), dtype=np.float32)
+    return vectors, found
+
+
+def _is_header(line):
+    # word2vec text files start with "<n words> <dim>"
+    parts = line.split()
+    return len(parts) == 2 and all(p.isdigit() for p in parts)
+
+
+def cosine_matrix(vectors, block_size=1024, out=None):
+    # [n x n] float32 cosine similarity of the rows of vectors, computed
+    # block_size rows at a time (out: optional array, e.g. a memmap, to
+    # fill). rows with zero length get zero similarity
+    vectors = np.asarray(vectors, dtype=np.float32)
+    n = vectors.shape[0]
+    norm = np.linalg.norm(vectors, axis=1)
+    unit = np.divide(vectors, norm[:, None], out=np.zeros_like(vectors),
+                     where=norm[:, None] > 0)
+    if out is None:
+        out = np.empty((n, n), dtype=np.float32)
+    for start in range(0, n, block_size):
+        block = unit[start:start + block_size] @ unit.T
+        np.clip(block, -1, 1, out=out[start:start + block_size])
+    return out
+
+
+def similarity_matrix(pool, embedding_path, cache_dir=None, block_size=1024,
+                      lowercase=True, missing='zero'):
+    # [pool x pool] float32 cosine similarity of the words in a pool.
+    # pool: path of a word pool file (one word per line), or an array of
+    #   words
+    # embedding_path: local embedding file (see load_embeddings)
+    # cache_dir: if set, the matrix is stored there (keyed by the pool
+    #   words and the embedding file contents) and returned as a
+    #   read-only memmap, so later calls (and worker processes) map the
+    #   file instead of recomputing it
+    # missing: 'zero' to give words without an embedding zero
+    #   similarity, or 'error' to raise a ValueError
+    if missing not in ('zero', 'error'):
+        raise ValueError(f'unknown missing option: {missing}')
+    if isinstance(pool, str):
+        pool = item_patterns.load_wordpool(pool)
+    words = [str(w) for w in pool]
+    cache_file = None
+    if cache_dir is not None:
+        spec = {'words': words, 'embedding': file_hash(embedding_path),
+                'lowercase': lowercase, 'missing': missing, 'version': VERSION}
+        key = hashlib.sha1(json.dumps(spec).encode()).hexdigest()[:16]
+        cache_file = os.path.join(cache_dir, f'semantic_{key}.npy')
+        if os.path.exists(cache_file):
+            return np.load(cache_file, mmap_mode='r')
+
+    vectors, found = load_embeddings(embedding_path, words, lowercase)
+    if missing == 'error' and not found.all():
+        absent = [w for w, f in zip(words, found) if not f]
+        raise ValueError(f'no embedding for {len(absent)} words: {absent[:10]}')
+    if cache_file is None:
+        return cosine_matrix(vectors, block_size)
+
+    # fill a temporary file and rename it, so a parallel run never maps
+    # half a matrix
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_file = cache_file[:-len('.npy')] + f'.{os.getpid()}.tmp.npy'
+    out = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.float32,
+                                    shape=(len(words), len(words)))
+    cosine_matrix(vectors, block_size, out)
+    out.flush()
+    del out
+    os.replace(tmp_file, cache_file)
+    return np.load(cache_file, mmap_mode='r')
+
+
+def submatrix(sim, item_index):
+    # similarity among the items of each list. item_index: [LL] pool
+    # indices of one list, giving [LL x LL], or [lists x LL], giving
+    # [lists x LL x LL]. only the rows of the listed items are read, so
+    # this is cheap on a memmapped matrix
+    item_index = np.asarray(item_index)
+    rows = np.unique(item_index)
+    block = np.asarray(sim[rows][:, rows])
+    local = np.searchsorted(rows, item_index)
+    return block[local[..., :, None], local[..., None, :]]
+
+
+def add_similarity(patterns, sim, name='sem'):
+    # add a [pool x pool] similarity matrix to a cymr patterns dict (for
+    # weights on a similarity layer, e.g. 'Sfc * sem'); returns patterns
+    if sim.shape != (len(patterns['items']),) * 2:
+        raise ValueError('similarity matrix must be [pool x pool]')
+    patterns.setdefault('similarity', {})[name] = sim
+    return patterns
+
+
+def pool_patterns(patterns, item_index):
+    # patterns for a subset of the pool (e.g. the items of one list or
+    # session), with similarity submatrices and vector rows for those
+    # items, for cymr models that only need to see part of a large pool
+    item_index = np.asarray(item_index)
+    vectors = {}
+    for name, value in patterns.get('vector', {}).items():
+        if isinstance(value, item_patterns.LocalistPatterns):
+            vectors[name] = item_patterns.LocalistPatterns(item_index.shape[0], value.dtype)
+        else:
+            vectors[name] = np.asarray(value[item_index])
+    out = {'items': np.asarray(patterns['items'])[item_index], 'vector': vectors}
+    if 'similarity' in patterns:
+        out['similarity'] = {name: submatrix(value, item_index)
+                             for name, value in patterns['similarity'].items()}
+    return out
@@ -0,0 +1,118 @@
+import os
+import time
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from psifr import fr
+
+import generation
+
+# simulated data on disk as a Parquet dataset partitioned by subject and
+# replicate (<path>/subject=<s>/rep=<r>/part-*.parquet), so large runs
+# can be written as they are generated and analyzed a chunk at a time.
+# chunks are read back lazily, one subject (or subject x replicate) at a
+# time, and fed to likelihood or psifr functions whose results are
+# per-subject anyway, so only one chunk is in memory at once.
+
+
+def write_chunk(chunk, path, partition_cols=('subject', 'rep')):
+    # append one frame of simulated data to the dataset at path. file
+    # names start with the write time (fixed width), so sorting them
+    # gives the order they were written; the random part keeps files
+    # from concurrent writers apart
+    table = pa.Table.from_pandas(chunk, preserve_index=False)
+    stamp = '{:020d}-{}'.format(time.time_ns(), os.urandom(4).hex())
+    pq.write_to_dataset(table, path, partition_cols=list(partition_cols),
+                        basename_template='part-' + stamp + '-{i}.parquet')
+
+
+def generate_to_parquet(model, data, path, group_param, rep_key='rep',
+                        **generate_kws):
+    # simulate data with generation.iter_generate and write each subject
+    # to the dataset at path as soon as it is done. takes the same
+    # arguments as generation.generate (n_rep, seed, n_jobs, ...).
+    # returns the number of events written
+    n_rows = 0
+    for chunk in generation.iter_generate(model, data, group_param,
+                                          rep_key=rep_key, **generate_kws):
+        write_chunk(chunk, path, partition_cols=('subject', rep_key))
+        n_rows += len(chunk)
+    return n_rows
+
+
+def chunk_keys(path, by=('subject',)):
+    # sorted list of the distinct values of the partition columns in by
+    # (one tuple per chunk)
+    dataset = ds.dataset(path, format='parquet', partitioning='hive')
+    keys = set()
+    for fragment in dataset.get_fragments():
+        part = ds.get_partition_keys(fragment.partition_expression)
+        keys.add(tuple(part[name] for name in by))
+    return sorted(keys)
+
+
+def iter_chunks(path, by=('subject',), columns=None, keys=None):
+    # yield (key, frame) for each chunk of the dataset at path, where a
+    # chunk is all events with the same values of the partition columns
+    # in by (e.g. ('subject',) or ('subject', 'rep')). rows are in the
+    # order they were written (see write_chunk), with replicates in
+    # order.
+    # columns: optional subset of columns to read
+    # keys: optional list of chunk keys to read (default all)
+    if isinstance(by, str):
+        by = (by,)
+    dataset = ds.dataset(path, format='parquet', partitioning='hive')
+    groups = {}
+    for fragment in dataset.get_fragments():
+        part = ds.get_partition_keys(fragment.partition_expression)
+        groups.setdefault(tuple(part[name] for name in by), []).append((part, fragment))
+    if keys is None:
+        keys = sorted(groups)
+    names = dataset.schema.names if columns is None else list(columns)
+    for key in keys:
+        # partitions in order, then files in the order they were written
+        parts = sorted(groups[key], key=lambda x: (sorted(x[0].items()),
+                                                   os.path.basename(x[1].path)))
+        tables = []
+        for part, fragment in parts:
+            table = fragment.to_table(schema=dataset.schema, columns=names)
+            tables.append(table)
+        frame = pa.concat_tables(tables).to_pandas()
+        yield key, frame[_column_order(dataset, frame.columns)]
+
+
+def _column_order(dataset, columns):
+    # partition columns are read last; put them back where they were
+    # when the data were written
+    meta = dataset.schema.pandas_metadata
+    if not meta:
+        return list(columns)
+    order = [c['name'] for c in meta['columns'] if c['name'] in columns]
+    return order + [c for c in columns if c not in order]
+
+
+def read_parquet(path, columns=None, keys=None, by=('subject',)):
+    # read a whole dataset (or the chunks in keys) into one frame
+    frames = [frame for key, frame in iter_chunks(path, by, columns, keys)]
+    return pd.concat(frames, axis=0, ignore_index=True)
+
+
+def likelihood_chunks(model, path, group_param, **likelihood_kws):
+    # model.likelihood evaluated one subject at a time; returns the
+    # per-subject results for the whole dataset
+    stats = [model.likelihood(frame, group_param, **likelihood_kws)
+             for key, frame in iter_chunks(path)]
+    return pd.concat(stats, axis=0)
+
+
+def summarize_chunks(path, func, recall_keys=None, **kws):
+    # psifr analysis (e.g. fr.spc, fr.lag_crp) of each subject after
+    # fr.merge_free_recall; psifr summaries are computed by subject, so
+    # the results are the same as for the whole dataset at once
+    results = []
+    for key, frame in iter_chunks(path):
+        merged = fr.merge_free_recall(frame, recall_keys=recall_keys)
+        results.append(func(merged, **kws))
+    return pd.concat(results, axis=0)
@@ -0,0 +1,239 @@
+import numpy as np
+import pandas as pd
+
+# summary statistics of free recall (SPC, lag-CRP, lag rank) computed
+# with array operations on a dense recall matrix, instead of walking
+# each list in python as psifr does. merged data (fr.merge_free_recall)
+# are converted once with recall_matrix; each statistic is then a few
+# vectorized passes over [lists x outputs] arrays. results have the same
+# format and values as the matching psifr functions.
+#
+# conditional analyses take a [lists x outputs] boolean mask of
+# transitions to include, where entry (i, j) marks the transition from
+# output j to output j + 1 of list i (see transition_mask). this is
+# equivalent to psifr's test_key / test with a test that only depends on
+# the previous item (e.g. test=lambda x, y: x < -0.5): excluded
+# transitions count toward neither actual nor possible lags.
+
+
+def recall_matrix(merged, keys=None):
+    # convert merged free recall data to dense arrays:
+    # subject, list, list_length: [lists]
+    # recalls: [lists x outputs] serial position of each recall (NaN for
+    #   intrusions and padding)
+    # valid: [lists x outputs] recall of a studied item that has not
+    #   been recalled before
+    # covariates: dict of [lists x outputs] values of each column in
+    #   keys at each recall
+    if keys is None:
+        keys = []
+    elif isinstance(keys, str):
+        keys = [keys]
+    list_id = merged.groupby(['subject', 'list'], sort=True).ngroup().to_numpy()
+    n_lists = int(list_id.max()) + 1 if list_id.size else 0
+    first = np.full(n_lists, -1)
+    first[list_id[::-1]] = np.arange(len(list_id))[::-1]
+
+    study = merged['study'].to_numpy(dtype=bool)
+    inputs = merged['input'].to_numpy(dtype=float)
+    list_length = np.zeros(n_lists, dtype=int)
+    np.maximum.at(list_length, list_id[study], inputs[study].astype(int))
+
+    output = merged['output'].to_numpy(dtype=float)
+    is_rec = ~np.isnan(output)
+    rec_list = list_id[is_rec]
+    rec_out = output[is_rec].astype(int) - 1
+    max_out = int(rec_out.max()) + 1 if rec_out.size else 0
+    recalls = np.full((n_lists, max_out), np.nan)
+    recalls[rec_list, rec_out] = inputs[is_rec]
+    valid = np.zeros((n_lists, max_out), dtype=bool)
+    repeat = merged['repeat'].to_numpy()[is_rec] > 0
+    valid[rec_list, rec_out] = ~np.isnan(inputs[is_rec]) & ~repeat
+
+    covariates = {}
+    for key in keys:
+        values = np.full((n_lists, max_out), np.nan)
+        values[rec_list, rec_out] = merged[key].to_numpy(dtype=float)[is_rec]
+        covariates[key] = values
+    return {'subject': merged['subject'].to_numpy()[first],
+            'list': merged['list'].to_numpy()[first],
+            'list_length': list_length, 'recalls': recalls, 'valid': valid,
+            'covariates': covariates}
+
+
+def transition_mask(mat, key, test):
+    # [lists x outputs] mask of transitions to include, from a covariate
+    # in mat['covariates'] and a vectorized test of the values at the
+    # previous and current recall, e.g. lambda x, y: x < -0.5
+    values = mat['covariates'][key]
+    mask = np.zeros(values.shape, dtype=bool)
+    with np.errstate(invalid='ignore'):
+        mask[:, :-1] = np.broadcast_to(test(values[:, :-1], values[:, 1:]),
+                                       mask[:, :-1].shape)
+    return mask
+
+
+def _subject_codes(mat):
+    subjects, codes = np.unique(mat['subject'], return_inverse=True)
+    return subjects, codes.reshape(-1)
+
+
+def _transitions(mat, mask=None):
+    # included transitions and the positions available at each one.
+    # returns the list, output (of the previous recall), previous and
+    # current position of each transition and [transitions x max list
+    # length] availability
+    recalls = mat['recalls']
+    valid = mat['valid']
+    n_lists, max_out = recalls.shape
+    max_len = int(mat['list_length'].max(initial=0))
+    # output at which each position is first recalled
+    first_out = np.full((n_lists, max_len + 1), np.inf)
+    rows, outs = np.nonzero(valid)
+    pos = recalls[rows, outs].astype(int)
+    np.minimum.at(first_out, (rows, pos), outs)
+
+    include = valid[:, :-1] & valid[:, 1:]
+    if mask is not None:
+        include &= mask[:, :-1]
+    rows, outs = np.nonzero(include)
+    prev = recalls[rows, outs].astype(int)
+    curr = recalls[rows, outs + 1].astype(int)
+    positions = np.arange(1, max_len + 1)
+    avail = ((first_out[rows, 1:] > outs[:, None]) &
+             (positions[None, :] <= mat['list_length'][rows, None]))
+    return rows, outs, prev, curr, avail
+
+
+def spc(mat):
+    # serial position curve; same output as fr.spc
+    subjects, codes = _subject_codes(mat)
+    max_len = int(mat['list_length'].max(initial=0))
+    positions = np.arange(1, max_len + 1)
+    studied = positions[None, :] <= mat['list_length'][:, None]
+    recalled = np.zeros(studied.shape, dtype=bool)
+    rows, outs = np.nonzero(mat['valid'])
+    recalled[rows, mat['recalls'][rows, outs].astype(int) - 1] = True
+
+    n_subj = subjects.shape[0]
+    n_studied = np.zeros((n_subj, max_len))
+    n_recalled = np.zeros((n_subj, max_len))
+    np.add.at(n_studied, codes, studied)
+    np.add.at(n_recalled, codes, recalled)
+    keep = n_studied > 0
+    subj_ind, pos_ind = np.nonzero(keep)
+    return pd.DataFrame({'subject': subjects[subj_ind],
+                         'input': positions[pos_ind].astype(float),
+                         'recall': n_recalled[keep] / n_studied[keep]})
+
+
+def _count_lags(group, n_groups, prev, curr, avail, max_len):
+    # [groups x lags] counts of actual and possible lags, for
+    # transitions labeled with a group index
+    n_lag = 2 * max_len - 1
+    actual = np.bincount(group * n_lag + (curr - prev + max_len - 1),
+                         minlength=n_groups * n_lag)
+    t_ind, p_ind = np.nonzero(avail)
+    lag_ind = (p_ind + 1) - prev[t_ind] + max_len - 1
+    possible = np.bincount(group[t_ind] * n_lag + lag_ind,
+                           minlength=n_groups * n_lag)
+    return actual.reshape(n_groups, n_lag), possible.reshape(n_groups, n_lag)
+
+
+def _crp_frame(subjects, max_len, actual, possible):
+    n_lag = 2 * max_len - 1
+    with np.errstate(invalid='ignore', divide='ignore'):
+        prob = actual / possible
+    lags = np.arange(-(max_len - 1), max_len)
+    return pd.DataFrame({'subject': np.repeat(subjects, n_lag),
+                         'lag': np.tile(lags, subjects.shape[0]),
+                         'prob': prob.ravel(), 'actual': actual.ravel(),
+                         'possible': possible.ravel()})
+
+
+def lag_crp(mat, mask=None):
+    # lag conditional response probability; same output as fr.lag_crp.
+    # mask: optional transition mask (see transition_mask)
+    subjects, codes = _subject_codes(mat)
+    max_len = int(mat['list_length'].max(initial=0))
+    rows, outs, prev, curr, avail = _transitions(mat, mask)
+    actual, possible = _count_lags(codes[rows], subjects.shape[0], prev, curr,
+                                   avail, max_len)
+    return _crp_frame(subjects, max_len, actual, possible)
+
+
+def covariate_bins(values, bins=None, n_quantiles=None):
+    # bin edges for a covariate, either fixed (bins: increasing edges;
+    # bin k is bins[k] <= x < bins[k + 1]) or n_quantiles bins with equal
+    # numbers of the (non-NaN) values, with open outer edges
+    if (bins is None) == (n_quantiles is None):
+        raise ValueError('specify one of bins or n_quantiles')
+    if bins is not None:
+        return np.asarray(bins, dtype=float)
+    edges = np.nanquantile(values, np.linspace(0, 1, n_quantiles + 1))
+    edges[0] = -np.inf
+    edges[-1] = np.inf
+    return edges
+
+
+def binned_lag_crp(mat, key, bins=None, n_quantiles=None, labels=None):
+    # lag-CRP for each bin of a covariate, in one pass over transitions.
+    # transitions are binned on the covariate at the previous recall
+    # (the x of a psifr test); transitions with a NaN value or outside
+    # the edges are left out.
+    # bins: bin edges, e.g. [-inf, -0.5, 0.5, inf] for low, middle and
+    #   high values
+    # n_quantiles: number of quantile bins, with edges from the values
+    #   at all included transitions
+    # labels: optional name for each bin
+    # returns the lag_crp columns for each bin and subject, with the bin
+    # index (bin), its name (label) and its edges (lower, upper)
+    subjects, codes = _subject_codes(mat)
+    max_len = int(mat['list_length'].max(initial=0))
+    rows, outs, prev, curr, avail = _transitions(mat)
+    values = mat['covariates'][key][rows, outs]
+
+    edges = covariate_bins(values, bins, n_quantiles)
+    n_bins = edges.shape[0] - 1
+    bin_ind = np.searchsorted(edges, values, side='right') - 1
+    keep = ~np.isnan(values) & (bin_ind >= 0) & (bin_ind < n_bins)
+    n_subj = subjects.shape[0]
+    group = bin_ind[keep] * n_subj + codes[rows[keep]]
+    actual, possible = _count_lags(group, n_bins * n_subj, prev[keep],
+                                   curr[keep], avail[keep], max_len)
+    crp = _crp_frame(np.tile(subjects, n_bins), max_len, actual, possible)
+
+    n_rows = n_subj * (2 * max_len - 1)
+    bin_col = np.repeat(np.arange(n_bins), n_rows)
+    if labels is None:
+        labels = [f'[{lo:g}, {hi:g})' for lo, hi in zip(edges[:-1], edges[1:])]
+    crp.insert(0, 'bin', bin_col)
+    crp.insert(1, 'label', np.asarray(labels, dtype=object)[bin_col])
+    crp.insert(2, 'lower', edges[:-1][bin_col])
+    crp.insert(3, 'upper', edges[1:][bin_col])
+    return crp
+
+
+def lag_rank(mat, mask=None):
+    # mean percentile rank of the absolute lag of each transition among
+    # the absolute lags that were possible (1 for the closest, 0 for the
+    # most distant, ties at the mean rank); same output as fr.lag_rank
+    subjects, codes = _subject_codes(mat)
+    rows, outs, prev, curr, avail = _transitions(mat, mask)
+    positions = np.arange(1, avail.shape[1] + 1)
+    actual = np.abs(curr - prev)
+    possible = np.abs(positions[None, :] - prev[:, None])
+    n_poss = np.count_nonzero(avail, axis=1)
+    n_less = np.count_nonzero(avail & (possible < actual[:, None]), axis=1)
+    n_equal = np.count_nonzero(avail & (possible == actual[:, None]), axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rank = 1 - (n_less + (n_equal - 1) / 2) / (n_poss - 1)
+    rank = np.where(n_poss > 1, rank, np.nan)
+
+    subj = codes[rows]
+    ok = ~np.isnan(rank)
+    total = np.bincount(subj[ok], weights=rank[ok], minlength=subjects.shape[0])
+    count = np.bincount(subj[ok], minlength=subjects.shape[0])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / count
+    return pd.DataFrame({'subject': subjects, 'rank': mean})
@@ -0,0 +1,136 @@
+import itertools
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+
+import caching
+
+# likelihood sweeps over grids of parameter values.
+# each point of the grid overrides entries of param_def.fixed; points are
+# split into one batch per job so the data are sent to each worker once,
+# and every evaluation is memoized on (data, patterns, model config,
+# parameter values), so repeated or overlapping grids cost nothing.
+
+# cache used when none is passed in; lives for the python session
+default_cache = caching.ResultCache()
+
+
+def grid_points(grid):
+    # list of parameter dicts for every combination of the values in
+    # grid, a dict of {param name: values}. the last parameter varies
+    # fastest, as in nested for loops over the names in order
+    names = list(grid)
+    return [dict(zip(names, values))
+            for values in itertools.product(*[np.asarray(grid[n]).tolist() for n in names])]
+
+
+def likelihood_sweep(model, data, param_def, grid, patterns=None, n_jobs=1,
+                     cache=None, by_subject=False, **likelihood_kws):
+    # model: cymr model (anything with a cymr-style likelihood method)
+    # data: free recall DataFrame
+    # param_def: cymr Parameters; its fixed values are the defaults for
+    #   every point, and it is passed to model.likelihood as param_def
+    # grid: dict of {param name: values}, or a list of parameter dicts
+    # n_jobs: number of worker processes
+    # cache: a caching.ResultCache (e.g. with a directory to keep results
+    #   between runs), None for the module default, or False for none
+    # by_subject: return one row per point and subject instead of one
+    #   row per point
+    # likelihood_kws: passed on, e.g. recall_keys=['hcmp']
+    # returns a DataFrame with one column per swept parameter plus
+    # 'logl' and 'n' (and 'subject' if by_subject)
+    points = grid_points(grid) if isinstance(grid, dict) else [dict(p) for p in grid]
+    if cache is None:
+        cache = default_cache
+
+    keys = [None] * len(points)
+    results = [None] * len(points)
+    if cache is not False:
+        config = caching.hash_parts(
+            type(model).__module__, type(model).__qualname__,
+            caching.param_def_hash(param_def),
+            caching.data_hash(data),
+            caching.patterns_hash(patterns),
+            caching.param_key(likelihood_kws),
+        )
+        for i, point in enumerate(points):
+            keys[i] = cache.key(config, caching.param_key(_full_param(param_def, point)))
+            results[i] = cache.get(keys[i])
+
+    todo = [i for i, res in enumerate(results) if res is None]
+    if todo:
+        n_batch = min(max(n_jobs, 1), len(todo))
+        batches = [todo[j::n_batch] for j in range(n_batch)]
+        if n_batch == 1:
+            out = [_eval_batch(model, data, param_def, patterns, likelihood_kws,
+                               [points[i] for i in batches[0]])]
+        else:
+            out = Parallel(n_jobs=n_jobs)(
+                delayed(_eval_batch)(model, data, param_def, patterns, likelihood_kws,
+                                     [points[i] for i in batch])
+                for batch in batches)
+        for batch, batch_res in zip(batches, out):
+            for i, res in zip(batch, batch_res):
+                results[i] = res
+                if cache is not False:
+                    cache.put(keys[i], res)
+
+    return _sweep_frame(points, results, by_subject)
+
+
+def _full_param(param_def, point):
+    param = param_def.fixed.copy()
+    param.update(point)
+    return param
+
+
+def _eval_batch(model, data, param_def, patterns, likelihood_kws, points):
+    batch_res = []
+    for point in points:
+        stats = model.likelihood(data, _full_param(param_def, point),
+                                 param_def=param_def, patterns=patterns,
+                                 **likelihood_kws)
+        batch_res.append({'subject': [caching.plain_value(s) for s in stats.index],
+                          'logl': stats['logl'].astype(float).tolist(),
+                          'n': stats['n'].astype(int).tolist()})
+    return batch_res
+
+
+def _sweep_frame(points, results, by_subject):
+    names = list(dict.fromkeys(k for p in points for k in p))
+    if by_subject:
+        frames = []
+        for i, (point, res) in enumerate(zip(points, results)):
+            frame = pd.DataFrame({'subject': res['subject'], 'logl': res['logl'], 'n': res['n']})
+            for name in reversed(names):
+                frame.insert(0, name, point.get(name, np.nan))
+            frame.insert(0, 'point', i)
+            frames.append(frame)
+        return pd.concat(frames, ignore_index=True)
+    frame = pd.DataFrame([{n: p.get(n, np.nan) for n in names} for p in points],
+                         columns=names)
+    frame['logl'] = [np.sum(res['logl']) for res in results]
+    frame['n'] = [int(np.sum(res['n'])) for res in results]
+    return frame
+
+
+def best_point(result, value='logl'):
+    # row of a sweep result with the largest value (e.g. max likelihood)
+    return result.loc[result[value].idxmax()]
+
+
+def to_grid(result, names, value='logl'):
+    # values from a sweep result as an array with one axis per parameter
+    # in names, with axes ordered by first appearance of each value.
+    # (result.set_index(names)[value].to_xarray() gives a labeled
+    # version if xarray is installed)
+    if isinstance(names, str):
+        names = [names]
+    levels = [pd.unique(result[n]) for n in names]
+    if len(names) == 1:
+        index = pd.Index(levels[0], name=names[0])
+    else:
+        index = pd.MultiIndex.from_product(levels, names=names)
+    values = result.groupby(names, sort=False)[value].sum().reindex(index)
+    return values.to_numpy().reshape([len(lev) for lev in levels])
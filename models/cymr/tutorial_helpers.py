@@ -1,119 +1,104 @@
 
+import inspect
+
 import numpy as np
-import pandas as pd
-from psifr import fr
 import seaborn as sns
 import matplotlib.pyplot as plt
-from string import ascii_letters
+
+import expt_builder as eb
+import item_patterns as ip
+import covariates as cov
+import summaries
+import comparison
 
 def create_patterns(pool_size):
     # goal here is to have a bare-bones set of patterns that makes
     # it clear what fields cymr expects and what format they should have
     # pool_size must be an int
-    # create a pool of fake item strings using ascii_letters
-    # which means currently pool_size must be < 52
-    item_pool = np.empty((pool_size,), dtype=str)
-    for i in range(pool_size):
-        item_pool[i] = ascii_letters[i]
-    # create a set of localist vectors:
-    localist_dict = {'loc': np.eye(pool_size)}
-    patterns = {'items': item_pool,
-                'vector': localist_dict}
-    return patterns
+    # item names are a, b, ... Z, aa, ab, ... so any pool size works;
+    # see item_patterns.create_patterns for word pools, distributed
+    # vectors and implicit localist patterns for large pools
+    # localist vectors stay dense here, as cymr has always received them
+    return ip.create_patterns(pool_size, localist='dense')
 
-def create_expt(patterns, n_subj, n_trials, list_len, dummy_recalls=False):
-    for i in range(n_subj):
-        sess_frame = create_session(patterns, i+1, n_trials, list_len, dummy_recalls)
-        if i==0:
-            expt_frame = sess_frame.copy()
-        else:
-            expt_frame = pd.concat([expt_frame, sess_frame], ignore_index=True)
-            
-    return expt_frame
+def create_expt(patterns, n_subj, n_trials, list_len, dummy_recalls=False,
+                item_order='fixed', rng=None):
+    # builds the whole experiment in one pass, see expt_builder.build_expt
+    # n_trials and list_len can also be given per subject, and
+    # item_order='random' draws a new random sample of items for each list
+    return eb.build_expt(patterns, n_subj, n_trials, list_len, dummy_recalls,
+                         item_order=item_order, rng=rng)
 
 def create_session(patterns, subjid, n_trials, list_len, dummy_recalls):
-    for i in range(n_trials):
-        trial_frame = create_list(patterns, subjid, i+1, list_len, dummy_recalls)
-        if i==0:
-            sess_frame = trial_frame.copy()
-        else:
-            #sess_frame = sess_frame.append(trial_frame)
-            sess_frame = pd.concat([sess_frame, trial_frame], ignore_index=True)
-    return sess_frame
+    return eb.build_expt(patterns, 1, n_trials, list_len, dummy_recalls,
+                         subjects=[subjid])
 
 
 def create_list(patterns, subjid, trialnum, list_len, dummy_recalls):
+    trial_frame = eb.build_expt(patterns, 1, 1, list_len, dummy_recalls,
+                                subjects=[subjid])
+    trial_frame['list'] = np.int32(trialnum)
+    return trial_frame
 
-    positions = np.zeros((list_len,),dtype=int)
-    indices = np.zeros((list_len,), dtype=int)
-    item_names = np.empty((list_len,), dtype=str)
-    for i in range(list_len):
-        positions[i] = i+1
-        indices[i] = i
-        item_names[i] = patterns['items'][i]
-
-    study_frame = pd.DataFrame({
-        'subject': np.ones((list_len,),dtype=int) * subjid,
-        'list': np.ones((list_len,),dtype=int) * trialnum,
-        'trial_type': ['study'] * list_len,
-        'position': positions,
-        'item_index': indices,
-        'item': item_names
-    })
-
-    if dummy_recalls:
-        recall_frame = pd.DataFrame({
-            'subject': np.ones((list_len,),dtype=int) * subjid,
-            'list': np.ones((list_len,),dtype=int) * trialnum,
-            'trial_type': ['recall'] * list_len,
-            'position': positions,
-            'item_index': indices,
-            'item': item_names
-        })
-        #trial_frame = study_frame.append(recall_frame)
-        trial_frame = pd.concat([study_frame, recall_frame], ignore_index=True)
+def set_recall_dynamic(param_def, expressions):
+    # dynamic recall parameters, evaluated at each recall event.
+    # newer cymr versions take a scope ('list' or per item) before the
+    # expressions and would otherwise read the dict as the scope and set
+    # nothing; older versions take the expressions directly
+    if 'scope' in inspect.signature(param_def.set_dynamic).parameters:
+        param_def.set_dynamic('recall', 'item', expressions)
     else:
-        trial_frame = study_frame
-
-    return trial_frame
+        param_def.set_dynamic('recall', expressions)
 
 def fix_hcmp_field(orig_df, new_df):
     # to identify a recall event, subject, list, trial_type, position
-    for index, row in orig_df.iterrows():
-        if row.trial_type == 'recall':
-            # find the corresponding row or rows in dyn_sim (rows if n_rep > 1)
-            mask = (new_df.subject==row.subject) & \
-                   (new_df.list==row.list) & \
-                   (new_df.position==row.position) & \
-                   (new_df.trial_type=='recall')
-            new_df.loc[mask, 'hcmp'] = row.hcmp
-    return new_df
+    # (with lists of replicate i numbered i * max_list + list by generate).
+    # see covariates.carry_recall_keys to carry other recall_keys
+    return cov.carry_recall_keys(orig_df, new_df, ['hcmp'])
 
-def plot_var_crp(df, figpath):
-    crp1 = fr.lag_crp(df, test_key='hcmp', test=lambda x, y: x < -0.5)
-    crp1['condition'] = 'low_brec'
-    crp2 = fr.lag_crp(df, test_key='hcmp', test=lambda x, y: x > 0.5)
-    crp2['condition'] = 'high_brec'
-    combined = pd.concat([crp1, crp2])
+def var_crp(df, key='hcmp', low=-0.5, high=0.5):
+    # lag-CRP for transitions from recalls with low (x < low) and high
+    # (x > high) values of key, computed together in one pass (see
+    # summaries.binned_lag_crp for any number of bins or quantiles).
+    # bins include their lower edge, so the high bin starts just above
+    # high to keep x == high out of it
+    mat = summaries.recall_matrix(df, keys=[key])
+    edges = [-np.inf, low, np.nextafter(high, np.inf), np.inf]
+    crp = summaries.binned_lag_crp(mat, key, bins=edges,
+                                   labels=['low_brec', 'mid', 'high_brec'])
+    crp = crp.query('label != "mid"').rename(columns={'label': 'condition'})
+    return crp.reset_index(drop=True)
+
+def plot_binned_crp(crp, hue='condition', max_lag=5):
+    # plot lag-CRP curves for each condition (or bin label) in crp,
+    # leaving out lag 0
     sns.set_theme(font_scale=1.2, style="ticks")
-    max_lag = 5
     filt_neg = f'{-max_lag} <= lag < 0'
     filt_pos = f'0 < lag <= {max_lag}'
-    g = sns.FacetGrid(combined, height=5)
+    g = sns.FacetGrid(crp, height=5)
     g.map_dataframe(
         lambda data, **kws: sns.lineplot(
-            data=data.query(filt_neg), x='lag', y='prob', hue='condition', **kws)
+            data=data.query(filt_neg), x='lag', y='prob', hue=hue, **kws)
     )
     g.map_dataframe(
         lambda data, **kws: sns.lineplot(
-            data=data.query(filt_pos), x='lag', y='prob', hue='condition', **kws)
+            data=data.query(filt_pos), x='lag', y='prob', hue=hue, **kws)
     )
     g.set_xlabels('Lag')
     g.set_ylabels('Cond. Resp. Prob.')
+    return g
+
+def plot_var_crp(df, figpath=None):
+    # figure is saved only if figpath is given; returns the lag-CRP
+    combined = var_crp(df)
+    g = plot_binned_crp(combined)
     plt.legend(['Low', 'High'], title='Temp. Reinst.')
     g.set(ylim=(0, 0.6))
-    plt.savefig(figpath+'var_hcmp_crp.pdf', bbox_inches='tight')
+    if figpath is not None:
+        plt.savefig(figpath+'var_hcmp_crp.pdf', bbox_inches='tight')
+    return combined
 
 def calc_aic(n, V, L):
-    aic = -2*L + 2*V + (2*V*(V+1)) / (n-V-1)
-    return aic
+    # AICc for n data points, V free parameters and log-likelihood L;
+    # arrays of any shape work
+    return comparison.aicc(L, n, V)